@@ -16,16 +16,28 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import daemon
-import daemon.runner
-import lockfile
 import signal
 import threading
 import os
 import logging
+import logging.handlers
+import queue
 import sys
 import socket
+import ssl
+import time
+import asyncio
+import json
+import collections
+import frames
 import messaging
+import metrics
+import relay
+import store
+import tls
+import workers
+from client import SUSD_SHELL_PORT, SUS_DIR
+from peers import PeerDirectory
 
 
 logger = logging.getLogger('SUSd')
@@ -35,12 +47,57 @@ logger.info('SUSd loaded.')
 stop = threading.Event()
 
 
-SUSD_SHELL_PORT = 7777
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """ Hands log records over to a QueueListener without formatting them.
+
+    Records are put in the queue as they are, so that %-style arguments
+    are only merged by the listener thread. When the queue is full records
+    are dropped rather than blocking the caller, and the number of dropped
+    records is logged as soon as there's room again.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': logger.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'log queue full: dropped %d records.', 'args': (self.dropped,),
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def queue_logging(size=10000):
+    """ Moves the root handlers behind a queue served by a separate thread.
+
+    Logging calls then only append a record to the queue: formatting and
+    writing to disk happen in the listener's thread. Returns the started
+    logging.handlers.QueueListener; stop it to flush the queue.
+    """
+    handlers = logging.root.handlers[:]
+    records = queue.Queue(size)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        logging.root.removeHandler(handler)
+    logging.root.addHandler(LogQueueHandler(records))
+    listener.start()
+    return listener
 
 
 def start(args):
     """ Start the daemon, if not already running. """
     # args: as given from argparse
+    import daemon  # only starting needs python-daemon, not the shell nor shutdown
+    import daemon.runner
+    import lockfile
     logger.info('attempting start.')
     try:
         pidfile = daemon.runner.make_pidlockfile('/tmp/SUS.pid', acquire_timeout=1)
@@ -77,9 +134,21 @@ def close(signum, frame):
     """ Catches SIGTERM and SIGTSTP. """
     import messaging
     stop.set()
-    socket.socket(socket.AF_INET, socket.SOCK_STREAM) \
-        .connect(('', messaging.SUS_MESSAGES_PORT))  # makes inboxsocket.accept return.
-                                                     # See messaging.InboxServer.listen
+    messaging.incoming_messages.wake()
+    messaging.outgoing_messages.wake()
+    if messaging.outbox_spool is not None:
+        messaging.outbox_spool.wake()
+    wake_inbox()
+
+
+def wake_inbox():
+    import messaging
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_STREAM) \
+            .connect(('', messaging.SUS_MESSAGES_PORT))  # makes inboxsocket.accept return.
+                                                         # See messaging.InboxServer.listen
+    except socket.error:
+        pass  # the asyncio event loop doesn't need waking up
 
 
 def shutdown(args):
@@ -95,10 +164,10 @@ def shutdown(args):
         if args.kill:
             os.kill(pid, signal.SIGKILL)
             os.remove('/tmp/SUS.pid')
-            logger.info('sent SIGKILL to {}.'.format(pid))
+            logger.info('sent SIGKILL to %s.', pid)
         else:
             os.kill(pid, signal.SIGTERM)
-            logger.info('sent SIGTERM to {}.'.format(pid))
+            logger.info('sent SIGTERM to %s.', pid)
     except ProcessLookupError:
         print("error>  SUS isn't running!")
         return
@@ -108,157 +177,704 @@ def shutdown(args):
 def run(args):
     global stop
 
+    # after daemonizing: a listener thread started earlier wouldn't survive the fork
+    log_listener = queue_logging(args.log_queue_size)
+    messaging.log_bodies = not args.log_metadata_only
     logger.info('setting up messaging services.')
     # Setting up messaging services
-    inbox = messaging.InboxServer(ip=args.ip)
+    spool = store.OutboxSpool(os.path.join(SUS_DIR, 'outbox.spool'),
+                              sync_interval=args.spool_sync_ms / 1000)
+    spool.stop = stop
+    messaging.incoming_messages.capacity = args.incoming_capacity or None
+    messaging.incoming_messages.policy = args.incoming_policy
+    messaging.outgoing_messages.capacity = args.outgoing_capacity or None
+    messaging.outgoing_messages.policy = args.outgoing_policy
+    messaging.outgoing_messages.on_drop = messaging.reject
+    for message_id, recipient, message in spool.open():
+        messaging.outgoing_messages.append(messaging.Outgoing(recipient, message, None, message_id))
+    messaging.outbox_spool = spool
+    spool_thread = threading.Thread(target=spool.start, name='Spool')
+    spool_thread.start()
+    message_store = None
+    if not args.no_history:
+        message_store = store.MessageStore(os.path.join(SUS_DIR, 'messages'))
+    limiter = None
+    if args.inbox_rate > 0:
+        limiter = messaging.RateLimiter(args.inbox_rate, args.inbox_burst or None)
+    duplicates = None
+    if args.dedup_window > 0 and args.dedup_capacity > 0:
+        duplicates = messaging.DuplicateFilter(args.dedup_window, args.dedup_capacity)
+    peers = PeerDirectory(os.path.join(SUS_DIR, 'peers.json'), ttl=args.resolve_ttl)
+    silenced = messaging.SilenceList(os.path.join(SUS_DIR, 'silenced.json'))
+    server_tls, client_tls = tls_contexts(args)
+    relay_service = start_relay(args, peers, client_tls) if args.relay else None
+    relays = resolve_all(peers, args.relays)
+    inbox_workers = args.inbox_workers
+    if inbox_workers and not workers.reuse_port_available():
+        logger.info('SO_REUSEPORT unavailable: serving the inbox from this process only.')
+        inbox_workers = 0
+    if inbox_workers and relay_service is not None:
+        # the relay lives in this process: workers would turn senders away
+        logger.info('relays serve the inbox from this process only.')
+        inbox_workers = 0
+    inbox = messaging.InboxServer(
+        ip=args.ip, history=message_store, limiter=limiter, backlog=args.backlog,
+        admission=messaging.Admission(args.max_connections, args.max_connections_per_ip or None),
+        duplicates=duplicates, silenced=silenced, reuse_port=inbox_workers > 0,
+        relay=relay_service, tls=server_tls, relays=relays,
+    )
     inbox.stop = stop
-    inbox_thread = threading.Thread(target=inbox.listen, name='Inbox')
+    worker_processes = workers.start_workers(
+        inbox_workers, args, inbox, stop, silenced.path,
+        tls_files(args) if server_tls is not None else None, relays,
+    ) if inbox_workers else []
+    shell = Shell(ip=args.ip, groups_file=os.path.join(SUS_DIR, 'groups.json'),
+                  backlog=args.backlog, admission=messaging.Admission(args.max_connections),
+                  peers=peers, silence_list=silenced)
+    shell.stop = stop
+    if args.async_io:
+        # inbox and shell share one event loop
+        inbox_thread = threading.Thread(target=messaging.listen_async,
+                                        args=([inbox, shell], stop), name='EventLoop')
+        shell_thread = None
+    else:
+        inbox_thread = threading.Thread(target=inbox.listen, name='Inbox')
+        shell_thread = threading.Thread(target=shell.listen, name='Shell')
     inbox_thread.start()
-    outbox = messaging.OutboxSender()
+    codec = None
+    if args.compress != 'none':
+        try:
+            codec = frames.codec_named(args.compress)
+        except KeyError:
+            logger.info('%s compression unavailable, sending uncompressed.', args.compress)
+            print('error>  {} compression is not available.'.format(args.compress))
+    outbox = messaging.OutboxSender(
+        senders=args.senders,
+        retries=messaging.RetryScheduler(max_attempts=args.max_attempts),
+        connections=messaging.PeerConnectionPool(
+            max_per_peer=args.max_peer_connections, idle_timeout=args.keep_alive,
+            health=messaging.PeerHealth(failure_threshold=args.peer_failures,
+                                        probe_interval=args.probe_interval,
+                                        connect_timeout=args.connect_timeout),
+            tls=client_tls,
+        ),
+        coalesce_delay=args.coalesce_ms / 1000,
+        history=message_store,
+        codec=codec,
+        compress_threshold=args.compress_threshold,
+        relays=relays,
+    )
     outbox.stop = stop
     outbox_thread = threading.Thread(target=outbox.start, name='Outbox')
     outbox_thread.start()
-    newmessages = messaging.NewMessagesHandlerStdout()
+    newmessages = messaging.NewMessagesHandlerStdout(peers=peers)
     newmessages.stop = stop
     newmessages_thread = threading.Thread(target=newmessages.start, name='NewMessagesHdlr')
     newmessages_thread.start()
-    shell = Shell(ip=args.ip)
-    shell.stop = stop
-    shell_thread = threading.Thread(target=shell.listen, name='Shell')
-    shell_thread.start()
+    if args.multicast:
+        multicast = messaging.MulticastListener(inbox)
+        multicast.stop = stop
+        threading.Thread(target=multicast.listen, name='Multicast', daemon=True).start()
+    if shell_thread is not None:
+        shell_thread.start()
+    register_gauges(inbox, outbox, spool)
+    if relay_service is not None:
+        metrics.registry.gauge('sus_relay_held', 'Messages held for unreachable peers.',
+                               lambda: len(relay_service))
+    metrics_server = None
+    if args.metrics_port:
+        try:
+            metrics_server = metrics.serve_prometheus(args.metrics_port)
+            logger.info('serving metrics at http://127.0.0.1:%d/.', args.metrics_port)
+        except socket.error as exc:
+            logger.info('could not serve metrics: %s.', exc)
     logger.info('done setting up services.')
 
     # threads only join when stopped by a SIGTERM -> shutdown
+    if worker_processes:
+        stop.wait()
+        # workers share the inbox's port: close() may have woken one of them instead
+        for process in worker_processes:
+            process.terminate()
+        for process in worker_processes:
+            process.join(timeout=0.5)
+        wake_inbox()
     inbox_thread.join()
     outbox_thread.join(timeout=0.5)
     newmessages_thread.join(timeout=0.5)
-    shell_thread.join(timeout=0.5)
+    if shell_thread is not None:
+        shell_thread.join(timeout=0.5)
+    spool_thread.join(timeout=0.5)
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if message_store is not None:
+        message_store.close()
+    peers.close()
     logger.info('SUS is shutting down.')
+    log_listener.stop()
 
 
-def send(recipient, message):
-    if message.find('##END') > -1:
-        print('error>  cannot have "##END" inside of message.')
-        return
-    logger.info('sending "{}" to <{}>.'.format(message, recipient))
-    susd_shell = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def tls_files(args):
+    """ The certificate and key files presented to peers. """
+    return (args.tls_cert or os.path.join(SUS_DIR, 'tls.crt'),
+            args.tls_key or os.path.join(SUS_DIR, 'tls.key'))
+
+
+def tls_contexts(args):
+    """ Returns the ssl.SSLContext of the inbox and the tls.ClientTLS of the outbox.
+
+    Both are None without --tls; the inbox's is also None without a certificate.
+    """
+    if not args.tls:
+        return None, None
+    client_tls = tls.ClientTLS(tls.client_context(args.tls_ca))
     try:
-        susd_shell.connect(('', SUSD_SHELL_PORT))
-    except socket.error:
-        print('error>  SUS isn\'t running.')
-        return
-    susd_shell.sendall(b'send ')
-    susd_shell.sendall(recipient.encode('utf-8'))
-    susd_shell.sendall(b' ')
-    susd_shell.sendall(message.encode('utf-8'))
-    susd_shell.sendall(b'\n')
-    received = ''
-    while len(received) != 6:
-        fragment = susd_shell.recv(100)
-        if fragment == b'':
-            break
-        received = ''.join([received, fragment.decode('utf-8')])
-    status = received.strip()
-    susd_shell.close()
-    if status == 'OK\n200':
-        print('SUS>  ✓')
-    else:
-        print('SUS>  error on accepting message.')
+        server_tls = tls.server_context(*tls_files(args))
+    except (OSError, ssl.SSLError) as exc:
+        logger.info('could not load the TLS certificate: %s. Receiving in plaintext only.', exc)
+        print('error>  could not load the TLS certificate: {}.'.format(exc))
+        server_tls = None
+    return server_tls, client_tls
 
 
-def reply(message):
-    if message.find('##END') > -1:
-        print('error>  cannot have "##END" inside of message.')
-        return
-    logger.info('replying with "{}".'.format(message))
-    susd_shell = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def start_relay(args, peers, client_tls=None):
+    """ Starts holding messages for unreachable peers; returns the relay.Relay, or None. """
     try:
-        susd_shell.connect(('', SUSD_SHELL_PORT))
-    except socket.error:
-        print('error>  SUS isn\'t running.')
-        return
-    susd_shell.sendall(b'reply ')
-    susd_shell.sendall(message.encode('utf-8'))
-    susd_shell.sendall(b'\n')
-    received = ''
-    while len(received) != 6:
-        fragment = susd_shell.recv(100)
-        if fragment == b'':
-            break
-        received = ''.join([received, fragment.decode('utf-8')])
-    status = received.strip()
-    susd_shell.close()
-    if status == 'OK\n200':
-        print('SUS>  ✓')
-    elif status == 'OK\n400':
-        print('error>  no message to reply to.')
-    else:
-        print('SUS>  error on accepting message.')
+        sealer = relay.Sealer(os.path.join(SUS_DIR, 'relay.key'))
+    except ImportError:
+        logger.info('relay mode needs the cryptography package: not relaying.')
+        print('error>  relay mode needs the cryptography package.')
+        return None
+    relay_spool = store.OutboxSpool(os.path.join(SUS_DIR, 'relay.spool'),
+                                    sync_interval=args.spool_sync_ms / 1000)
+    relay_spool.stop = stop
+    relay_service = relay.Relay(relay_spool, sealer, capacity=args.relay_capacity,
+                                retention=args.relay_retention * 86400,
+                                siblings=resolve_all(peers, args.relay_siblings),
+                                sync_interval=args.relay_sync_interval, tls=client_tls)
+    relay_service.stop = stop
+    relay_service.open()
+    threading.Thread(target=relay_spool.start, name='RelaySpool').start()
+    threading.Thread(target=relay_service.start, name='Relay', daemon=True).start()
+    return relay_service
+
+
+def resolve_all(peers, names):
+    """ The IPs of the comma-separated peers in `names`. """
+    ips = []
+    for name in filter(None, (n.strip() for n in names.split(','))):
+        ip = peers.resolve(name)
+        if ip is None:
+            logger.info('could not resolve <%s>: ignored.', name)
+        else:
+            ips.append(ip)
+    return ips
+
+
+def register_gauges(inbox, outbox, spool):
+    """ Exposes the state of the running services in metrics.registry. """
+    gauge = metrics.registry.gauge
+    gauge('sus_incoming_queue_depth', 'Received messages not handled yet.',
+          lambda: len(messaging.incoming_messages))
+    gauge('sus_outgoing_queue_depth', 'Messages waiting to be picked up by the outbox.',
+          lambda: len(messaging.outgoing_messages))
+    gauge('sus_inbox_threads', 'Threads serving inbox connections.',
+          lambda: len(inbox.threads))
+    gauge('sus_inbox_connections', 'Inbox connections being served.',
+          lambda: len(inbox.admission))
+    gauge('sus_inbox_refused', 'Inbox connections refused by admission control.',
+          lambda: inbox.admission.refused)
+    gauge('sus_incoming_rejected', 'Received messages refused because the queue was full.',
+          lambda: messaging.incoming_messages.rejected)
+    gauge('sus_incoming_dropped', 'Received messages dropped to make room for newer ones.',
+          lambda: messaging.incoming_messages.dropped)
+    gauge('sus_outgoing_rejected', 'Messages to send refused because the queue was full.',
+          lambda: messaging.outgoing_messages.rejected)
+    gauge('sus_outgoing_dropped', 'Messages to send dropped to make room for newer ones.',
+          lambda: messaging.outgoing_messages.dropped)
+    gauge('sus_retry_pending', 'Messages waiting for their recipient\'s backoff to expire.',
+          lambda: len(outbox.retries))
+    gauge('sus_dead_letters', 'Messages given up on, kept for inspection.',
+          lambda: len(outbox.retries.dead_letters))
+    gauge('sus_spool_pending', 'Messages in the outbox spool not delivered yet.',
+          lambda: len(spool.pending))
+    gauge('sus_unreachable_peers', 'Recipients held back until a probe gets through.',
+          lambda: len(outbox.health.unreachable()))
+    gauge('sus_subscribers', 'Interactive clients receiving pushed messages.',
+          lambda: len(messaging.subscribers))
+    gauge('sus_idle_peer_connections', 'Connections to peers kept open for reuse.',
+          lambda: sum(len(idle) for idle in outbox.connections.idle.values()))
 
 
 class Shell:
     """ Shell for receiving commands while the daemon is running. """
-    def __init__(self, ip, inactivity_timeout=2, buffer_size=1024):
+    REFUSAL = 'OK\n{}'.format(messaging.OVERLOADED).encode('utf-8')
+    WORDS = {'send': 3, 'ungroup': 2, 'unpeer': 2, 'unsilence': 2}  # the fewest a command takes
+
+    def __init__(self, ip, inactivity_timeout=2, buffer_size=1024, groups_file=None,
+                 delivery_timeout=5, stream_timeout=60, backlog=128, admission=None, peers=None,
+                 silence_list=None, poll_interval=0.5, subscriber_backlog=1000):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.bind((ip, SUSD_SHELL_PORT))
+        self.backlog = backlog
+        self.admission = admission if admission is not None else messaging.Admission()
         self.inactivity_timeout = inactivity_timeout
+        self.stream_timeout = stream_timeout  # inactivity allowed in stream mode
+        self.poll_interval = poll_interval  # how often subscriptions check stop while idle
+        self.subscriber_backlog = subscriber_backlog  # pushes a slow subscriber may fall behind
         self.buffer_size = buffer_size
-        self.threads = []
+        self.delivery_timeout = delivery_timeout  # how long group sends wait for results
+        self.groups_file = groups_file
+        self.groups = self.load_groups()
+        self.peers = peers if peers is not None else PeerDirectory()
+        # senders the inbox ignores, edited by the silence commands
+        if silence_list is None:
+            silence_list = messaging.SilenceList()
+        self.silence_list = silence_list
+        self.threads = set()  # threads serving a connection; they remove themselves when done
+        self.threads_lock = threading.Lock()
         self.stop = threading.Event()
 
     def listen(self):
-        self.server.listen(5)
-        logger.info('shell server listening at {}.'.format(self.server))
+        self.server.listen(self.backlog)
+        logger.info('shell server listening at %s.', self.server)
         while not self.stop.is_set():
             client, address = self.server.accept()
+            if not self.admission.admit(address[0]):
+                messaging.refuse(client, self.REFUSAL)
+                continue
             client.settimeout(self.inactivity_timeout)
-            thread = threading.Thread(target=self.serve_client, args=(client, address))
+            thread = threading.Thread(target=self.serve_admitted, args=(client, address))
+            with self.threads_lock:
+                self.threads.add(thread)
             thread.start()
-            self.threads.append(thread)
         logger.info('stop set. Shell is shutting down.')
-        for t in self.threads:
+        with self.threads_lock:
+            threads = list(self.threads)
+        for t in threads:
             t.join(timeout=0.1)
 
+    def serve_admitted(self, client, address):
+        try:
+            self.serve_client(client, address)
+        finally:
+            self.admission.release(address[0])
+            with self.threads_lock:
+                self.threads.discard(threading.current_thread())
+
     def serve_client(self, client, address):
-        logger.info('connected to {}:{}.'.format(address[0], address[1]))
-        received = ''
+        logger.debug('connected to %s:%s.', address[0], address[1])
+        received = bytearray()
         try:
             while not self.stop.is_set():
                 fragment = client.recv(self.buffer_size)
                 if fragment == b'':
                     break
-                received = ''.join([received, fragment.decode('utf-8')])
-                if received.endswith('\n'):
+                received += fragment
+                if received.endswith(b'\n'):
                     break
         except socket.error as exc:
             self.closed_connection(address, exc)
             return
-        if not self.stop.is_set():
-            client.sendall(b'OK\n')
-            client.sendall(str(
-                self.handle_command(received)
-            ).encode('utf-8'))
+        first, _, rest = received.partition(b'\n')
+        if first in (b'stream', b'subscribe') and not self.stop.is_set():
+            try:
+                if first == b'stream':
+                    self.serve_stream(client, rest)
+                else:
+                    self.serve_subscription(client, rest)
+            except socket.error as exc:
+                client.close()
+                self.closed_connection(address, exc)
+                return
+        elif not self.stop.is_set():
+            try:
+                client.sendall(b'OK\n')
+                client.sendall(str(self.run_command(received)).encode('utf-8'))
+            except socket.error as exc:
+                client.close()
+                self.closed_connection(address, exc)
+                return
         client.close()
         self.closed_connection(address)
 
+    def serve_stream(self, client, pending):
+        """ Pipelined mode: every line is a command, answered by a status line, in order. """
+        client.settimeout(self.stream_timeout)
+        client.sendall(b'OK\n')
+        pending = bytearray(pending)
+        while not self.stop.is_set():
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            if lines:
+                client.sendall(self.stream_statuses(lines))
+            fragment = client.recv(65536)
+            if fragment == b'':
+                break
+            pending += fragment
+        if pending and not self.stop.is_set():
+            client.sendall(self.stream_statuses([pending]))
+
+    def serve_subscription(self, client, pending):
+        """ Interactive mode: runs commands, one per line, while pushing incoming messages.
+
+        Both command responses and messages are sent as JSON lines (see
+        response_line and push_line). A subscriber that falls more than
+        `subscriber_backlog` messages behind misses the following ones.
+        """
+        client.settimeout(self.poll_interval)
+        lock = threading.Lock()  # responses and pushes share the connection
+        pushes = queue.Queue()
+        closed = threading.Event()
+
+        def publish(sender, message):
+            if pushes.qsize() < self.subscriber_backlog:
+                pushes.put(self.push_line(sender, message))
+
+        def push():
+            while not closed.is_set():
+                try:
+                    line = pushes.get(timeout=self.poll_interval)
+                    with lock:
+                        client.sendall(line)
+                except queue.Empty:
+                    continue
+                except socket.error:
+                    return
+
+        pusher = threading.Thread(target=push, name='Pusher', daemon=True)
+        pusher.start()
+        messaging.subscribers.add(publish)
+        try:
+            with lock:
+                client.sendall(b'OK\n')
+            pending = bytearray(pending)
+            while not self.stop.is_set():
+                lines = pending.split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    response = self.subscription_response(line)
+                    with lock:
+                        client.sendall(response)
+                try:
+                    fragment = client.recv(self.buffer_size)
+                except socket.timeout:
+                    continue  # subscribers may stay quiet for hours
+                if fragment == b'':
+                    break
+                pending += fragment
+        finally:
+            messaging.subscribers.discard(publish)
+            closed.set()
+            pusher.join()
+
+    @staticmethod
+    def push_line(sender, message):
+        return (json.dumps({'sender': sender, 'message': message}) + '\n').encode('utf-8')
+
+    def subscription_response(self, line):
+        return self.response_line(self.run_command(line))
+
+    @staticmethod
+    def response_line(response):
+        status, _, body = str(response).partition('\n')
+        return (json.dumps({'status': status, 'body': body}) + '\n').encode('utf-8')
+
+    def stream_statuses(self, lines):
+        statuses = []
+        commands = []
+        for line in lines:
+            try:
+                commands.append(line.decode('utf-8'))
+            except UnicodeDecodeError:
+                statuses.extend(self.handle_commands(commands))
+                statuses.append(400)
+                commands = []
+        statuses.extend(self.handle_commands(commands))
+        return ''.join('{}\n'.format(status) for status in statuses).encode('utf-8')
+
+    async def serve_client_async(self, reader, writer):
+        """ Same as serve_client, for connections accepted by messaging.listen_async. """
+        address = writer.get_extra_info('peername')
+        logger.debug('connected to %s:%s.', address[0], address[1])
+        received = bytearray()
+        try:
+            while not self.stop.is_set():
+                fragment = await asyncio.wait_for(reader.read(self.buffer_size),
+                                                  self.inactivity_timeout)
+                if fragment == b'':
+                    break
+                received += fragment
+                if received.endswith(b'\n'):
+                    break
+            first, _, rest = received.partition(b'\n')
+            if first == b'stream' and not self.stop.is_set():
+                await self.serve_stream_async(reader, writer, rest)
+            elif first == b'subscribe' and not self.stop.is_set():
+                await self.serve_subscription_async(reader, writer, rest)
+            elif not self.stop.is_set():
+                # group sends block until delivered, keep them off the event loop
+                response = await asyncio.get_event_loop().run_in_executor(
+                    None, self.run_command, received)
+                writer.write(b'OK\n')
+                writer.write(str(response).encode('utf-8'))
+                await writer.drain()
+        except (socket.error, asyncio.TimeoutError) as exc:
+            writer.close()
+            self.closed_connection(address, exc)
+            return
+        writer.close()
+        self.closed_connection(address)
+
+    async def serve_stream_async(self, reader, writer, pending):
+        """ Same as serve_stream, for connections accepted by messaging.listen_async. """
+        loop = asyncio.get_event_loop()
+        writer.write(b'OK\n')
+        pending = bytearray(pending)
+        while not self.stop.is_set():
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            if lines:
+                writer.write(await loop.run_in_executor(None, self.stream_statuses, lines))
+                await writer.drain()
+            fragment = await asyncio.wait_for(reader.read(65536), self.stream_timeout)
+            if fragment == b'':
+                break
+            pending += fragment
+        if pending and not self.stop.is_set():
+            writer.write(await loop.run_in_executor(None, self.stream_statuses, [pending]))
+            await writer.drain()
+
+    async def serve_subscription_async(self, reader, writer, pending):
+        """ Same as serve_subscription, for connections accepted by messaging.listen_async. """
+        loop = asyncio.get_event_loop()
+        limit = self.subscriber_backlog * self.buffer_size  # bytes a slow subscriber may lag
+
+        def push(line):
+            if writer.transport.get_write_buffer_size() < limit:
+                writer.write(line)
+
+        def publish(sender, message):
+            loop.call_soon_threadsafe(push, self.push_line(sender, message))
+
+        messaging.subscribers.add(publish)
+        try:
+            writer.write(b'OK\n')
+            pending = bytearray(pending)
+            while not self.stop.is_set():
+                lines = pending.split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    writer.write(await loop.run_in_executor(
+                        None, self.subscription_response, line))
+                    await writer.drain()
+                fragment = await reader.read(self.buffer_size)
+                if fragment == b'':
+                    break
+                pending += fragment
+        finally:
+            messaging.subscribers.discard(publish)
+
+    def run_command(self, data):
+        """ Runs the command received as `data`; data that isn't UTF-8 gets a 400. """
+        try:
+            command = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return 400
+        return self.handle_command(command)
+
+    def handle_commands(self, commands):
+        """ Runs pipelined commands, returning their statuses.
+
+        Consecutive sends to a single recipient are enqueued together, so
+        that they share one spool commit.
+        """
+        statuses = []
+        sends = []
+        for command in commands:
+            words = command.split(' ', maxsplit=2)
+            if words[0] == 'send' and len(words) == 3 and ',' not in words[1] \
+                    and not words[1].startswith('@'):
+                recipient = self.peers.resolve(words[1])
+                if recipient is not None:
+                    sends.append((recipient, words[2]))
+                    continue
+            if sends:
+                statuses.extend(self.send_statuses(sends))
+                sends = []
+            statuses.append(str(self.handle_command(command)).split('\n', 1)[0])
+        if sends:
+            statuses.extend(self.send_statuses(sends))
+        return statuses
+
+    @staticmethod
+    def send_statuses(sends):
+        return [200 if accepted else messaging.OVERLOADED
+                for accepted in messaging.enqueue_many(sends)]
+
     def handle_command(self, command):
-        command = command.split(' ', maxsplit=2)
+        """ Runs `command`, returning its status code, optionally followed by a body. """
+        command = command.rstrip('\n').split(' ', maxsplit=2)
+        if len(command) < self.WORDS.get(command[0], 1):
+            return 400
         if command[0] == 'send':
-            messaging.outgoing_messages.append((command[1], command[2]))
-            return 200
+            recipients = self.resolve(command[1])
+            if recipients is None:
+                return '404\nno such group or peer.'
+            if len(recipients) == 1 and not command[1].startswith('@'):
+                if not messaging.enqueue(recipients[0], command[2]):
+                    return messaging.OVERLOADED
+                return 200
+            return self.fan_out(recipients, command[2])
         if command[0] == 'reply':
             if messaging.last_received_sender is None:
                 return 400
             message = ' '.join(command[1:])
-            messaging.outgoing_messages.append((messaging.last_received_sender, message))
+            if not messaging.enqueue(messaging.last_received_sender, message):
+                return messaging.OVERLOADED
+            return 200
+        if command[0] == 'broadcast':
+            try:
+                messaging.send_multicast(' '.join(command[1:]))
+            except (socket.error, ValueError) as exc:
+                logger.info('broadcast failed: %s.', exc)
+                return 500
+            return 200
+        if command[0] == 'stats':
+            return '200\n{}\n'.format(metrics.registry.summary())
+        if command[0] == 'group':
+            return self.handle_group(command[1:])
+        if command[0] == 'ungroup':
+            if self.groups.pop(command[1], None) is None:
+                return 404
+            self.save_groups()
+            return 200
+        if command[0] == 'peer':
+            return self.handle_peer(command[1:])
+        if command[0] == 'unpeer':
+            return 200 if self.peers.remove(command[1]) else 404
+        if command[0] == 'silence':
+            return self.handle_silence(command[1:])
+        if command[0] == 'unsilence':
+            target = self.silence_target(command[1])
+            if target is None or not self.silence_list.remove(target):
+                return 404
             return 200
         else:
             return 404
 
+    def fan_out(self, recipients, message):
+        """ Sends `message` to every recipient in parallel, waiting for the results. """
+        delivery = messaging.Delivery(recipients)
+        messaging.enqueue_all(recipients, message, delivery)
+        results = delivery.wait(self.delivery_timeout)
+        return '200\n' + ''.join('{} {}\n'.format(r, result) for r, result in results.items())
+
+    def expand(self, recipients):
+        """ Expands a comma-separated list of peers and @groups; None if a group is unknown. """
+        expanded = []
+        for recipient in recipients.split(','):
+            recipient = recipient.strip()
+            if recipient.startswith('@'):
+                if recipient[1:] not in self.groups:
+                    return None
+                expanded.extend(self.groups[recipient[1:]])
+            elif recipient:
+                expanded.append(recipient)
+        return list(collections.OrderedDict.fromkeys(expanded))
+
+    def resolve(self, recipients):
+        """ The IPs of a comma-separated list of peers and @groups; None if any is unknown. """
+        expanded = self.expand(recipients)
+        if expanded is None:
+            return None
+        resolved = [self.peers.resolve(recipient) for recipient in expanded]
+        if None in resolved:
+            return None
+        return list(collections.OrderedDict.fromkeys(resolved))
+
+    def handle_group(self, args):
+        args = [arg.strip() for arg in args if arg.strip()]
+        if not args:
+            return '200\n' + ''.join('@{}: {}\n'.format(name, ', '.join(members))
+                                     for name, members in sorted(self.groups.items()))
+        name = args[0]
+        if len(args) == 1:
+            if name not in self.groups:
+                return 404
+            return '200\n@{}: {}\n'.format(name, ', '.join(self.groups[name]))
+        members = self.expand(args[1])  # by name, so that they follow their peer's IP
+        if not members or name.startswith('@') or ',' in name:
+            return 400
+        self.groups[name] = members
+        self.save_groups()
+        return 200
+
+    def handle_peer(self, args):
+        args = [arg.strip() for arg in args if arg.strip()]
+        if not args:
+            names = dict(self.peers.learned)
+            names.update(self.peers.names)
+            return '200\n' + ''.join('{}: {}\n'.format(name, address)
+                                     for name, address in sorted(names.items()))
+        name = args[0]
+        if len(args) == 1:
+            if name not in self.peers:
+                return 404
+            return '200\n{}: {}\n'.format(name, self.peers.get(name))
+        if name.startswith('@') or ',' in name or ',' in args[1]:
+            return 400
+        self.peers.add(name, args[1])
+        return 200
+
+    def silence_target(self, target):
+        """ An IP or CIDR range as it is, or the IP of a peer; None if it doesn't resolve. """
+        target = target.strip()
+        try:
+            return messaging.SilenceList.normalized(target)
+        except ValueError:
+            return self.peers.resolve(target)
+
+    def handle_silence(self, args):
+        args = [arg.strip() for arg in args if arg.strip()]
+        if not args:
+            return '200\n' + ''.join(
+                '{}\n'.format(entry) if expiry is None else '{} until {}\n'.format(
+                    entry, time.strftime('%Y-%m-%d %H:%M', time.localtime(expiry)))
+                for entry, expiry in self.silence_list.items())
+        target = self.silence_target(args[0])
+        if target is None:
+            return '404\nno such peer.'
+        expiry = None
+        if len(args) > 1:
+            try:
+                expiry = time.time() + store.parse_duration(args[1])
+            except ValueError:
+                return 400
+        self.silence_list.add(target, expiry)
+        return '200\n{}\n'.format(target)
+
+    def load_groups(self):
+        if self.groups_file is None or not os.path.exists(self.groups_file):
+            return {}
+        try:
+            with open(self.groups_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as exc:
+            logger.info('could not load groups from %s: %s.', self.groups_file, exc)
+            return {}
+
+    def save_groups(self):
+        if self.groups_file is None:
+            return
+        os.makedirs(os.path.dirname(self.groups_file), exist_ok=True)
+        with open(self.groups_file, 'w') as f:
+            json.dump(self.groups, f, indent=2)
+
     @staticmethod
     def closed_connection(address, exception=None):
         if exception is None:
-            logger.info('closed connection to {}:{}.'.format(address[0], address[1]))
+            logger.debug('closed connection to %s:%s.', address[0], address[1])
         else:
-            logger.info('closed connection to {}:{} due to error <{}>: {}.'.format(
-                address[0], address[1], exception.__class__.__name__, exception))
+            logger.info('closed connection to %s:%s due to error <%s>: %s.',
+                        address[0], address[1], exception.__class__.__name__, exception)
@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" What the SUS command line needs to talk to a running daemon.
+
+Only the standard library modules needed for a single command are
+imported, so that scripted sends start fast: anything daemon-related
+lives in SUSd and messaging.
+"""
+
+
+import os
+import socket
+
+
+SUSD_SHELL_PORT = 7777
+SUS_DIR = os.path.expanduser('~/.SUS')  # where the daemon keeps its data
+
+
+def shell_command(*words):
+    """ Runs a command on the daemon's shell.
+
+    Returns (status, body), or None if SUS isn't running.
+    """
+    susd_shell = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        susd_shell.connect(('', SUSD_SHELL_PORT))
+    except socket.error:
+        print('error>  SUS isn\'t running.')
+        return None
+    susd_shell.sendall(' '.join(words).encode('utf-8'))
+    susd_shell.sendall(b'\n')
+    received = bytearray()
+    while True:
+        fragment = susd_shell.recv(4096)
+        if fragment == b'':
+            break
+        received += fragment
+    susd_shell.close()
+    response = received.decode('utf-8').split('\n', 2)
+    if len(response) < 2 or response[0] != 'OK':
+        return '', ''
+    return response[1].strip(), response[2] if len(response) > 2 else ''
+
+
+RESULTS = {'sent': '✓', 'relayed': '✓ (held by a relay)', 'failed': '✗'}
+
+
+def send(recipient, message):
+    response = shell_command('send', recipient, message)
+    if response is None:
+        return
+    status, results = response
+    if status == '200' and results:
+        # one line per recipient of a group send
+        for line in results.splitlines():
+            recipient, result = line.rsplit(' ', 1)
+            print('SUS>  {} {}'.format(recipient, RESULTS.get(result, result)))
+    elif status == '200':
+        print('SUS>  ✓')
+    elif status == '404':
+        print('error>  {}'.format(results or 'no such group.'))
+    elif status == '503':
+        print('error>  SUS is overloaded, try again later.')
+    else:
+        print('SUS>  error on accepting message.')
+
+
+def send_stream(lines, recipient=None):
+    """ Sends every `recipient<TAB>message` line over a single shell connection.
+
+    Lines are streamed by a separate thread while the statuses are read
+    back, so that the daemon never waits for this end. Lines without a tab
+    are sent to `recipient`.
+    """
+    susd_shell = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        susd_shell.connect(('', SUSD_SHELL_PORT))
+    except socket.error:
+        print('error>  SUS isn\'t running.')
+        return
+    line_numbers = []  # line number of every command sent, in order
+
+    def stream():
+        chunk = [b'stream\n']
+        size = 0
+        for number, line in enumerate(lines, 1):
+            line = line.rstrip('\n')
+            if '\t' in line:
+                to, message = line.split('\t', 1)
+            elif recipient is not None:
+                to, message = recipient, line
+            else:
+                print('error>  line {}: no recipient.'.format(number))
+                continue
+            if not to or not message:
+                continue
+            line_numbers.append(number)
+            command = 'send {} {}\n'.format(to, message).encode('utf-8')
+            chunk.append(command)
+            size += len(command)
+            if size >= 65536:
+                susd_shell.sendall(b''.join(chunk))
+                chunk = []
+                size = 0
+        susd_shell.sendall(b''.join(chunk))
+        susd_shell.shutdown(socket.SHUT_WR)
+
+    import threading
+    streamer = threading.Thread(target=stream, name='Stream', daemon=True)
+    streamer.start()
+    received = susd_shell.makefile('r', encoding='utf-8')
+    if received.readline() != 'OK\n':
+        print('SUS>  error on accepting messages.')
+        susd_shell.close()
+        return
+    accepted = failed = 0
+    for index, status in enumerate(received):
+        if status.strip() == '200':
+            accepted += 1
+        else:
+            failed += 1
+            print('error>  line {}: status {}.'.format(line_numbers[index], status.strip()))
+    streamer.join()
+    susd_shell.close()
+    if failed == 0:
+        print('SUS>  ✓ ({} messages)'.format(accepted))
+    else:
+        print('error>  {} of {} messages not accepted.'.format(failed, accepted + failed))
+
+
+def reply(message):
+    response = shell_command('reply', message)
+    if response is None:
+        return
+    status, _ = response
+    if status == '200':
+        print('SUS>  ✓')
+    elif status == '400':
+        print('error>  no message to reply to.')
+    elif status == '503':
+        print('error>  SUS is overloaded, try again later.')
+    else:
+        print('SUS>  error on accepting message.')
+
+
+def history(peer=None, since=None, count=50):
+    """ Prints the messages exchanged with `peer`, read straight from the message store.
+
+    `peer` may be a nickname or host name, as for send; peers with a
+    nickname are shown by it.
+    """
+    import itertools
+    import time
+    import peers
+    import store
+    directory = peers.PeerDirectory(os.path.join(SUS_DIR, 'peers.json'))
+    try:
+        if peer is not None:
+            ip = directory.resolve(peer)
+            if ip is None:
+                print('error>  unknown peer: {}.'.format(peer))
+                return
+            peer = ip
+        # the user's nicknames take precedence over learned ones
+        nicknames = {ip: nickname for nickname, ip in
+                     itertools.chain(directory.learned.items(), directory.names.items())}
+    finally:
+        directory.close()
+    messages = store.MessageStore(os.path.join(SUS_DIR, 'messages'))
+    for stored in messages.history(peer, since, count):
+        when = time.strftime('%Y-%m-%d %H:%M', time.localtime(stored.timestamp))
+        name = nicknames.get(stored.peer, stored.peer)
+        if stored.direction == store.INCOMING:
+            print('{}  {}: {}'.format(when, name, stored.message))
+        else:
+            print('{}  > {}: {}'.format(when, name, stored.message))
+
+
+def stats():
+    response = shell_command('stats')
+    if response is None:
+        return
+    status, body = response
+    if status == '200':
+        print(body.rstrip('\n'))
+    else:
+        print('error>  could not read the statistics.')
+
+
+def broadcast(message):
+    response = shell_command('broadcast', message)
+    if response is None:
+        return
+    if response[0] == '200':
+        print('SUS>  ✓ (multicast, unacknowledged)')
+    else:
+        print('SUS>  error on broadcasting message.')
+
+
+def group(name=None, members=None, delete=False):
+    if name is not None:
+        name = name.lstrip('@')
+    if delete:
+        response = shell_command('ungroup', name)
+    elif members:
+        response = shell_command('group', name, ','.join(members))
+    elif name:
+        response = shell_command('group', name)
+    else:
+        response = shell_command('group')
+    if response is None:
+        return
+    status, body = response
+    if status == '200':
+        print(body.rstrip('\n') if body else 'SUS>  ✓')
+    elif status == '404':
+        print('error>  no such group.')
+    else:
+        print('error>  invalid group.')
+
+
+def peer(name=None, address=None, delete=False):
+    if delete:
+        response = shell_command('unpeer', name)
+    elif address:
+        response = shell_command('peer', name, address)
+    elif name:
+        response = shell_command('peer', name)
+    else:
+        response = shell_command('peer')
+    if response is None:
+        return
+    status, body = response
+    if status == '200':
+        print(body.rstrip('\n') if body else 'SUS>  ✓')
+    elif status == '404':
+        print('error>  no such peer.')
+    else:
+        print('error>  invalid nickname.')
+
+
+def silence(peer=None, duration=None, undo=False):
+    if undo:
+        response = shell_command('unsilence', peer)
+    elif peer and duration:
+        response = shell_command('silence', peer, duration)
+    elif peer:
+        response = shell_command('silence', peer)
+    else:
+        response = shell_command('silence')
+    if response is None:
+        return
+    status, body = response
+    if status == '200' and peer and not undo:
+        print('SUS>  silenced {}.'.format(body.strip()))
+    elif status == '200':
+        print(body.rstrip('\n') if body else 'SUS>  ✓')
+    elif status == '404':
+        print('error>  {} isn\'t silenced.'.format(peer) if undo else 'error>  no such peer.')
+    else:
+        print('error>  invalid duration.')
+
+
+def interactive(lines):
+    """ Chats over one subscription to the daemon, until `lines` (e.g. stdin) run out.
+
+    Incoming messages are printed as they arrive. Plain lines are sent to
+    the current peer: the one chosen with `/to PEER`, or else whoever sent
+    the last message. Lines starting with a slash are commands, as in
+    `/send PEER MESSAGE`, `/group` or `/stats`; `/quit` leaves.
+    """
+    import json
+    import threading
+    susd_shell = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        susd_shell.connect(('', SUSD_SHELL_PORT))
+    except socket.error:
+        print('error>  SUS isn\'t running.')
+        return
+    susd_shell.sendall(b'subscribe\n')
+    received = susd_shell.makefile('r', encoding='utf-8')
+    if received.readline() != 'OK\n':
+        print('error>  SUS is overloaded, try again later.')
+        susd_shell.close()
+        return
+    state = {'peer': None, 'last_sender': None}
+
+    def receive():
+        try:
+            for line in received:
+                event = json.loads(line)
+                if 'sender' in event:
+                    state['last_sender'] = event['sender']
+                    print('SUS> {}: {}'.format(event['sender'], event['message']))
+                elif event['status'] != '200':
+                    print('error>  {} {}'.format(event['status'],
+                                                 event['body'].strip()).rstrip())
+                elif event['body'].strip():
+                    print(event['body'].rstrip('\n'))
+        except (socket.error, ValueError):
+            pass  # reset, e.g. by leaving while a response was on its way
+        print('SUS>  disconnected.')
+
+    receiver = threading.Thread(target=receive, name='Receive', daemon=True)
+    receiver.start()
+    print('SUS>  interactive mode: /to PEER picks who to talk to, /quit leaves.')
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line == '/quit':
+            break
+        if line.startswith('/to '):
+            state['peer'] = line[4:].strip()
+            continue
+        if line.startswith('/'):
+            command = line[1:]
+        else:
+            peer = state['peer'] or state['last_sender']
+            if peer is None:
+                print('error>  nobody to talk to yet: /to PEER first.')
+                continue
+            command = 'send {} {}'.format(peer, line)
+        try:
+            susd_shell.sendall(command.encode('utf-8') + b'\n')
+        except socket.error:
+            break
+    try:
+        susd_shell.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    susd_shell.close()
@@ -0,0 +1,448 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Length-prefixed framing for the messages protocol.
+
+Every frame starts with a 16 bytes header:
+
+    magic (0xFF) | version | type | flags | payload length (u32) | message id (u64)
+
+0xFF never appears in UTF-8, so a connection whose first byte isn't MAGIC
+comes from a legacy peer sending ##END-terminated text.
+
+The low bits of the flags of MESSAGE and BATCH frames tell which codec
+compressed the payload (0 for none). ACK frames advertise in their flags
+the codecs the receiver can decode, one bit per codec: senders only
+compress for peers that advertised the codec, so older peers, which
+leave the flags at 0, keep getting plain payloads.
+
+The message id of a MESSAGE frame identifies the message itself, and is
+the same on every attempt to deliver it. Entries of BATCH frames flagged
+MESSAGE_IDS are prefixed by their message's id too; senders only flag
+batches for peers whose acks carry MESSAGE_IDS.
+
+RELAY, FORWARD and SYNC frames are only exchanged with relays (see
+relay): a RELAY frame asks a relay to hold a message for its recipient,
+a FORWARD frame hands the held messages over, and SYNC frames carry the
+JSON requests and responses with which relays reconcile their mailboxes.
+
+A STARTTLS frame, sent first on a connection, asks the receiver to switch
+it to TLS (see tls) once it acknowledged the frame.
+"""
+
+
+import codecs
+import collections
+import struct
+import zlib
+
+
+MAGIC = 0xFF
+VERSION = 1
+HEADER = struct.Struct('!BBBBIQ')
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+# frame types
+MESSAGE = 1
+ACK = 2
+BATCH = 3  # several messages, each prefixed by its u32 length
+RELAY = 4  # "recipient\nmessage", for a relay to hold
+FORWARD = 5  # held messages, as a MESSAGE_IDS batch of "sender\nmessage" entries
+SYNC = 6  # JSON, between relays
+STARTTLS = 7  # empty: what follows its ack is a TLS handshake
+
+BATCH_LENGTH = struct.Struct('!I')
+BATCH_ENTRY = struct.Struct('!QI')  # message id, length
+
+MESSAGE_IDS = 0x10  # flag of BATCH frames (and acks, see above)
+
+
+Frame = collections.namedtuple('Frame', ['type', 'flags', 'message_id', 'payload'])
+
+
+class FrameError(ValueError):
+    """ The peer sent something that isn't a valid frame. """
+
+
+CODEC_MASK = 0x0F
+
+
+class Codec:
+    """ A compression algorithm, identified in frame flags by `id` (1 to 4).
+
+    Subclasses implement compress, and decompress, which must refuse to
+    produce more than `max_size` bytes: a small frame could otherwise
+    expand into gigabytes.
+    """
+    id = None
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data, max_size=MAX_PAYLOAD):
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    id = 1
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_size=MAX_PAYLOAD):
+        decompressor = zlib.decompressobj()
+        try:
+            result = decompressor.decompress(data, max_size)
+        except zlib.error as exc:
+            raise FrameError('corrupt zlib payload: {}'.format(exc))
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise FrameError('zlib payload larger than {} bytes or truncated'.format(max_size))
+        return result
+
+
+class LzmaCodec(Codec):
+    id = 2
+    name = 'lzma'
+
+    def __init__(self, preset=1):
+        import lzma  # Python may be built without it
+        self.lzma = lzma
+        self.preset = preset
+
+    def compress(self, data):
+        return self.lzma.compress(data, format=self.lzma.FORMAT_XZ, preset=self.preset)
+
+    def decompress(self, data, max_size=MAX_PAYLOAD):
+        decompressor = self.lzma.LZMADecompressor()
+        try:
+            result = decompressor.decompress(data, max_size)
+        except self.lzma.LZMAError as exc:
+            raise FrameError('corrupt lzma payload: {}'.format(exc))
+        if not decompressor.eof:
+            raise FrameError('lzma payload larger than {} bytes or truncated'.format(max_size))
+        return result
+
+
+class ZstdCodec(Codec):
+    """ Needs the zstandard package. """
+    id = 3
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        import zstandard
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.error = zstandard.ZstdError
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data, max_size=MAX_PAYLOAD):
+        try:
+            return self.decompressor.decompress(data, max_output_size=max_size)
+        except self.error as exc:
+            raise FrameError('corrupt or too large zstd payload: {}'.format(exc))
+
+
+CODECS = {}  # id -> Codec, for every codec this process can decode
+
+
+def register_codec(codec):
+    if not 1 <= codec.id <= 4:
+        raise ValueError('codec ids go from 1 to 4')
+    CODECS[codec.id] = codec
+
+
+register_codec(ZlibCodec())
+try:
+    register_codec(LzmaCodec())
+except ImportError:
+    pass  # Python was built without lzma
+try:
+    register_codec(ZstdCodec())
+except ImportError:
+    pass  # zstandard isn't installed
+
+
+def codec_named(name):
+    for codec in CODECS.values():
+        if codec.name == name:
+            return codec
+    raise KeyError(name)
+
+
+def codecs_mask(codecs=None):
+    """ ACK flags advertising `codecs` (default: all the registered ones). """
+    ids = CODECS if codecs is None else [c.id for c in codecs]
+    mask = 0
+    for id in ids:
+        mask |= 1 << (id - 1)
+    return mask
+
+
+def accepts(mask, codec):
+    """ True if ACK flags `mask` advertise `codec`. """
+    return bool(mask & (1 << (codec.id - 1)))
+
+
+def compress(payload, codec, threshold):
+    """ Returns (payload, flags): compressed by `codec` if at least `threshold`
+    bytes long and if compressing makes it smaller.
+    """
+    if codec is None or len(payload) < threshold:
+        return payload, 0
+    compressed = codec.compress(payload)
+    if len(compressed) >= len(payload):
+        return payload, 0
+    return compressed, codec.id
+
+
+def decoded_payload(frame):
+    """ The payload of a MESSAGE or BATCH frame, decompressed if need be. """
+    id = frame.flags & CODEC_MASK
+    if id == 0:
+        return frame.payload
+    codec = CODECS.get(id)
+    if codec is None:
+        raise FrameError('unknown codec {}'.format(id))
+    return codec.decompress(bytes(frame.payload))
+
+
+def text(payload):
+    """ Decodes a message from a payload, which must be valid UTF-8. """
+    try:
+        return str(payload, 'utf-8')
+    except UnicodeDecodeError as exc:
+        raise FrameError('message is not valid UTF-8: {}'.format(exc))
+
+
+def pack(type, payload, message_id=0, flags=0):
+    return b''.join([HEADER.pack(MAGIC, VERSION, type, flags, len(payload), message_id), payload])
+
+
+def pack_batch(messages, message_id=0, flags=0, ids=None):
+    """ Packs several encoded messages in one BATCH frame. """
+    if ids is not None:
+        flags |= MESSAGE_IDS
+    return pack(BATCH, batch_payload(messages, ids), message_id, flags)
+
+
+def batch_payload(messages, ids=None):
+    """ The payload of a BATCH frame; with `ids`, of a BATCH frame flagged MESSAGE_IDS. """
+    parts = []
+    if ids is None:
+        for message in messages:
+            parts.append(BATCH_LENGTH.pack(len(message)))
+            parts.append(message)
+    else:
+        for message_id, message in zip(ids, messages):
+            parts.append(BATCH_ENTRY.pack(message_id, len(message)))
+            parts.append(message)
+    return b''.join(parts)
+
+
+def unpack_batch(payload, with_ids=False):
+    """ Yields the messages in the payload of a BATCH frame, as memoryviews.
+
+    With `with_ids`, yields (message id, message) pairs from a BATCH frame
+    flagged MESSAGE_IDS instead.
+    """
+    payload = memoryview(payload)
+    entry = BATCH_ENTRY if with_ids else BATCH_LENGTH
+    offset = 0
+    while offset < len(payload):
+        if offset + entry.size > len(payload):
+            raise FrameError('truncated batch')
+        fields = entry.unpack_from(payload, offset)
+        length = fields[-1]
+        offset += entry.size
+        if offset + length > len(payload):
+            raise FrameError('truncated batch')
+        if with_ids:
+            yield fields[0], payload[offset:offset + length]
+        else:
+            yield payload[offset:offset + length]
+        offset += length
+
+
+def recv_frame(conn):
+    """ Reads exactly one frame from a blocking socket. """
+    header = bytearray(HEADER.size)
+    recv_exactly(conn, memoryview(header))
+    magic, version, type, flags, length, message_id = HEADER.unpack(header)
+    check_header(magic, version, length)
+    payload = bytearray(length)
+    recv_exactly(conn, memoryview(payload))
+    return Frame(type, flags, message_id, payload)
+
+
+def recv_exactly(conn, view):
+    while len(view) > 0:
+        received = conn.recv_into(view)
+        if received == 0:
+            raise ConnectionResetError('connection closed in the middle of a frame')
+        view = view[received:]
+
+
+def check_header(magic, version, length):
+    if magic != MAGIC:
+        raise FrameError('bad magic byte {:#x}'.format(magic))
+    if version != VERSION:
+        raise FrameError('unsupported protocol version {}'.format(version))
+    if length > MAX_PAYLOAD:
+        raise FrameError('frame of {} bytes is too large'.format(length))
+
+
+class FrameReader:
+    """ Reassembles the frames received on a connection.
+
+    Data is received straight into one preallocated bytearray (see
+    recv_from), which is only grown as a frame that doesn't fit arrives.
+    Payloads yielded by frames() are memoryviews into that buffer: they're
+    only valid until the next call to recv_from or feed.
+    """
+    def __init__(self, buffer_size=16384):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not parsed yet
+        self.end = 0    # end of received data
+        self.legacy = None  # decided on the first byte received
+        self.legacy_reader = None
+        self.start_tls = False  # set when the peer asked to switch to TLS
+
+    def recv_from(self, conn):
+        """ Receives from a blocking socket. Returns the bytes received, 0 on EOF. """
+        self.make_room()
+        received = conn.recv_into(self.view[self.end:])
+        self.received(received)
+        return received
+
+    def feed(self, data):
+        """ Appends `data`, e.g. as read from an asyncio StreamReader. """
+        self.make_room(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.received(len(data))
+
+    def received(self, size):
+        if self.legacy is None and size > 0:
+            self.legacy = self.buffer[self.start] != MAGIC
+            if self.legacy:
+                self.legacy_reader = LegacyReader()
+        self.end += size
+
+    def make_room(self, size=1):
+        """ Makes sure at least `size` bytes can be received after self.end.
+
+        The buffer grows with the data of a frame that doesn't fit, doubling
+        up to the length in its header: a header alone doesn't get the
+        memory it claims.
+        """
+        held = self.end - self.start
+        needed = held + size
+        frame_size = None  # of the partial frame, if its header was received
+        if self.legacy is False and held >= HEADER.size:
+            length = HEADER.unpack_from(self.buffer, self.start)[4]
+            frame_size = HEADER.size + min(length, MAX_PAYLOAD)
+        # move a partial frame to the front if it won't fit where it is
+        fits = self.start == 0 or self.start + max(needed, frame_size or 0) <= len(self.buffer)
+        if self.end + size <= len(self.buffer) and fits:
+            return
+        if needed > len(self.buffer):
+            grown = 2 * len(self.buffer)
+            if frame_size is not None:
+                grown = min(grown, frame_size)
+            buffer = bytearray(max(needed, grown))
+            buffer[:held] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer[:held] = self.buffer[self.start:self.end]
+        self.end = held
+        self.start = 0
+
+    def frames(self):
+        """ Yields every complete Frame received so far. """
+        while self.end - self.start >= HEADER.size:
+            magic, version, type, flags, length, message_id = \
+                HEADER.unpack_from(self.buffer, self.start)
+            check_header(magic, version, length)
+            payload_start = self.start + HEADER.size
+            if self.end - payload_start < length:
+                return
+            self.start = payload_start + length
+            yield Frame(type, flags, message_id, self.view[payload_start:self.start])
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def legacy_messages(self):
+        """ Returns the ##END-terminated messages completed by the data received so far. """
+        messages = self.legacy_reader.feed(self.view[self.start:self.end])
+        self.start = self.end = 0
+        return messages
+
+    def idle(self):
+        """ True if no partial frame or message has been received. """
+        if self.legacy:
+            return self.start == self.end and self.legacy_reader.idle()
+        return self.start == self.end
+
+
+class LegacyReader:
+    """ Splits a legacy ##END-terminated stream into messages in linear time.
+
+    Bytes are decoded incrementally, so that multibyte characters split
+    across two recv calls are handled.
+    """
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.chunks = []
+        self.carry = ''  # last characters seen, in case ##END spans two chunks
+
+    def feed(self, data):
+        messages = []
+        text = self.decoder.decode(data)
+        while text:
+            end = ''.join([self.carry, text]).find('##END')
+            if end < 0:
+                self.chunks.append(text)
+                self.carry = ''.join([self.carry, text])[-4:]
+                break
+            cut = end - len(self.carry)  # negative if ##END started in a previous chunk
+            message = ''.join(self.chunks + [text[:max(cut, 0)]])
+            if cut < 0:
+                message = message[:cut]
+            messages.append(message)
+            self.chunks = []
+            self.carry = ''
+            text = text[cut + len('##END'):]
+        return messages
+
+    def rest(self):
+        """ Returns what was received after the last ##END, e.g. on EOF. """
+        message = ''.join(self.chunks + [self.decoder.decode(b'', final=True)])
+        self.chunks = []
+        self.carry = ''
+        return message
+
+    def idle(self):
+        return not ''.join(self.chunks).strip()
@@ -18,11 +18,9 @@
 
 import sys
 import argparse
-import logging
-import logging.config
 
 
-logging.config.dictConfig({
+LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
@@ -35,21 +33,166 @@ logging.config.dictConfig({
             'class': 'logging.handlers.RotatingFileHandler',
             'formatter': 'default',
             'filename': '/tmp/SUS.log',
-            'maxBytes': 10000,
-            'backupCount': 1
+            'maxBytes': 1024 * 1024,
+            'backupCount': 3
         }
     },
     'loggers': {
         '': {
             'handlers': ['file'],
-            'level': 'DEBUG',
+            'level': 'INFO',
             'propagate': True
         }
     }
-})
+}
 
 
-logger = logging.getLogger('main')
+def setup_logging(level=None, max_bytes=None, backups=None):
+    """ Configures logging. Only service commands log: client commands skip
+    importing and configuring logging altogether, to start faster.
+
+    Arguments left to None keep the values in LOGGING.
+    """
+    import logging.config
+    if level is not None:
+        LOGGING['loggers']['']['level'] = level.upper()
+    if max_bytes is not None:
+        LOGGING['handlers']['file']['maxBytes'] = max_bytes
+    if backups is not None:
+        LOGGING['handlers']['file']['backupCount'] = backups
+    logging.config.dictConfig(LOGGING)
+    logging.getLogger('main').info('SUS started. Args: %s', sys.argv)
+
+
+def start_arguments():
+    """ The options of `SUS start`, which are the arguments SUSd.run takes. """
+    args = argparse.ArgumentParser(prog='SUS start')
+    args.add_argument('-n', '--non-daemon', help='start SUS in non-daemon mode.',
+                      action='store_true')
+    args.add_argument('-i', '--ip', help='ip for SUS services.', default='',
+                      action='store')
+    args.add_argument('-a', '--async-io', help='serve inbox and shell from one asyncio event loop.',
+                      action='store_true')
+    args.add_argument('--inbox-workers', help='extra processes receiving messages, sharing the '
+                                              'messages port with SO_REUSEPORT (0 receives in '
+                                              'the daemon process only).',
+                      type=int, default=0)
+    args.add_argument('-w', '--senders', help='number of threads sending messages.',
+                      type=int, default=4)
+    args.add_argument('--max-attempts', help='delivery attempts before giving up on a message.',
+                      type=int, default=8)
+    args.add_argument('--keep-alive', help='seconds to keep idle peer connections open (0 disables).',
+                      type=float, default=30)
+    args.add_argument('--max-peer-connections', help='connections open at once to the same peer.',
+                      type=int, default=2)
+    args.add_argument('--connect-timeout', help='longest wait, in seconds, for a connection to '
+                                                'a peer; peers that answered before get a '
+                                                'timeout based on their round trip time.',
+                      type=float, default=10)
+    args.add_argument('--peer-failures', help='consecutive failures after which a peer is '
+                                              'considered unreachable until a probe gets through.',
+                      type=int, default=3)
+    args.add_argument('--probe-interval', help='seconds between probes of an unreachable peer, '
+                                               'doubling up to a minute.',
+                      type=float, default=5)
+    args.add_argument('--resolve-ttl', help='seconds for which the IP of a host name is used '
+                                            'before resolving it again, in the background.',
+                      type=float, default=300)
+    args.add_argument('--tls', help='switch connections with peers to TLS, for the peers that '
+                                    'support it; receiving over TLS needs --tls-cert.',
+                      action='store_true')
+    args.add_argument('--tls-cert', help='certificate presented to peers (default: tls.crt in '
+                                         'the SUS directory).')
+    args.add_argument('--tls-key', help='private key of --tls-cert (default: tls.key in the SUS '
+                                        'directory).')
+    args.add_argument('--tls-ca', help="trusted certificates, to verify peers' certificates "
+                                       "(by default they aren't verified).")
+    args.add_argument('--relays', help='comma-separated peers that may hold messages for '
+                                       'unreachable recipients, and forward the ones held '
+                                       'for us (see --relay).',
+                      default='')
+    args.add_argument('--relay', help='hold messages for unreachable peers, encrypted on disk, '
+                                      'until they reconnect (needs the cryptography package).',
+                      action='store_true')
+    args.add_argument('--relay-siblings', help='comma-separated relays with which to reconcile '
+                                               'held messages.',
+                      default='')
+    args.add_argument('--relay-capacity', help='most messages held as a relay.',
+                      type=int, default=10000)
+    args.add_argument('--relay-retention', help='days after which held messages are dropped.',
+                      type=float, default=7)
+    args.add_argument('--relay-sync-interval', help='seconds between reconciliations with '
+                                                    'sibling relays.',
+                      type=float, default=60)
+    args.add_argument('--coalesce-ms', help='milliseconds to wait for more messages to the same peer '
+                                            'before sending them in one batch.',
+                      type=float, default=2)
+    args.add_argument('--compress', help='codec compressing large messages, for peers '
+                                         'that can decode it (zstd needs the zstandard package).',
+                      choices=['none', 'zlib', 'lzma', 'zstd'], default='zlib')
+    args.add_argument('--compress-threshold', help='smallest message (or batch), in bytes, '
+                                                   'worth compressing.',
+                      type=int, default=1024)
+    args.add_argument('--dedup-window', help='seconds during which a message received again, '
+                                             'because its ack was lost, is recognized and dropped '
+                                             '(0 disables).',
+                      type=float, default=600)
+    args.add_argument('--dedup-capacity', help='most message ids remembered to recognize '
+                                               'duplicates (0 disables).',
+                      type=int, default=100000)
+    args.add_argument('-m', '--multicast', help='receive messages sent with `SUS broadcast`.',
+                      action='store_true')
+    args.add_argument('--no-history', help="don't keep sent and received messages on disk.",
+                      action='store_true')
+    args.add_argument('--spool-sync-ms', help='milliseconds between fsyncs of the outbox spool: '
+                                              '0 syncs as soon as possible, more saves fsyncs '
+                                              'at the cost of latency.',
+                      type=float, default=0)
+    args.add_argument('--incoming-capacity', help='received messages held before applying '
+                                                  '--incoming-policy (0 for no limit).',
+                      type=int, default=10000)
+    args.add_argument('--incoming-policy', help='what to do with messages received while the '
+                                                'queue is full: block the sender, reject them '
+                                                'or drop the oldest queued message.',
+                      choices=['block', 'reject', 'drop-oldest'], default='block')
+    args.add_argument('--outgoing-capacity', help='messages waiting to be sent before applying '
+                                                  '--outgoing-policy (0 for no limit).',
+                      type=int, default=100000)
+    args.add_argument('--outgoing-policy', help='what to do with messages sent while the queue '
+                                                'is full.',
+                      choices=['block', 'reject', 'drop-oldest'], default='block')
+    args.add_argument('--backlog', help='connections waiting to be accepted by the inbox and '
+                                        'the shell.',
+                      type=int, default=128)
+    args.add_argument('--max-connections', help='connections served at once by the inbox (and, '
+                                                'separately, by the shell).',
+                      type=int, default=256)
+    args.add_argument('--max-connections-per-ip', help='inbox connections served at once from '
+                                                       'the same IP (0 for no limit).',
+                      type=int, default=16)
+    args.add_argument('--inbox-rate', help='messages per second accepted from each IP '
+                                           '(0 for no limit).',
+                      type=float, default=0)
+    args.add_argument('--inbox-burst', help='messages an IP may send at once before '
+                                            '--inbox-rate kicks in (default: one second worth).',
+                      type=int, default=0)
+    args.add_argument('--log-level', help='least severe messages logged: debug logs every '
+                                          'message and connection.',
+                      choices=['debug', 'info', 'warning', 'error'], default='info')
+    args.add_argument('--log-max-bytes', help='size at which the log file is rotated.',
+                      type=int, default=1024 * 1024)
+    args.add_argument('--log-backups', help='rotated log files to keep.',
+                      type=int, default=3)
+    args.add_argument('--log-queue-size', help='log records waiting to be written before '
+                                               'new ones are dropped.',
+                      type=int, default=10000)
+    args.add_argument('--log-metadata-only', help="log senders, recipients and sizes, "
+                                                  "but not the messages themselves.",
+                      action='store_true')
+    args.add_argument('--metrics-port', help='serve metrics for Prometheus at '
+                                             'http://127.0.0.1:<port>/ (0 disables).',
+                      type=int, default=0)
+    return args
 
 
 class SUS:
@@ -63,6 +206,11 @@ Common commands:
    send        Send a message
    reply       Reply to the last message received
    silence     Silence a conversation
+   history     Show past messages
+   broadcast   Send a message to everybody on the LAN
+   group       Manage groups of recipients
+   peer        Manage nicknames of peers
+   stats       Show how the daemon is doing
 
 Service commands:
    start       Start SUS    :)
@@ -70,7 +218,6 @@ Service commands:
 
 Type `SUS <command> --help` for information about specific commands.
 ''')
-        logger.info('SUS started. Args: {}'.format(sys.argv))
         if len(sys.argv) == 1:
             self.interactive_mode()
             return
@@ -84,13 +231,10 @@ Type `SUS <command> --help` for information about specific commands.
             getattr(self, args.command)()
 
     def start(self):
+        args = start_arguments().parse_args(sys.argv[2:])
+        setup_logging(args.log_level, args.log_max_bytes, args.log_backups)
+        import logging
         import SUSd
-        args = argparse.ArgumentParser(prog='SUS start')
-        args.add_argument('-n', '--non-daemon', help='start SUS in non-daemon mode.',
-                          action='store_true')
-        args.add_argument('-i', '--ip', help='ip for SUS services.', default='',
-                          action='store')
-        args = args.parse_args(sys.argv[2:])
         if args.non_daemon:
             logging.root.handlers.append(
                 logging.StreamHandler()
@@ -98,6 +242,7 @@ Type `SUS <command> --help` for information about specific commands.
         SUSd.start(args)
 
     def shutdown(self):
+        setup_logging()
         import SUSd
         args = argparse.ArgumentParser(prog='SUS shutdown')
         args.add_argument('-k', '--kill', help='send SIGKILL instead of SIGTERM.',
@@ -106,24 +251,108 @@ Type `SUS <command> --help` for information about specific commands.
         SUSd.shutdown(args)
 
     def send(self):
-        import SUSd
+        import client
         args = argparse.ArgumentParser(prog='SUS send')
-        args.add_argument('recipient', help='IP to which send the message.')
-        args.add_argument('message', nargs='+', help='message to send.')
+        args.add_argument('recipient', nargs='?',
+                          help='peer (nickname, host name or IP) to which send the message; '
+                               'several comma-separated peers or @group to send it to a group.')
+        args.add_argument('message', nargs='*', help='message to send.')
+        args.add_argument('--stdin', help='send every `recipient<TAB>message` line read from stdin '
+                                          '(lines without a tab go to `recipient`).',
+                          action='store_true')
         args = args.parse_args(sys.argv[2:])
+        if args.stdin:
+            client.send_stream(sys.stdin, args.recipient)
+            return
+        if args.recipient is None or not args.message:
+            print('error>  a recipient and a message are required.')
+            sys.exit(2)
         args.message = ' '.join(args.message).lstrip()
-        SUSd.send(args.recipient, args.message)
+        client.send(args.recipient, args.message)
 
     def reply(self):
-        import SUSd
+        import client
         args = argparse.ArgumentParser(prog='SUS reply')
         args.add_argument('message', nargs='+', help='message to send.')
         args = args.parse_args(sys.argv[2:])
         args.message = ' '.join(args.message).lstrip()
-        SUSd.reply(args.message)
+        client.reply(args.message)
+
+    def history(self):
+        import client
+        import store
+        args = argparse.ArgumentParser(prog='SUS history')
+        args.add_argument('peer', nargs='?', help='only show messages exchanged with this peer '
+                                                  '(nickname, host name or IP).')
+        args.add_argument('-s', '--since', help='only show messages since then: a date '
+                                                '(2017-04-14 13:30) or a time ago (30m, 2h, 7d).')
+        args.add_argument('-n', '--count', help='show at most this many messages.',
+                          type=int, default=50)
+        args = args.parse_args(sys.argv[2:])
+        since = None
+        if args.since is not None:
+            try:
+                since = store.parse_since(args.since)
+            except ValueError:
+                print('error>  invalid time: {}.'.format(args.since))
+                return
+        client.history(args.peer, since, args.count)
+
+    def broadcast(self):
+        import client
+        args = argparse.ArgumentParser(prog='SUS broadcast')
+        args.add_argument('message', nargs='+', help='message to send to the LAN multicast group.')
+        args = args.parse_args(sys.argv[2:])
+        args.message = ' '.join(args.message).lstrip()
+        client.broadcast(args.message)
+
+    def group(self):
+        import client
+        parser = argparse.ArgumentParser(prog='SUS group')
+        parser.add_argument('name', nargs='?',
+                            help='group to show or define; all groups if omitted.')
+        parser.add_argument('members', nargs='*', help='peers (or @groups) making up the group.')
+        parser.add_argument('-d', '--delete', help='delete the group.', action='store_true')
+        args = parser.parse_args(sys.argv[2:])
+        if args.delete and args.name is None:
+            parser.error('a group name is required to delete it.')
+        client.group(args.name, args.members, args.delete)
+
+    def peer(self):
+        import client
+        parser = argparse.ArgumentParser(prog='SUS peer')
+        parser.add_argument('name', nargs='?',
+                            help='nickname to show or define; all peers if omitted.')
+        parser.add_argument('address', nargs='?', help='IP or host name of the peer.')
+        parser.add_argument('-d', '--delete', help='forget the nickname.', action='store_true')
+        args = parser.parse_args(sys.argv[2:])
+        if args.delete and args.name is None:
+            parser.error('a nickname is required to forget it.')
+        client.peer(args.name, args.address, args.delete)
+
+    def silence(self):
+        import client
+        parser = argparse.ArgumentParser(prog='SUS silence')
+        parser.add_argument('peer', nargs='?',
+                            help='peer (nickname, host name or IP) or CIDR range to silence; '
+                                 'all silenced senders if omitted.')
+        parser.add_argument('-f', '--for', help='only silence it for this long (30m, 2h, 7d).',
+                            dest='duration')
+        parser.add_argument('-u', '--undo', help='let it speak again.', action='store_true')
+        args = parser.parse_args(sys.argv[2:])
+        if args.undo and args.peer is None:
+            parser.error('a peer is required to let it speak again.')
+        client.silence(args.peer, args.duration, args.undo)
+
+    def stats(self):
+        import client
+        args = argparse.ArgumentParser(prog='SUS stats')
+        args.parse_args(sys.argv[2:])
+        client.stats()
 
     def interactive_mode(self):
-        print('interactive mode')
+        import client
+        client.interactive(sys.stdin)
 
 
 if __name__ == '__main__':
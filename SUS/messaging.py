@@ -16,143 +16,1718 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
 import socket
+import ssl
 import threading
 import collections
+import concurrent.futures
+import functools
+import itertools
+import heapq
+import ipaddress
+import json
+import os
+import random
+import struct
+import time
 import logging
+import frames
+import metrics
+import store
+import tls
 
 
 logger = logging.getLogger('messaging')
+log_bodies = True  # False logs who sent what and how long it was, but not the messages
 
+received_total = metrics.registry.counter('sus_messages_received_total', 'Messages received.')
+sent_total = metrics.registry.counter('sus_messages_sent_total', 'Messages delivered to peers.')
+failed_total = metrics.registry.counter('sus_messages_failed_total',
+                                        'Messages given up on after too many attempts.')
+retries_total = metrics.registry.counter('sus_send_retries_total', 'Failed delivery attempts.')
+throttled_total = metrics.registry.counter('sus_inbox_throttled_total',
+                                            'Times reading from a peer was paused by rate limiting.')
+payload_bytes_total = metrics.registry.counter('sus_payload_bytes_total',
+                                               'Bytes of framed messages sent, before compression.')
+wire_bytes_total = metrics.registry.counter('sus_wire_bytes_total',
+                                            'Bytes of framed messages sent, after compression.')
+duplicates_total = metrics.registry.counter('sus_duplicates_total',
+                                            'Messages received again, after a lost ack.')
+silenced_total = metrics.registry.counter('sus_inbox_silenced_total',
+                                          'Connections from silenced senders, closed unread.')
+relayed_total = metrics.registry.counter('sus_messages_relayed_total',
+                                          'Messages to unreachable peers handed to a relay.')
+connections_total = metrics.registry.counter('sus_inbox_connections_total',
+                                             'Connections accepted by the inbox.')
+receive_latency = metrics.registry.histogram(
+    'sus_receive_seconds', 'From receiving a message (or accepting its connection) to queuing it.')
+queue_latency = metrics.registry.histogram(
+    'sus_outbox_seconds', 'From queuing a message to having it acknowledged by its recipient.')
+ack_latency = metrics.registry.histogram(
+    'sus_ack_seconds', 'From sending a frame to receiving its ack.')
 
-incoming_messages = collections.deque()
-outgoing_messages = collections.deque()
+
+# what MessageQueue.put does when the queue is full
+BLOCK = 'block'              # wait for room, for up to `timeout` seconds, then reject
+REJECT = 'reject'            # refuse the new message
+DROP_OLDEST = 'drop-oldest'  # make room by dropping the oldest message
+OVERLOAD_POLICIES = (BLOCK, REJECT, DROP_OLDEST)
+
+
+class MessageQueue:
+    """ A deque that wakes up blocked consumers when something is appended.
+
+    Consumers call drain, which sleeps until messages are available (or
+    `timeout` expires) and then takes them out in one batch.
+
+    Producers call put, which holds the queue to at most `capacity`
+    messages according to `policy` (one of OVERLOAD_POLICIES). Messages
+    dropped to make room are passed to `on_drop`, if set.
+    """
+    def __init__(self, capacity=None, policy=BLOCK, timeout=5, on_drop=None):
+        self.items = collections.deque()
+        lock = threading.Lock()
+        self.not_empty = threading.Condition(lock)
+        self.not_full = threading.Condition(lock)
+        self.capacity = capacity
+        self.policy = policy
+        self.timeout = timeout
+        self.on_drop = on_drop
+        self.rejected = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<{} of {} messages>'.format(self.__class__.__name__, len(self.items))
+
+    def append(self, message):
+        """ Appends `message` even if the queue is full. """
+        with self.not_empty:
+            self.items.append(message)
+            self.not_empty.notify()
+
+    def put(self, message, block=True):
+        """ Appends `message`, unless the queue is full and the policy rejects it.
+
+        Returns True if the message was queued. With block=False the BLOCK
+        policy rejects right away instead of waiting.
+        """
+        dropped = None
+        with self.not_empty:
+            if self.capacity is not None and len(self.items) >= self.capacity:
+                if self.policy == DROP_OLDEST:
+                    dropped = self.items.popleft()
+                    self.dropped += 1
+                elif self.policy == REJECT or not block or not self.not_full.wait_for(
+                        lambda: len(self.items) < self.capacity, self.timeout):
+                    self.rejected += 1
+                    return False
+            self.items.append(message)
+            self.not_empty.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+        return True
+
+    def full(self):
+        return self.capacity is not None and len(self.items) >= self.capacity
+
+    def wait_for_room(self, timeout=None):
+        """ Blocks until the queue isn't full. Returns False if `timeout` expires first. """
+        with self.not_full:
+            return self.not_full.wait_for(lambda: not self.full(), timeout)
+
+    def appendleft(self, message):
+        with self.not_empty:
+            self.items.appendleft(message)
+            self.not_empty.notify()
+
+    def popleft(self):
+        with self.not_empty:
+            message = self.items.popleft()
+            self.not_full.notify()
+            return message
+
+    def drain(self, max_items=64, timeout=None):
+        """ Blocks until at least one message is queued, then pops up to `max_items`.
+
+        Returns an empty list if `timeout` expires first.
+        """
+        with self.not_empty:
+            if not self.items:
+                self.not_empty.wait(timeout)
+            batch = []
+            while self.items and len(batch) < max_items:
+                batch.append(self.items.popleft())
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def wake(self):
+        """ Wakes every blocked consumer, e.g. so that it notices a stop event. """
+        with self.not_empty:
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+
+incoming_messages = MessageQueue()
+outgoing_messages = MessageQueue()
+outbox_spool = None  # a store.OutboxSpool making outgoing_messages survive restarts, if any
+
+
+Outgoing = collections.namedtuple('Outgoing', ['recipient', 'message', 'delivery', 'id', 'queued'])
+Outgoing.__new__.__defaults__ = (None,)  # messages replayed from the spool have no queuing time
+
+
+def new_message_id():
+    return random.getrandbits(64)
+
+
+def enqueue(recipient, message, delivery=None):
+    """ Queues `message` for sending, returning once it's safely spooled.
+
+    Returns False if outgoing_messages is full and its policy rejected it.
+    """
+    return all(enqueue_all([recipient], message, delivery))
+
+
+def enqueue_all(recipients, message, delivery=None):
+    """ Queues `message` for every recipient, waiting for a single spool commit. """
+    return enqueue_many([(r, message) for r in recipients], delivery)
+
+
+def enqueue_many(messages, delivery=None):
+    """ Queues every (recipient, message) pair, waiting for a single spool commit.
+
+    Returns whether each message was queued: see reject.
+    """
+    queued = time.monotonic()
+    outgoing = [Outgoing(r, m, delivery, new_message_id(), queued) for r, m in messages]
+    if outgoing_messages.full() and outgoing_messages.policy != DROP_OLDEST:
+        # shed the load before paying for the spool
+        if outgoing_messages.policy == REJECT or \
+                not outgoing_messages.wait_for_room(outgoing_messages.timeout):
+            for o in outgoing:
+                reject(o)
+            return [False] * len(outgoing)
+    if outbox_spool is not None and outgoing:
+        for o in outgoing:
+            record = outbox_spool.add(o.id, o.recipient, o.message, wait=False)
+        outbox_spool.wait(record)
+    accepted = []
+    for o in outgoing:
+        accepted.append(outgoing_messages.put(o))
+        if not accepted[-1]:
+            reject(o)
+    return accepted
+
+
+def reject(message):
+    """ Gives up on an outgoing message that didn't fit in outgoing_messages. """
+    logger.debug('outgoing queue full: gave up on message to <%s>.', message.recipient)
+    finish(message, 'failed')
 
 
 last_received_sender = None
 
 
 SUS_MESSAGES_PORT = 6666
+SUS_MULTICAST_GROUP = '239.255.66.66'
+KEEPALIVE_FLAG = 'keep-alive'
+OVERLOADED = 503  # status of messages (or connections) refused because the daemon is overloaded
+NOT_A_RELAY = 404  # status of messages asked to be held by a daemon that isn't a relay
+
+
+class DuplicateFilter:
+    """ Remembers the ids of the messages received in the last `window` seconds.
+
+    Senders retry a message whenever its ack is lost, even if we queued
+    it: add tells such retries apart by their id, in constant time.
+    The LRU, an OrderedDict of at most `capacity` ids, is what decides
+    whether an id was seen. A Bloom filter in front of it answers
+    for ids never seen, the common case, without looking them up: a false
+    positive only costs that lookup, never a message. The filter's
+    generations are cycled every `window` seconds so that it forgets old ids
+    (and keeps a low false positive rate) in constant memory.
+    """
+    def __init__(self, window=600, capacity=100000, bits=2 ** 21, hashes=4):
+        self.window = window
+        self.capacity = capacity
+        self.bits = bits
+        self.hashes = hashes
+        self.recent = collections.OrderedDict()  # id -> when it was received
+        self.current = bytearray(bits // 8)   # Bloom filter of the ids of this window
+        self.previous = bytearray(bits // 8)  # and of the previous one
+        self.rotated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def positions(self, message_id):
+        # ids are random, so their halves make two independent hashes
+        low, high = message_id & 0xFFFFFFFF, (message_id >> 32) | 1
+        return [(low + i * high) % self.bits for i in range(self.hashes)]
+
+    def maybe_seen(self, positions):
+        return all(self.current[p >> 3] & (1 << (p & 7)) for p in positions) or \
+            all(self.previous[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def add(self, message_id):
+        """ Records `message_id`. Returns False if it was already there: a duplicate. """
+        now = time.monotonic()
+        positions = self.positions(message_id)
+        with self.lock:
+            if now - self.rotated >= self.window:
+                self.previous, self.current = self.current, bytearray(self.bits // 8)
+                self.rotated = now
+            self.expire(now)
+            if self.maybe_seen(positions) and message_id in self.recent:
+                return False
+            for p in positions:
+                self.current[p >> 3] |= 1 << (p & 7)
+            self.recent[message_id] = now
+            return True
+
+    def discard(self, message_id):
+        """ Forgets `message_id`, e.g. because the message couldn't be queued after all. """
+        with self.lock:
+            self.recent.pop(message_id, None)
+
+    def expire(self, now):
+        while self.recent:
+            message_id, received = next(iter(self.recent.items()))
+            if len(self.recent) < self.capacity and now - received < self.window:
+                break
+            del self.recent[message_id]
+
+
+class RateLimiter:
+    """ Token buckets limiting how many messages each IP may send per second.
+
+    Every IP may send `burst` messages at once, then `rate` per second.
+    Messages are charged once received, possibly running the bucket into
+    debt: delay tells how long to stop reading from the IP until the debt
+    is paid back.
+    """
+    def __init__(self, rate, burst=None, max_buckets=10000):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.max_buckets = max_buckets
+        self.buckets = {}  # ip -> [tokens, last refill]
+        self.lock = threading.Lock()
+
+    def refill(self, ip, now):
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.prune(now)
+            bucket = self.buckets[ip] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def prune(self, now):
+        """ Forgets the buckets that have refilled completely. """
+        refill_time = self.burst / self.rate
+        for ip, (tokens, last) in list(self.buckets.items()):
+            if now - last >= refill_time:
+                del self.buckets[ip]
+
+    def charge(self, ip, messages=1):
+        with self.lock:
+            self.refill(ip, time.monotonic())[0] -= messages
+
+    def delay(self, ip):
+        """ Seconds to wait before reading more from `ip`. """
+        with self.lock:
+            tokens = self.refill(ip, time.monotonic())[0]
+        return 0 if tokens > 0 else (1 - tokens) / self.rate
+
+
+IPV4 = struct.Struct('!I')
+
+
+class SilenceList:
+    """ Senders whose connections are closed as soon as they're accepted.
+
+    Entries are IPs or CIDR ranges (e.g. 10.1.0.0/16), silenced forever or
+    until their expiry, a time.time() timestamp. Checking an IP costs a
+    dictionary lookup per prefix length in use, and no locking: edits
+    replace `networks` as a whole.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}   # IP or CIDR range -> expiry, or None
+        self.networks = {}  # prefix length -> {network, as an int: expiry, or None}
+        self.lock = threading.Lock()
+        self.load()
+
+    def __contains__(self, ip):
+        networks = self.networks
+        if not networks:
+            return False
+        try:
+            address, = IPV4.unpack(socket.inet_aton(ip))
+        except OSError:
+            return False
+        for length, silenced in networks.items():
+            mask = (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+            if address & mask in silenced:
+                expiry = silenced[address & mask]
+                if expiry is None or expiry > time.time():
+                    return True
+        return False
+
+    @staticmethod
+    def normalized(target):
+        """ '10.1.2.3/16' -> '10.1.0.0/16', '10.1.2.3/32' -> '10.1.2.3'. Raises ValueError. """
+        network = ipaddress.IPv4Network(target, strict=False)
+        if network.prefixlen == 32:
+            return str(network.network_address)
+        return str(network)
+
+    def add(self, target, expiry=None):
+        """ Silences an IP or CIDR range, until `expiry` if given. Returns the entry added. """
+        entry = self.normalized(target)
+        with self.lock:
+            self.entries[entry] = expiry
+            self.rebuild()
+        self.save()
+        return entry
+
+    def remove(self, target):
+        """ Lets an IP or CIDR range speak again. Returns False if it wasn't silenced. """
+        entry = self.normalized(target)
+        with self.lock:
+            if self.entries.pop(entry, False) is False:
+                return False
+            self.rebuild()
+        self.save()
+        return True
+
+    def items(self):
+        """ (entry, expiry) of every entry still in force, dropping the expired ones. """
+        now = time.time()
+        with self.lock:
+            expired = [entry for entry, expiry in self.entries.items()
+                       if expiry is not None and expiry <= now]
+            for entry in expired:
+                del self.entries[entry]
+            if expired:
+                self.rebuild()
+            items = sorted(self.entries.items())
+        if expired:
+            self.save()
+        return items
+
+    def rebuild(self):
+        networks = {}
+        for entry, expiry in self.entries.items():
+            network = ipaddress.IPv4Network(entry)
+            networks.setdefault(network.prefixlen, {})[int(network.network_address)] = expiry
+        self.networks = networks
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = {self.normalized(e): expiry for e, expiry in json.load(f).items()}
+            self.rebuild()
+        except (OSError, ValueError, AttributeError) as exc:
+            logger.info('could not load silenced senders from %s: %s.', self.path, exc)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            entries = dict(self.entries)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+
+
+class Admission:
+    """ Caps the connections served at once, overall and from each IP.
+
+    Servers ask admit before serving a connection, and release once done
+    with it. Connections that aren't admitted are closed with refuse,
+    before reading anything from them.
+    """
+    def __init__(self, max_connections=256, max_per_ip=None):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.active = collections.Counter()  # ip -> connections being served
+        self.total = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.total
+
+    def admit(self, ip):
+        with self.lock:
+            if self.total >= self.max_connections or \
+                    (self.max_per_ip is not None and self.active[ip] >= self.max_per_ip):
+                self.refused += 1
+                return False
+            self.active[ip] += 1
+            self.total += 1
+            return True
+
+    def release(self, ip):
+        with self.lock:
+            self.total -= 1
+            self.active[ip] -= 1
+            if self.active[ip] <= 0:
+                del self.active[ip]  # so that the counter doesn't grow with every IP ever seen
+
+
+def refuse(conn, refusal):
+    """ Sends `refusal` on a connection that wasn't admitted, and closes it. """
+    try:
+        conn.settimeout(0.5)
+        conn.sendall(refusal)
+        conn.shutdown(socket.SHUT_WR)
+    except socket.error:
+        pass
+    conn.close()
 
 
 class InboxServer:
-    def __init__(self, ip, inactivity_timeout=2, buffer_size=1024):
+    # refused connections get an ack saying that we're overloaded: framed senders
+    # don't expect it and retry, legacy senders find no "OK"
+    REFUSAL = frames.pack(frames.ACK, str(OVERLOADED).encode('utf-8'))
+
+    def __init__(self, ip, inactivity_timeout=2, keepalive_timeout=60, buffer_size=1024,
+                 history=None, limiter=None, backlog=128, admission=None, duplicates=None,
+                 silenced=None, reuse_port=False, relay=None, tls=None, relays=()):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            # let inbox worker processes share the port, see workers
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((ip, SUS_MESSAGES_PORT))
+        self.backlog = backlog
+        self.admission = admission if admission is not None else Admission()
         self.inactivity_timeout = inactivity_timeout
+        self.keepalive_timeout = keepalive_timeout  # idle time allowed between messages
         self.buffer_size = buffer_size
-        self.threads = []
+        self.history = history  # a store.MessageStore, if messages are to be kept
+        self.limiter = limiter  # a RateLimiter, if senders are to be throttled
+        self.duplicates = duplicates  # a DuplicateFilter, if retries are to be recognized
+        self.silenced = silenced  # a SilenceList, if some senders are to be ignored
+        self.relay = relay  # a relay.Relay, if we hold messages for other peers
+        self.relays = set(relays)  # IPs of the relays that may forward messages held for us
+        self.tls = tls  # an ssl.SSLContext, if peers may switch connections to TLS
+        self.threads = set()  # threads serving a connection; they remove themselves when done
+        self.threads_lock = threading.Lock()
         self.stop = threading.Event()
 
     def listen(self):
-        self.server.listen(5)
-        logger.info('inbox server listening at {}.'.format(self.server))
+        self.server.listen(self.backlog)
+        logger.info('inbox server listening at %s.', self.server)
         while not self.stop.is_set():
             client, address = self.server.accept()
+            if self.silenced is not None and address[0] in self.silenced:
+                silenced_total.inc()
+                client.close()
+                continue
+            if not self.admission.admit(address[0]):
+                refuse(client, self.REFUSAL)
+                continue
             client.settimeout(self.inactivity_timeout)
-            thread = threading.Thread(target=self.serve_client, args=(client, address))
+            thread = threading.Thread(target=self.serve_admitted,
+                                      args=(client, address, time.monotonic()),
+                                      daemon=True)  # may be idling on a keep-alive connection
+            with self.threads_lock:
+                self.threads.add(thread)
             thread.start()
-            self.threads.append(thread)
         logger.info('stop set. Inbox is shutting down.')
-        for t in self.threads:
+        with self.threads_lock:
+            threads = list(self.threads)
+        for t in threads:
             t.join(timeout=0.5)
 
-    def serve_client(self, client, address):
-        global last_received_sender
-        logger.info('connected to {}:{}.'.format(address[0], address[1]))
-        received = ''
+    def serve_admitted(self, client, address, accepted):
+        try:
+            self.serve_client(client, address, accepted)
+        finally:
+            self.admission.release(address[0])
+            with self.threads_lock:
+                self.threads.discard(threading.current_thread())
+
+    def serve_client(self, client, address, accepted=None):
+        """ Receives messages until the peer closes the connection.
+
+        Peers speaking the framed protocol (see frames) and legacy peers
+        sending ##END-terminated text are told apart by the first byte.
+        Legacy peers send a single message and close, unless they understand
+        the keep-alive ack.
+        """
+        logger.debug('connected to %s:%s.', address[0], address[1])
+        connections_total.inc()
+        if self.relay is not None:
+            self.relay.wake(address[0])  # it's back: hand it what we hold for it
+        reader = frames.FrameReader(self.buffer_size)
+        received_at = accepted  # the first messages also waited for their connection's thread
         try:
             while not self.stop.is_set():
-                fragment = client.recv(self.buffer_size)
-                if fragment == b'':
+                if self.limiter is not None:
+                    delay = self.limiter.delay(address[0])
+                    if delay > 0:
+                        # leave what it sends in the socket buffers: TCP slows the peer down
+                        throttled_total.inc()
+                        self.stop.wait(delay)
+                        continue
+                if incoming_messages.full() and incoming_messages.policy == BLOCK:
+                    incoming_messages.wait_for_room(incoming_messages.timeout)
+                try:
+                    received = reader.recv_from(client)
+                except socket.timeout:
+                    if not reader.idle():
+                        raise
+                    break  # idle keep-alive connection
+                if received == 0:
                     break
-                received = ''.join([received, fragment.decode('utf-8')])
-                if received.rstrip().endswith('##END'):
-                    break
-        except socket.error as exc:
+                if self.silenced is not None and address[0] in self.silenced:
+                    break  # silenced while connected
+                client.settimeout(self.inactivity_timeout)
+                acks = self.handle_received(reader, address[0], received_at or time.monotonic())
+                received_at = None
+                if acks:
+                    client.sendall(acks)
+                    client.settimeout(self.keepalive_timeout)
+                if reader.start_tls:
+                    reader.start_tls = False
+                    client.settimeout(self.inactivity_timeout)
+                    # or the acks would wait behind the session tickets for a delayed ACK
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    client = self.tls.wrap_socket(client, server_side=True)
+                    client.settimeout(self.keepalive_timeout)
+            if reader.legacy and not self.stop.is_set():
+                # a legacy peer closed the connection without ##END
+                client.sendall(self.handle_legacy_rest(reader, address[0]))
+        except (socket.error, frames.FrameError) as exc:
+            client.close()
             self.closed_connection(address, exc)
             return
-        if not self.stop.is_set():
-            client.sendall(b'OK\n')
-            client.sendall(str(
-                self.handle_message(received, address[0])
-            ).encode('utf-8'))
-            last_received_sender = address[0]
         client.close()
         self.closed_connection(address)
 
-    def handle_message(self, message, sender):
-        message = message.replace('##END', '').strip()
-        logger.info('new message from <{}>: "{}"'.format(sender, message))
-        incoming_messages.append((sender, message))
+    async def serve_client_async(self, reader, writer):
+        """ Same as serve_client, for connections accepted by listen_async. """
+        address = writer.get_extra_info('peername')
+        logger.debug('connected to %s:%s.', address[0], address[1])
+        connections_total.inc()
+        if self.relay is not None:
+            self.relay.wake(address[0])  # it's back: hand it what we hold for it
+        frame_reader = frames.FrameReader(self.buffer_size)
+        timeout = self.inactivity_timeout
+        loop = asyncio.get_event_loop()
+        try:
+            while not self.stop.is_set():
+                if self.limiter is not None:
+                    delay = self.limiter.delay(address[0])
+                    if delay > 0:
+                        throttled_total.inc()
+                        await asyncio.sleep(delay)
+                        continue
+                if incoming_messages.full() and incoming_messages.policy == BLOCK:
+                    await loop.run_in_executor(None, incoming_messages.wait_for_room,
+                                               incoming_messages.timeout)
+                try:
+                    fragment = await asyncio.wait_for(reader.read(self.buffer_size), timeout)
+                except asyncio.TimeoutError:
+                    if not frame_reader.idle():
+                        raise
+                    break  # idle keep-alive connection
+                if fragment == b'':
+                    break
+                if self.silenced is not None and address[0] in self.silenced:
+                    break  # silenced while connected
+                timeout = self.inactivity_timeout
+                frame_reader.feed(fragment)
+                # blocking on a full queue would stall the event loop, see above
+                if self.relay is None:
+                    acks = self.handle_received(frame_reader, address[0], time.monotonic(),
+                                                block=False)
+                else:
+                    # holding a message waits for the relay spool's fsync
+                    acks = await loop.run_in_executor(None, self.handle_received, frame_reader,
+                                                      address[0], time.monotonic(), False)
+                if acks:
+                    writer.write(acks)
+                    await writer.drain()
+                    timeout = self.keepalive_timeout
+                if frame_reader.start_tls:
+                    frame_reader.start_tls = False
+                    if not hasattr(writer, 'start_tls'):
+                        raise frames.FrameError('TLS needs asyncio from Python 3.11')
+                    await writer.start_tls(self.tls, ssl_handshake_timeout=self.inactivity_timeout)
+            if frame_reader.legacy and not self.stop.is_set():
+                writer.write(self.handle_legacy_rest(frame_reader, address[0]))
+                await writer.drain()
+        except (socket.error, asyncio.TimeoutError, frames.FrameError) as exc:
+            writer.close()
+            self.closed_connection(address, exc)
+            return
+        except asyncio.CancelledError:
+            pass  # the event loop is shutting down
+        writer.close()
+        self.closed_connection(address)
+
+    def handle_received(self, reader, sender, received_at=None, block=True):
+        """ Handles every message completed in `reader`; returns the acks to send back. """
+        acks = []
+        messages = 0
+        if reader.legacy:
+            for message in reader.legacy_messages():
+                acks.append(self.legacy_ack(self.deliver(message, sender, received_at, block)))
+                messages += 1
+        else:
+            for frame in reader.frames():
+                if frame.type == frames.MESSAGE:
+                    status = str(self.deliver(frames.text(frames.decoded_payload(frame)), sender,
+                                              received_at, block, frame.message_id))
+                    messages += 1
+                elif frame.type == frames.BATCH:
+                    # one ack for the whole batch, holding every message's status
+                    payload = frames.decoded_payload(frame)
+                    if frame.flags & frames.MESSAGE_IDS:
+                        statuses = [str(self.deliver(frames.text(message), sender, received_at,
+                                                     block, message_id))
+                                    for message_id, message in frames.unpack_batch(payload, True)]
+                    else:
+                        statuses = [str(self.deliver(frames.text(message), sender, received_at,
+                                                     block))
+                                    for message in frames.unpack_batch(payload)]
+                    status = ' '.join(statuses)
+                    messages += len(statuses)
+                elif frame.type == frames.FORWARD:
+                    if sender not in self.relays:  # or anyone could pose as any sender
+                        raise frames.FrameError('FORWARD frame from <{}>, not a relay'.format(
+                            sender))
+                    statuses = [str(self.deliver_forwarded(entry, sender, received_at, block,
+                                                           message_id))
+                                for message_id, entry in
+                                frames.unpack_batch(frames.decoded_payload(frame), True)]
+                    status = ' '.join(statuses)
+                    messages += len(statuses)
+                elif frame.type == frames.RELAY:
+                    status = str(self.hold(frame, sender))
+                    messages += 1
+                elif frame.type == frames.SYNC:
+                    if self.relay is None or sender not in self.relay.siblings:
+                        raise frames.FrameError('SYNC frame from <{}>, not a sibling relay'.format(
+                            sender))
+                    status = self.relay.handle_sync(frame.payload)
+                elif frame.type == frames.STARTTLS:
+                    if self.tls is None or not reader.idle():
+                        raise frames.FrameError('unexpected STARTTLS frame')
+                    reader.start_tls = True
+                    status = '200'
+                else:
+                    raise frames.FrameError('unexpected frame type {}'.format(frame.type))
+                # acks tell the sender which codecs it may compress with, and that
+                # batches may carry message ids
+                acks.append(frames.pack(frames.ACK, status.encode('utf-8'), frame.message_id,
+                                        frames.codecs_mask() | frames.MESSAGE_IDS))
+        if messages and self.limiter is not None:
+            self.limiter.charge(sender, messages)
+        return b''.join(acks)
+
+    def handle_legacy_rest(self, reader, sender):
+        message = reader.legacy_reader.rest()
+        if not message.strip():
+            return b''
+        return self.legacy_ack(self.deliver(message, sender))
+
+    @staticmethod
+    def legacy_ack(status):
+        """ The trailing keep-alive flag tells the sender it may reuse the
+        connection; legacy senders only look for "OK\\n".
+        """
+        return 'OK\n{} {}\n'.format(status, KEEPALIVE_FLAG).encode('utf-8')
+
+    def deliver(self, message, sender, received_at=None, block=True, message_id=None):
+        global last_received_sender
+        status = self.handle_message(message, sender, block, message_id)
+        last_received_sender = sender
+        received_total.inc()
+        if received_at is not None:
+            receive_latency.observe(time.monotonic() - received_at)
+        return status
+
+    def deliver_forwarded(self, entry, relay, received_at=None, block=True, message_id=None):
+        """ Delivers a message held for us by `relay`, as sent by its original sender. """
+        sender, _, message = frames.text(entry).partition('\n')
+        if self.silenced is not None and sender in self.silenced:
+            silenced_total.inc()
+            return 200
+        logger.debug('message from <%s> forwarded by relay <%s>.', sender, relay)
+        return self.deliver(message, sender, received_at, block, message_id)
+
+    def hold(self, frame, sender):
+        """ Has our relay hold the message in a RELAY frame from `sender`. """
+        if self.relay is None:
+            return NOT_A_RELAY
+        recipient, _, message = frames.text(frame.payload).partition('\n')
+        return self.relay.hold(frame.message_id, recipient, sender, message)
+
+    def handle_message(self, message, sender, block=True, message_id=None):
+        """ Queues a received message. Returns 200, or OVERLOADED if the queue is full.
+
+        Messages whose id was already received are acknowledged but dropped.
+        """
+        if message_id is not None and self.duplicates is not None:
+            if not self.duplicates.add(message_id):
+                duplicates_total.inc()
+                logger.debug('dropped duplicate of message %x from <%s>.', message_id, sender)
+                return 200
+        message = message.strip()
+        if log_bodies:
+            logger.debug('new message from <%s>: "%s"', sender, message)
+        else:
+            logger.debug('new message from <%s> (%d characters).', sender, len(message))
+        if not incoming_messages.put((sender, message), block):
+            if message_id is not None and self.duplicates is not None:
+                self.duplicates.discard(message_id)  # the retry will be welcome
+            return OVERLOADED
+        if self.history is not None:
+            self.history.append(store.INCOMING, sender, message)
         return 200
 
     @staticmethod
     def closed_connection(address, exception=None):
         if exception is None:
-            logger.info('closed connection to {}:{}.'.format(address[0], address[1]))
+            logger.debug('closed connection to %s:%s.', address[0], address[1])
+        else:
+            logger.info('closed connection to %s:%s due to error <%s>: %s.',
+                        address[0], address[1], exception.__class__.__name__, exception)
+
+
+class Delivery:
+    """ Collects the outcome of sending one message to several recipients.
+
+    Outgoing messages may carry a Delivery: OutboxSender reports to it
+    whether each recipient got the message ('sent'), a relay holds it for
+    the recipient ('relayed') or it was given up ('failed').
+    """
+    def __init__(self, recipients):
+        self.results = collections.OrderedDict((r, 'pending') for r in recipients)
+        self.remaining = len(self.results)
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        if self.remaining == 0:
+            self.done.set()
+
+    def report(self, recipient, result):
+        with self.lock:
+            if self.results.get(recipient) != 'pending':
+                return
+            self.results[recipient] = result
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.done.set()
+
+    def wait(self, timeout=None):
+        """ Returns the results once every recipient is done or `timeout` expires. """
+        self.done.wait(timeout)
+        with self.lock:
+            return collections.OrderedDict(self.results)
+
+
+def finish(message, result):
+    """ Removes `message` from the spool, and reports `result` to its Delivery, if any. """
+    if outbox_spool is not None:
+        outbox_spool.done(message.id)
+    if message.delivery is not None:
+        message.delivery.report(message.recipient, result)
+
+
+class RetryScheduler:
+    """ Holds back messages whose recipient recently failed to receive one.
+
+    Every recipient has its own exponential backoff (with jitter): while a
+    recipient is backed off, all of its messages wait here instead of
+    hitting the network. Messages that fail `max_attempts` times are moved
+    to `dead_letters`.
+    """
+    def __init__(self, base_delay=0.5, max_delay=60, max_attempts=8, dead_letters_size=1000):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.dead_letters = collections.deque(maxlen=dead_letters_size)
+        self.failures = {}    # recipient -> consecutive failures
+        self.not_before = {}  # recipient -> time before which it's backed off
+        self.pending = []     # heap of (due, seq, message, attempts)
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def failed(self, message, attempts):
+        """ Records a failed delivery. Returns False if the message was dead-lettered. """
+        return self.failed_batch([(message, attempts)])[0]
+
+    def failed_batch(self, batch):
+        """ Records a failed attempt at delivering (message, attempts) pairs to one recipient.
+
+        However many messages it carried, the attempt counts as a single
+        failure of the recipient. Returns, for every message, False if it
+        was dead-lettered.
+        """
+        if not batch:
+            return []
+        recipient = batch[0][0][0]
+        with self.lock:
+            failures = self.failures.get(recipient, 0) + 1
+            self.failures[recipient] = failures
+            delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            due = self.not_before[recipient] = max(self.not_before.get(recipient, 0),
+                                                   time.monotonic() + delay)
+            retried = []
+            for message, attempts in batch:
+                if attempts >= self.max_attempts:
+                    self.dead_letters.append(message)
+                    retried.append(False)
+                else:
+                    heapq.heappush(self.pending, (due, next(self.seq), message, attempts))
+                    retried.append(True)
+            return retried
+
+    def succeeded(self, recipient):
+        with self.lock:
+            self.failures.pop(recipient, None)
+            self.not_before.pop(recipient, None)
+
+    def defer(self, message, attempts):
+        """ Parks `message` until its recipient's backoff expires.
+
+        Returns False, without parking it, if the recipient isn't backed off.
+        """
+        with self.lock:
+            due = self.not_before.get(message[0], 0)
+            if due <= time.monotonic():
+                return False
+            heapq.heappush(self.pending, (due, next(self.seq), message, attempts))
+            return True
+
+    def release(self, recipient):
+        """ Makes every message parked for `recipient` due now. """
+        now = time.monotonic()
+        with self.lock:
+            self.pending = [(now if message[0] == recipient else due, seq, message, attempts)
+                            for due, seq, message, attempts in self.pending]
+            heapq.heapify(self.pending)
+
+    def due(self):
+        """ Pops all the (message, attempts) pairs whose backoff expired. """
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            while self.pending and self.pending[0][0] <= now:
+                _, _, message, attempts = heapq.heappop(self.pending)
+                ready.append((message, attempts))
+        return ready
+
+    def next_due_in(self, default):
+        """ Seconds until the next parked message is due, at most `default`. """
+        with self.lock:
+            if not self.pending:
+                return default
+            return max(0, min(default, self.pending[0][0] - time.monotonic()))
+
+
+class Peer:
+    """ What PeerHealth knows about a recipient. """
+    def __init__(self):
+        self.last_seen = None  # when it last accepted a connection or a message
+        self.srtt = None       # smoothed round trip time of connecting to it
+        self.rttvar = None
+        self.failures = 0      # consecutive failures
+        self.opened = None     # when its circuit opened, if it's open
+        self.next_probe = 0
+        self.probe_delay = 0
+        self.probing = False
+
+
+class PeerHealth:
+    """ Tracks how reachable each recipient is, and stops sending to dead ones.
+
+    After `failure_threshold` consecutive failures a recipient's circuit
+    opens: its messages are failed right away, without touching the
+    network, and a probe (a bare connect) checks every `probe_interval`
+    seconds, backing off up to `max_probe_interval`, whether it came back.
+    The first success closes the circuit again.
+
+    Connect timeouts follow each recipient's round trip time, like TCP's
+    retransmission timeout (RFC 6298), between `min_connect_timeout` and
+    `connect_timeout` seconds.
+    """
+    def __init__(self, failure_threshold=3, probe_interval=5, max_probe_interval=60,
+                 connect_timeout=10, min_connect_timeout=0.5):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.connect_timeout = connect_timeout
+        self.min_connect_timeout = min_connect_timeout
+        self.peers = {}  # recipient -> Peer
+        self.lock = threading.Lock()
+
+    def unreachable(self):
+        """ The recipients whose circuit is open. """
+        with self.lock:
+            return [r for r, peer in self.peers.items() if peer.opened is not None]
+
+    def allow(self, recipient):
+        """ False if `recipient`'s circuit is open. """
+        peer = self.peers.get(recipient)
+        return peer is None or peer.opened is None
+
+    def timeout(self, recipient):
+        """ Seconds to wait for a connection to `recipient`. """
+        peer = self.peers.get(recipient)
+        if peer is None or peer.srtt is None:
+            return self.connect_timeout
+        return max(self.min_connect_timeout,
+                   min(self.connect_timeout, peer.srtt + 4 * peer.rttvar))
+
+    def succeeded(self, recipient, rtt=None):
+        """ Records that `recipient` answered, `rtt` seconds after connecting if known.
+
+        Returns True if this closed its circuit.
+        """
+        with self.lock:
+            peer = self.peers.setdefault(recipient, Peer())
+            peer.last_seen = time.monotonic()
+            if rtt is not None:
+                if peer.srtt is None:
+                    peer.srtt, peer.rttvar = rtt, rtt / 2
+                else:
+                    peer.rttvar = 0.75 * peer.rttvar + 0.25 * abs(peer.srtt - rtt)
+                    peer.srtt = 0.875 * peer.srtt + 0.125 * rtt
+            peer.failures = 0
+            closed = peer.opened is not None
+            peer.opened = None
+        if closed:
+            logger.info('<%s> is reachable again.', recipient)
+        return closed
+
+    def failed(self, recipient):
+        """ Records a failure to reach `recipient`, opening its circuit if there were enough. """
+        with self.lock:
+            peer = self.peers.setdefault(recipient, Peer())
+            peer.failures += 1
+            if peer.opened is not None or peer.failures < self.failure_threshold:
+                return
+            peer.opened = time.monotonic()
+            peer.probe_delay = self.probe_interval
+            peer.next_probe = peer.opened + peer.probe_delay
+        logger.info('<%s> is unreachable: holding its messages until a probe gets through.',
+                    recipient)
+
+    def probes_due(self):
+        """ Returns the recipients to probe now, marking them as being probed. """
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for recipient, peer in self.peers.items():
+                if peer.opened is not None and not peer.probing and peer.next_probe <= now:
+                    peer.probing = True
+                    due.append(recipient)
+        return due
+
+    def next_probe_in(self, default):
+        """ Seconds until the next probe is due, at most `default`. """
+        with self.lock:
+            due = [p.next_probe for p in self.peers.values()
+                   if p.opened is not None and not p.probing]
+        if not due:
+            return default
+        return max(0, min(default, min(due) - time.monotonic()))
+
+    def probed(self, recipient, rtt=None):
+        """ Records the outcome of a probe: `rtt` is None if it failed.
+
+        Returns True if this closed the circuit.
+        """
+        if rtt is not None:
+            closed = self.succeeded(recipient, rtt)
+        else:
+            closed = False
+        with self.lock:
+            peer = self.peers[recipient]
+            peer.probing = False
+            if rtt is None:
+                peer.probe_delay = min(self.max_probe_interval, peer.probe_delay * 2)
+                peer.next_probe = time.monotonic() + peer.probe_delay
+        return closed
+
+
+class PeerConnectionPool:
+    """ Keeps connections to peers open so that they can carry more messages.
+
+    At most `max_per_peer` connections per recipient are in use at any time;
+    connections left idle for longer than `idle_timeout` seconds are closed.
+    Connecting is timed out, and timed, by `health` (see PeerHealth); once
+    connected, operations time out after `timeout` seconds. With `tls` (a
+    tls.ClientTLS), new connections switch to TLS if the peer speaks it.
+    """
+    def __init__(self, max_per_peer=2, idle_timeout=30, timeout=10, health=None, tls=None):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.health = health if health is not None else PeerHealth()
+        self.tls = tls
+        self.idle = {}   # recipient -> [(connection, last used)]
+        self.slots = {}  # recipient -> semaphore limiting connections in use
+        self.lock = threading.Lock()
+
+    def acquire(self, recipient):
+        """ Returns (connection, reused). Raises socket.error if connect fails. """
+        with self.lock:
+            slot = self.slots.setdefault(recipient, threading.BoundedSemaphore(self.max_per_peer))
+        slot.acquire()
+        conn = self.pop_idle(recipient)
+        if conn is not None:
+            return conn, True
+        try:
+            conn = self.connect(recipient)
+            if self.tls is not None and self.tls.wanted(recipient):
+                try:
+                    conn = self.tls.wrap(conn, recipient)
+                except tls.Refused:
+                    conn = self.connect(recipient)
+        except:
+            slot.release()
+            raise
+        return conn, False
+
+    def connect(self, recipient):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            conn.settimeout(self.health.timeout(recipient))
+            started = time.monotonic()
+            conn.connect((recipient, SUS_MESSAGES_PORT))
+            self.health.succeeded(recipient, time.monotonic() - started)
+            conn.settimeout(self.timeout)
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def release(self, recipient, conn, keep_alive=True):
+        if self.tls is not None:
+            self.tls.remember(recipient, conn)
+        if keep_alive and self.idle_timeout > 0:
+            with self.lock:
+                self.idle.setdefault(recipient, []).append((conn, time.monotonic()))
         else:
-            logger.info('closed connection to {}:{} due to error <{}>: {}.'.format(
-                address[0], address[1], exception.__class__.__name__, exception))
+            conn.close()
+        self.slots[recipient].release()
+
+    def discard(self, recipient, conn):
+        self.release(recipient, conn, keep_alive=False)
+
+    def pop_idle(self, recipient):
+        """ Pops the most recently used healthy idle connection to `recipient`. """
+        while True:
+            with self.lock:
+                idle = self.idle.get(recipient)
+                if not idle:
+                    return None
+                conn, last_used = idle.pop()
+            if time.monotonic() - last_used < self.idle_timeout and self.healthy(conn):
+                return conn
+            conn.close()
+
+    def healthy(self, conn):
+        """ An idle connection is healthy if the peer neither closed it nor sent anything. """
+        try:
+            conn.setblocking(False)
+            if isinstance(conn, ssl.SSLSocket):
+                conn.recv(1)  # TLS can't peek, but whatever it reads makes the connection unusable
+            else:
+                conn.recv(1, socket.MSG_PEEK)
+            return False
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return True
+        except socket.error:
+            return False
+        finally:
+            conn.settimeout(self.timeout)
+
+    def reap(self):
+        """ Closes every connection that has been idle for too long. """
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for recipient, idle in self.idle.items():
+                expired.extend(c for c, last_used in idle if now - last_used >= self.idle_timeout)
+                idle[:] = [(c, t) for c, t in idle if now - t < self.idle_timeout]
+        for conn in expired:
+            conn.close()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
 
 
 class OutboxSender:
-    def __init__(self, watch=outgoing_messages):
+    """ Sends the messages found in outgoing_messages.
+
+    Messages queued for the same recipient within `coalesce_delay` seconds
+    are sent together in one BATCH frame, up to `coalesce_count` messages
+    or `coalesce_bytes` bytes.
+
+    Messages to unreachable recipients are handed to the first of `relays`
+    that accepts to hold them (see relay), if any.
+    """
+    def __init__(self, watch=outgoing_messages, poll_interval=0.5, senders=4, retries=None,
+                 connections=None, coalesce_delay=0.002, coalesce_count=64,
+                 coalesce_bytes=64 * 1024, fanout_senders=64, history=None, codec=None,
+                 compress_threshold=1024, relays=()):
         self.watch = watch
-        self.threads = []
+        self.history = history  # a store.MessageStore, if messages are to be kept
+        self.poll_interval = poll_interval  # how often to check stop while idle
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=senders,
+                                                          thread_name_prefix='Sender')
+        # messages sent to many recipients at once get their own, wider pool
+        self.fanout_pool = concurrent.futures.ThreadPoolExecutor(max_workers=fanout_senders,
+                                                                 thread_name_prefix='FanOut')
+        self.retries = retries if retries is not None else RetryScheduler()
+        self.connections = connections if connections is not None else PeerConnectionPool()
+        self.legacy_peers = {}  # recipient -> when it was found not to understand frames
+        self.legacy_recheck = 600
+        self.framed_peers = set()
+        self.probe_timeout = 2
+        self.codec = codec  # a frames.Codec compressing large payloads, if any
+        self.compress_threshold = compress_threshold
+        self.peer_flags = {}  # recipient -> flags of its last ack: codecs, MESSAGE_IDS
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_count = coalesce_count
+        self.coalesce_bytes = coalesce_bytes
+        self.coalescing = {}  # recipient -> [deadline, [(message, attempts)], bytes]
+        self.health = self.connections.health
+        self.relays = list(relays)
+        self.probe_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2,
+                                                                thread_name_prefix='Probe')
         self.stop = threading.Event()
 
     def start(self):
-        logger.info('outbox started. Watching {}.'.format(self.watch))
+        logger.info('outbox started. Watching %s.', self.watch)
         while not self.stop.is_set():
-            if len(self.watch) <= 0:
-                continue
-            message = self.watch.popleft()
-            t = threading.Thread(target=self.send_message, args=(message,))
-            t.start()
+            timeout = self.retries.next_due_in(self.next_flush_in(self.poll_interval))
+            timeout = self.health.next_probe_in(timeout)
+            for message in self.watch.drain(timeout=timeout):
+                self.schedule(message)
+            for message, attempts in self.retries.due():
+                self.schedule(message, attempts)
+            self.flush()
+            for recipient in self.health.probes_due():
+                self.probe_pool.submit(self.probe, recipient)
+            self.connections.reap()
         logger.info('stop set. Outbox is shutting down.')
-        for t in self.threads:
-            t.join(timeout=0.5)
+        self.probe_pool.shutdown(wait=False)
+        self.pool.shutdown(wait=False)
+        self.fanout_pool.shutdown(wait=False)
+        self.connections.close_all()
 
-    def send_message(self, message):
+    def schedule(self, message, attempts=0):
+        """ Queues `message` for its recipient's next batch, unless the recipient is backed off. """
+        if self.retries.defer(message, attempts):
+            return
         recipient = message[0]
-        message = message[1]
-        logger.info('sending message "{}" to <{}>.'.format(message, recipient))
-        try:
-            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            conn.connect((recipient, SUS_MESSAGES_PORT))
-        except:
-            print('SUS>  remote host unresponsive.')
-            self.handle_not_sent((recipient, message))
+        if not self.health.allow(recipient):
+            if self.relays:
+                self.pool.submit(self.send_to_relay, message, attempts)
+            else:
+                self.handle_not_sent(message, attempts + 1)
             return
-        if not self.stop.is_set():
-            conn.sendall(message.encode('utf-8'))
-            conn.sendall(b'##END')
-            received = conn.recv(100).decode('utf-8')
-            if 'OK\n' not in received:
-                self.handle_not_sent((recipient, message))
+        batch = self.coalescing.get(recipient)
+        if batch is None:
+            batch = self.coalescing[recipient] = [time.monotonic() + self.coalesce_delay, [], 0]
+        batch[1].append((message, attempts))
+        batch[2] += len(message[1])
+        if len(batch[1]) >= self.coalesce_count or batch[2] >= self.coalesce_bytes:
+            self.flush(recipient)
+
+    def flush(self, recipient=None):
+        """ Hands to a sender `recipient`'s batch, or every batch whose window expired. """
+        if recipient is not None:
+            recipients = [recipient]
+        else:
+            now = time.monotonic()
+            recipients = [r for r, batch in self.coalescing.items() if batch[0] <= now]
+        for recipient in recipients:
+            batch = self.coalescing.pop(recipient)[1]
+            fanout = any(message.delivery is not None for message, _ in batch)
+            pool = self.fanout_pool if fanout else self.pool
+            pool.submit(self.send_messages, recipient, batch)
+
+    def next_flush_in(self, default):
+        """ Seconds until the next batch's window expires, at most `default`. """
+        if not self.coalescing:
+            return default
+        deadline = min(batch[0] for batch in self.coalescing.values())
+        return max(0, min(default, deadline - time.monotonic()))
+
+    def send_messages(self, recipient, batch):
+        """ Sends a batch of (message, attempts) pairs to `recipient`. """
+        if logger.isEnabledFor(logging.DEBUG):
+            if log_bodies:
+                logger.debug('sending %d message(s) to <%s>: %s.', len(batch), recipient,
+                             ', '.join('"{}"'.format(m[1]) for m, _ in batch))
             else:
-                logger.info('correctly sent message.')
-                print('SUS>  ✓')
+                logger.debug('sending %d message(s) to <%s>.', len(batch), recipient)
+        while True:
+            legacy = self.is_legacy(recipient)
+            if legacy and len(batch) > 1:
+                for item in batch:  # legacy peers take one message at a time
+                    self.send_messages(recipient, [item])
+                return
+            try:
+                conn, reused = self.connections.acquire(recipient)
+            except:
+                print('SUS>  remote host unresponsive.')
+                self.health.failed(recipient)
+                self.handle_all_not_sent(batch)
+                return
+            if self.stop.is_set():
+                self.connections.discard(recipient, conn)
+                self.handle_all_not_sent(batch)
+                return
+            if legacy and '##END' in batch[0][0][1]:
+                self.connections.release(recipient, conn)
+                logger.info('cannot send "##END" to legacy peer <%s>.', recipient)
+                print('SUS>  {} cannot receive messages containing "##END".'.format(recipient))
+                failed_total.inc()
+                finish(batch[0][0], 'failed')
+                return
+            messages = [m for m, _ in batch]
+            # legacy peers choke on frames, but may not close the connection
+            probing = not legacy and recipient not in self.framed_peers
+            if probing:
+                conn.settimeout(self.probe_timeout)
+            try:
+                sent_at = time.monotonic()
+                if legacy:
+                    accepted, keep_alive = self.deliver_legacy(conn, messages[0].message)
+                    accepted = [accepted]
+                else:
+                    peer_flags = self.peer_flags.get(recipient, 0)
+                    codec = self.codec
+                    if codec is not None and not frames.accepts(peer_flags, codec):
+                        codec = None
+                    accepted, keep_alive, self.peer_flags[recipient] = \
+                        self.deliver(conn, messages, codec, peer_flags & frames.MESSAGE_IDS)
+                    self.framed_peers.add(recipient)
+            except (ConnectionError, socket.timeout) as exc:
+                timed_out = isinstance(exc, socket.timeout)
+                self.connections.discard(recipient, conn)
+                if reused and not timed_out:
+                    continue  # the peer may have just closed the idle connection
+                if probing and not timed_out:
+                    logger.info('<%s> dropped a framed message, falling back to ##END.',
+                                recipient)
+                    self.legacy_peers[recipient] = time.monotonic()
+                    continue
+                answer = self.try_legacy(recipient, batch[0][0]) if probing else None
+                if answer is not None:
+                    accepted, legacy = answer
+                    if legacy:
+                        logger.info('<%s> only answered ##END, falling back to it.', recipient)
+                        self.legacy_peers[recipient] = time.monotonic()
+                    else:
+                        self.framed_peers.add(recipient)  # it's just slow
+                    self.handle_sent(recipient, batch[:1], [accepted])
+                    batch = batch[1:]
+                    if batch:
+                        continue
+                    return
+                logger.info('error while sending: %s.', exc)
+                self.health.failed(recipient)
+                self.handle_all_not_sent(batch)
+                return
+            except (socket.error, frames.FrameError) as exc:
+                self.connections.discard(recipient, conn)
+                if probing and isinstance(exc, frames.FrameError):
+                    logger.info('<%s> did not answer with a frame, falling back to ##END.',
+                                recipient)
+                    self.legacy_peers[recipient] = time.monotonic()
+                    continue
+                logger.info('error while sending: %s.', exc)
+                self.handle_all_not_sent(batch)
+                return
+            break
+        now = time.monotonic()
+        ack_latency.observe(now - sent_at)
+        if probing:
+            conn.settimeout(self.connections.timeout)
+        self.connections.release(recipient, conn, keep_alive=keep_alive)
+        self.health.succeeded(recipient)
+        self.handle_sent(recipient, batch, accepted, now)
+
+    def handle_sent(self, recipient, batch, accepted, now=None):
+        """ Settles the (message, attempts) pairs of `batch`, whether `accepted` by `recipient`. """
+        if not any(accepted):
+            self.handle_all_not_sent(batch)
+            return
+        if now is None:
+            now = time.monotonic()
+        self.retries.succeeded(recipient)
+        sent = 0
+        refused = []
+        for (message, attempts), ok in zip(batch, accepted):
+            if ok:
+                sent += 1
+                finish(message, 'sent')
+                if message.queued is not None:
+                    queue_latency.observe(now - message.queued)
+                if self.history is not None:
+                    self.history.append(store.OUTGOING, recipient, message[1])
+            else:
+                refused.append((message, attempts))
+        self.handle_all_not_sent(refused)
+        sent_total.inc(sent)
+        logger.debug('correctly sent %d message(s).', sent)
+        print('SUS>  ✓' if sent == 1 else 'SUS>  ✓ ({} messages)'.format(sent))
+
+    def handle_all_not_sent(self, batch):
+        """ Retries (message, attempts) pairs whose delivery failed in one attempt. """
+        if not batch:
+            return
+        batch = [(message, attempts + 1) for message, attempts in batch]
+        logger.info('%d message(s) not sent (attempt %d).', len(batch), batch[0][1])
+        retries_total.inc(len(batch))
+        for (message, _), retried in zip(batch, self.retries.failed_batch(batch)):
+            if not retried:
+                self.give_up(message)
+        self.watch.wake()  # so that start() picks up the new backoff deadline
+
+    def send_to_relay(self, message, attempts):
+        """ Hands `message` to the first relay that holds it for its unreachable recipient. """
+        payload = '\n'.join([message.recipient, message.message]).encode('utf-8')
+        for relay in self.relays:
+            if relay == message.recipient or not self.health.allow(relay):
+                continue
+            try:
+                conn, reused = self.connections.acquire(relay)
+            except socket.error as exc:
+                logger.info('relay <%s> unreachable: %s.', relay, exc)
+                self.health.failed(relay)
+                continue
+            try:
+                conn.sendall(frames.pack(frames.RELAY, payload, message.id))
+                ack = frames.recv_frame(conn)
+            except (socket.error, frames.FrameError) as exc:
+                self.connections.discard(relay, conn)
+                logger.info('error while sending to relay <%s>: %s.', relay, exc)
+                if not reused:
+                    self.health.failed(relay)
+                continue
+            self.connections.release(relay, conn)
+            if ack.type != frames.ACK or ack.message_id != message.id or ack.payload != b'200':
+                logger.info('relay <%s> refused message to <%s>.', relay, message.recipient)
+                continue
+            relayed_total.inc()
+            logger.info('relay <%s> holds message to <%s>.', relay, message.recipient)
+            print('SUS>  {} unreachable: message held by relay {}.'.format(message.recipient,
+                                                                           relay))
+            finish(message, 'relayed')
+            if self.history is not None:
+                self.history.append(store.OUTGOING, message.recipient, message.message)
+            return
+        self.handle_not_sent(message, attempts + 1)
+
+    def probe(self, recipient):
+        """ Checks whether unreachable `recipient` accepts connections again. """
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(self.health.connect_timeout)
+        started = time.monotonic()
+        try:
+            conn.connect((recipient, SUS_MESSAGES_PORT))
+            rtt = time.monotonic() - started
+        except socket.error:
+            rtt = None
+        finally:
+            conn.close()
+        if self.health.probed(recipient, rtt):
+            # its messages needn't wait for their backoff any more
+            self.retries.succeeded(recipient)
+            self.retries.release(recipient)
+            self.watch.wake()
+
+    def try_legacy(self, recipient, message):
+        """ Sends `message` terminated by ##END, on a new connection to `recipient`.
+
+        Tried when a first frame got neither an answer nor a close: a legacy
+        inbox chokes on frames, and may leave the connection open. Returns
+        None if the peer doesn't answer this either, else (accepted, legacy):
+        newer peers flag their answer with KEEPALIVE_FLAG, legacy ones don't.
+        """
+        if '##END' in message.message:
+            return None
+        try:
+            conn = self.connections.connect(recipient)
+        except socket.error:
+            return None
+        try:
+            conn.settimeout(self.probe_timeout)
+            accepted, keep_alive = self.deliver_legacy(conn, message.message)
+        except (socket.error, UnicodeDecodeError):
+            return None
+        finally:
+            conn.close()
+        return accepted, not keep_alive
+
+    def is_legacy(self, recipient):
+        """ True if `recipient` recently failed to understand frames. """
+        marked = self.legacy_peers.get(recipient)
+        if marked is None:
+            return False
+        if time.monotonic() - marked > self.legacy_recheck:
+            self.legacy_peers.pop(recipient, None)
+            return False
+        return True
+
+    def deliver(self, conn, messages, codec=None, with_ids=False):
+        """ Sends the Outgoing `messages` in one frame, compressed by `codec` if worth it.
+
+        Messages keep their id across attempts, so that the peer can drop
+        the ones it already received; batches only carry them `with_ids`.
+        Returns (accepted per message, keep_alive, flags of the peer's ack).
+        """
+        extra_flags = 0
+        if len(messages) == 1:
+            type, payload = frames.MESSAGE, messages[0].message.encode('utf-8')
+            message_id = messages[0].id
         else:
-            self.handle_not_sent((recipient, message))
-        conn.close()
+            type = frames.BATCH
+            encoded = [m.message.encode('utf-8') for m in messages]
+            if with_ids:
+                payload = frames.batch_payload(encoded, [m.id for m in messages])
+                extra_flags = frames.MESSAGE_IDS
+            else:
+                payload = frames.batch_payload(encoded)
+            message_id = new_message_id()
+        wire, flags = frames.compress(payload, codec, self.compress_threshold)
+        flags |= extra_flags
+        conn.sendall(frames.pack(type, wire, message_id, flags))
+        payload_bytes_total.inc(len(payload))
+        wire_bytes_total.inc(len(wire))
+        ack = frames.recv_frame(conn)
+        if ack.type != frames.ACK or ack.message_id != message_id:
+            raise frames.FrameError('expected the ack of message {}'.format(message_id))
+        statuses = ack.payload.split()
+        if len(statuses) != len(messages):
+            raise frames.FrameError('expected {} statuses, got {}'.format(
+                len(messages), len(statuses)))
+        return [status == b'200' for status in statuses], True, ack.flags
+
+    def deliver_legacy(self, conn, message):
+        """ Sends `message` terminated by ##END. Returns (accepted, keep_alive). """
+        conn.sendall(message.encode('utf-8'))
+        conn.sendall(b'##END')
+        received = self.receive_ack(conn)
+        if 'OK\n' not in received:
+            return False, False
+        status = received.split('OK\n', 1)[1].split(' ', 1)[0].strip()
+        # legacy peers always accept; newer ones may be overloaded
+        return status in ('', '200'), received.endswith(' {}\n'.format(KEEPALIVE_FLAG))
 
-    def handle_not_sent(self, message):
-        logger.info('message not sent.')
-        self.watch.appendleft(message)
+    @staticmethod
+    def receive_ack(conn):
+        """ Reads "OK\\n<status>", terminated by a newline or, for legacy peers, by EOF. """
+        received = ''
+        while received.count('\n') < 2:
+            fragment = conn.recv(100)
+            if fragment == b'':
+                if received == '':
+                    raise ConnectionResetError('connection closed before the ack')
+                break
+            received = ''.join([received, fragment.decode('utf-8')])
+        return received
+
+    def handle_not_sent(self, message, attempts=1):
+        logger.info('message not sent (attempt %d).', attempts)
+        retries_total.inc()
+        if not self.retries.failed(message, attempts):
+            self.give_up(message)
+        self.watch.wake()  # so that start() picks up the new backoff deadline
+
+    @staticmethod
+    def give_up(message):
+        logger.info('giving up on message to <%s>.', message[0])
+        failed_total.inc()
+        print('SUS>  could not deliver message to {}.'.format(message[0]))
+        finish(message, 'failed')
+
+
+class Subscribers:
+    """ The interactive clients to which incoming messages are pushed.
+
+    Every subscriber is a callback, called with (sender, message) by the
+    thread handling incoming messages: it must not block.
+    """
+    def __init__(self):
+        self.callbacks = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.callbacks)
+
+    def add(self, callback):
+        with self.lock:
+            self.callbacks.add(callback)
+
+    def discard(self, callback):
+        with self.lock:
+            self.callbacks.discard(callback)
+
+    def publish(self, sender, message):
+        with self.lock:
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback(sender, message)
+
+
+subscribers = Subscribers()
 
 
 class NewMessagesHandlerStdout:
-    """ Handles new messages found in incoming_messages. """
-    def __init__(self, watch=incoming_messages):
+    """ Handles new messages found in incoming_messages.
+
+    Messages are printed and pushed to `subscribers`. Senders are shown by
+    their nickname in `peers` (a peers.PeerDirectory), if any.
+    """
+    def __init__(self, watch=incoming_messages, poll_interval=0.5, peers=None,
+                 subscribers=subscribers):
         self.watch = watch
+        self.poll_interval = poll_interval  # how often to check stop while idle
+        self.peers = peers
+        self.subscribers = subscribers
         self.stop = threading.Event()
 
     def start(self):
-        logger.info('{} started.'.format(self.__class__.__name__))
+        logger.info('%s started.', self.__class__.__name__)
+        while not self.stop.is_set():
+            for sender, message in self.watch.drain(timeout=self.poll_interval):
+                if self.peers is not None:
+                    sender = self.peers.name_of(sender)
+                print('\n\nSUS> {}: {}'.format(sender, message))
+                self.subscribers.publish(sender, message)
+
+
+class MulticastListener:
+    """ Receives messages sent to the LAN multicast group with send_multicast.
+
+    Every datagram holds a single MESSAGE frame, delivered through `inbox`
+    like any other message. Multicast messages aren't acknowledged.
+    """
+    def __init__(self, inbox, group=SUS_MULTICAST_GROUP, poll_interval=0.5):
+        self.inbox = inbox
+        self.group = group
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('', SUS_MESSAGES_PORT))
+        membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+        self.server.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.server.settimeout(poll_interval)
+        self.stop = threading.Event()
+
+    def listen(self):
+        logger.info('listening for multicast messages on %s.', self.group)
         while not self.stop.is_set():
-            if len(self.watch) <= 0:
+            try:
+                datagram, address = self.server.recvfrom(65535)
+            except socket.timeout:
+                continue
+            if self.inbox.silenced is not None and address[0] in self.inbox.silenced:
+                silenced_total.inc()
                 continue
-            message = self.watch.popleft()
-            print('\n\nSUS> {}: {}'.format(message[0], message[1]))
+            reader = frames.FrameReader(len(datagram))
+            reader.feed(datagram)
+            try:
+                for frame in reader.frames():
+                    if frame.type == frames.MESSAGE and not reader.legacy:
+                        self.inbox.deliver(str(frames.decoded_payload(frame), 'utf-8'), address[0],
+                                           message_id=frame.message_id)
+            except (frames.FrameError, UnicodeDecodeError) as exc:
+                logger.info('dropped multicast datagram from <%s>: %s.', address[0], exc)
+        logger.info('stop set. Multicast listener is shutting down.')
+        self.server.close()
+
+
+def send_multicast(message, group=SUS_MULTICAST_GROUP, ttl=1):
+    """ Sends `message` once to every daemon listening on the multicast group. """
+    payload = message.encode('utf-8')
+    if frames.HEADER.size + len(payload) > 65507:
+        raise ValueError('message too large for a multicast datagram')
+    conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        conn.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        conn.sendto(frames.pack(frames.MESSAGE, payload, new_message_id()),
+                    (group, SUS_MESSAGES_PORT))
+    finally:
+        conn.close()
+
+
+def listen_async(servers, stop):
+    """ Serves all of `servers` from a single asyncio event loop.
+
+    Every server must have a bound `server` socket, a `backlog`, an
+    `admission` (see Admission), the REFUSAL sent to connections it doesn't
+    admit and a `serve_client_async` coroutine (see InboxServer and
+    SUSd.Shell). Returns once `stop` is set.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_serve_async(servers, stop))
+    finally:
+        loop.close()
+
+
+async def _serve_admitted(server, reader, writer):
+    ip = writer.get_extra_info('peername')[0]
+    silenced = getattr(server, 'silenced', None)  # only the inbox silences senders
+    if silenced is not None and ip in silenced:
+        silenced_total.inc()
+        writer.close()
+        return
+    if not server.admission.admit(ip):
+        writer.write(server.REFUSAL)
+        writer.close()
+        return
+    try:
+        await server.serve_client_async(reader, writer)
+    finally:
+        server.admission.release(ip)
+
+
+async def _serve_async(servers, stop):
+    loop = asyncio.get_event_loop()
+    running = []
+    for server in servers:
+        server.server.listen(server.backlog)
+        running.append(await asyncio.start_server(
+            functools.partial(_serve_admitted, server), sock=server.server,
+            backlog=server.backlog
+        ))
+        logger.info('%s listening at %s (asyncio).',
+                    server.__class__.__name__, server.server)
+    await loop.run_in_executor(None, stop.wait)
+    logger.info('stop set. Event loop is shutting down.')
+    for s in running:
+        s.close()
+    clients = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for client in clients:
+        client.cancel()  # e.g. idle keep-alive connections
+    await asyncio.gather(*clients, return_exceptions=True)
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" In-process metrics: counters, gauges and latency histograms.
+
+Updating a metric costs a lock and an addition; all the work happens when
+the registry is read, by the `stats` shell command or by the Prometheus
+endpoint (see serve_prometheus).
+"""
+
+
+import collections
+import threading
+
+
+class Counter:
+    """ A number that only goes up. """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def summary(self):
+        return str(self.value)
+
+    def exposition(self):
+        return ['{} {}'.format(self.name, self.value)]
+
+
+class Gauge:
+    """ A number read from `function` whenever the gauge is read. """
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    @property
+    def value(self):
+        return self.function()
+
+    def summary(self):
+        return str(self.value)
+
+    def exposition(self):
+        return ['{} {}'.format(self.name, self.value)]
+
+
+class Histogram:
+    """ Counts durations in log-linear buckets, like HdrHistogram.
+
+    Durations are recorded in microseconds: every power of two is split in
+    SUB_BUCKETS buckets, so that quantiles are within ~6% of the real value
+    whatever their magnitude, in a fixed amount of memory.
+    """
+    kind = 'summary'
+    SUB_BUCKETS = 16
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.counts = [0] * (64 * self.SUB_BUCKETS)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        micros = max(0, int(seconds * 1000000))
+        index = self.index(micros)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += micros
+            if micros > self.max:
+                self.max = micros
+
+    @classmethod
+    def index(cls, micros):
+        if micros < 2 * cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - cls.SUB_BUCKETS.bit_length()
+        return shift * cls.SUB_BUCKETS + (micros >> shift)
+
+    @classmethod
+    def value_at(cls, index):
+        """ Middle of the range of durations counted in bucket `index`, in microseconds. """
+        if index < 2 * cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        low = (index - shift * cls.SUB_BUCKETS) << shift
+        return low + (1 << shift) / 2
+
+    def quantiles(self, quantiles=QUANTILES):
+        """ Returns the durations, in seconds, below which each of `quantiles` falls. """
+        with self.lock:
+            counts = self.counts[:]
+            count = self.count
+            maximum = self.max
+        result = []
+        if count == 0:
+            return [0.0 for _ in quantiles]
+        seen = 0
+        index = 0
+        for quantile in quantiles:
+            rank = quantile * count
+            while index < len(counts) and seen + counts[index] < rank:
+                seen += counts[index]
+                index += 1
+            result.append(min(self.value_at(index), maximum) / 1000000)
+        return result
+
+    def summary(self):
+        quantiles = self.quantiles()
+        return 'count {}  {}  max {}'.format(self.count, '  '.join(
+            'p{:g} {}'.format(q * 100, format_duration(v))
+            for q, v in zip(self.QUANTILES, quantiles)), format_duration(self.max / 1000000))
+
+    def exposition(self):
+        lines = ['{}{{quantile="{}"}} {}'.format(self.name, q, v)
+                 for q, v in zip(self.QUANTILES, self.quantiles())]
+        lines.append('{}_sum {}'.format(self.name, self.sum / 1000000))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+def format_duration(seconds):
+    if seconds < 0.001:
+        return '{:.0f}µs'.format(seconds * 1000000)
+    if seconds < 1:
+        return '{:.1f}ms'.format(seconds * 1000)
+    return '{:.2f}s'.format(seconds)
+
+
+class Registry:
+    """ All the metrics of a process, by name. """
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        """ Registers `metric`, replacing any metric with the same name. """
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, function):
+        return self.add(Gauge(name, help, function))
+
+    def histogram(self, name, help):
+        return self.add(Histogram(name, help))
+
+    def summary(self):
+        """ One `name value` line per metric, for humans. """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        width = max((len(m.name) for m in metrics), default=0)
+        return '\n'.join('{}  {}'.format(m.name.ljust(width), m.summary()) for m in metrics)
+
+    def exposition(self):
+        """ The metrics in Prometheus' text exposition format. """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.exposition())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+
+def serve_prometheus(port, registry=registry, ip='127.0.0.1'):
+    """ Serves the metrics in `registry` over HTTP, for Prometheus to scrape.
+
+    Returns the server, already serving from a daemon thread: call its
+    shutdown method to stop it.
+    """
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes aren't worth a line in the log
+
+    server = http.server.HTTPServer((ip, port), Handler)
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Peer directory: nicknames for peers, and the resolution of names to IPs.
+
+Peers are named either by the user (`SUS peer xor-Nand 192.168.1.7`, or a
+host name instead of the IP), or by their traffic: whoever sends us a
+message is known from then on by the short reverse DNS name of its IP.
+Only the last `max_learned` names learned that way are kept.
+
+Host names are resolved once and cached for `ttl` seconds. Past that, the
+cached IP keeps being used while a background thread resolves the name
+again, so that sending by name never waits for DNS, except the very first
+time.
+"""
+
+
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+logger = logging.getLogger('peers')
+
+
+def is_ip(address):
+    try:
+        socket.inet_aton(address)
+    except (OSError, UnicodeError):
+        return False
+    return address.count('.') == 3
+
+
+class PeerDirectory:
+    """ Maps nicknames to addresses, and addresses to IPs. """
+    def __init__(self, path=None, ttl=300, negative_ttl=30, max_learned=1000):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl  # how long to remember that a name doesn't resolve
+        self.max_learned = max_learned
+        self.names = {}    # nickname -> IP or host name, set by the user
+        self.learned = collections.OrderedDict()  # nickname -> IP, from incoming messages
+        self.cache = {}    # host name -> (IP or None, expiry)
+        self.reverse = {}  # IP -> (nickname or None, expiry)
+        self.resolving = set()  # names and IPs being resolved in the background
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2,
+                                                          thread_name_prefix='Resolver')
+        self.load()
+
+    def __contains__(self, nickname):
+        return nickname in self.names or nickname in self.learned
+
+    def get(self, nickname):
+        return self.names.get(nickname) or self.learned.get(nickname)
+
+    def add(self, nickname, address):
+        with self.lock:
+            self.names[nickname] = address
+            self.forget(address)
+        self.save()
+
+    def remove(self, nickname):
+        """ Forgets `nickname`. Returns False if it wasn't known. """
+        with self.lock:
+            address = self.names.pop(nickname, None) or self.learned.pop(nickname, None)
+            if address is None:
+                return False
+            self.forget(address)
+        self.save()
+        return True
+
+    def forget(self, address):
+        self.cache.pop(address, None)
+        self.reverse.clear()  # nicknames of IPs may have changed
+
+    def resolve(self, name):
+        """ Returns the IP of a nickname, host name or IP; None if it doesn't resolve.
+
+        Only names never resolved before cost a DNS lookup.
+        """
+        address = self.names.get(name) or self.learned.get(name) or name
+        if is_ip(address):
+            return address
+        cached = self.cache.get(address)
+        if cached is None:
+            return self.lookup(address)
+        ip, expiry = cached
+        if expiry <= time.monotonic():
+            self.in_background(address, self.lookup)
+        return ip
+
+    def lookup(self, host):
+        try:
+            ip = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+            ttl = self.ttl
+        except (socket.gaierror, UnicodeError) as exc:
+            logger.info('could not resolve %s: %s.', host, exc)
+            ip = None
+            ttl = self.negative_ttl
+        self.cache[host] = (ip, time.monotonic() + ttl)
+        return ip
+
+    def name_of(self, ip):
+        """ The nickname of the peer at `ip`, or the IP itself if it has none (yet).
+
+        An IP without a nickname is looked up in reverse DNS in the background.
+        """
+        entry = self.reverse.get(ip)
+        if entry is None or entry[1] <= time.monotonic():
+            for nickname, address in list(self.names.items()):
+                if address == ip or self.cache.get(address, (None,))[0] == ip:
+                    self.reverse[ip] = (nickname, time.monotonic() + self.ttl)
+                    return nickname
+            self.in_background(ip, self.learn)
+        if entry is None or entry[0] is None:
+            return ip
+        return entry[0]
+
+    def learn(self, ip):
+        """ Names the peer at `ip` after its reverse DNS name. """
+        try:
+            nickname = socket.gethostbyaddr(ip)[0].split('.', 1)[0]
+        except (socket.herror, socket.gaierror, UnicodeError):
+            nickname = None
+        with self.lock:
+            if nickname is not None and nickname in self.names:
+                nickname = None  # the user's nicknames take precedence
+            self.reverse[ip] = (nickname, time.monotonic() + self.ttl)
+            if nickname is None or self.learned.get(nickname) == ip:
+                return
+            self.learned[nickname] = ip
+            self.learned.move_to_end(nickname)
+            self.evict()
+        logger.info('learned that %s is %s.', ip, nickname)
+        self.save()
+
+    def evict(self):
+        """ Forgets the oldest learned nicknames past max_learned. Call holding the lock. """
+        while len(self.learned) > self.max_learned:
+            self.learned.popitem(last=False)
+
+    def in_background(self, key, function):
+        """ Calls function(key) on a resolver thread, unless it's already being called. """
+        with self.lock:
+            if key in self.resolving:
+                return
+            self.resolving.add(key)
+
+        def run():
+            try:
+                function(key)
+            finally:
+                with self.lock:
+                    self.resolving.discard(key)
+        self.pool.submit(run)
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+            self.names = saved.get('names', {})
+            self.learned = collections.OrderedDict(saved.get('learned', {}))
+            self.evict()
+        except (OSError, ValueError, AttributeError) as exc:
+            logger.info('could not load peers from %s: %s.', self.path, exc)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            saved = {'names': dict(self.names), 'learned': dict(self.learned)}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(saved, f, indent=2)  # unsorted: learned nicknames are oldest first
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,398 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Store-and-forward relays, for `SUS start --relay`.
+
+A sender whose recipient is unreachable hands the message to one of its
+relays (`--relays`) in a RELAY frame. The relay holds it until the
+recipient is back: as soon as the recipient connects to the relay, or
+when a periodic attempt finds it reachable, every message held for it is
+forwarded in FORWARD frames of up to `forward_count` messages each. The
+recipient sees them as sent by their original sender: relays are trusted
+to tell who that was.
+
+Held messages are spooled encrypted (see Sealer), and are bounded by
+`capacity` and `per_recipient`: beyond those, relays refuse messages as
+overloaded inboxes do. Messages older than `retention` seconds are
+dropped.
+
+Relays listed as `siblings` reconcile their mailboxes every
+`sync_interval` seconds, so that a message reaches its recipient from
+whichever relay meets it first. Every mailbox has a digest, the XOR of
+the hashes of the ids it holds, kept up to date as messages come and go:
+relays exchange the digests and list the ids of the mailboxes whose
+digests differ, then pull just the messages they miss, and drop those
+the sibling already delivered.
+"""
+
+
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import frames
+import messaging
+import metrics
+import tls
+
+
+logger = logging.getLogger('relay')
+
+held_total = metrics.registry.counter('sus_relay_held_total', 'Messages held for other peers.')
+forwarded_total = metrics.registry.counter('sus_relay_forwarded_total',
+                                           'Held messages delivered to their recipient.')
+expired_total = metrics.registry.counter('sus_relay_expired_total',
+                                         'Held messages dropped after the retention period.')
+
+
+class Sealer:
+    """ Encrypts held messages with a key of its own, kept in `key_path`.
+
+    Needs the cryptography package.
+    """
+    def __init__(self, key_path):
+        from cryptography.fernet import Fernet, InvalidToken
+        self.invalid = InvalidToken
+        self.fernet = Fernet(self.load_key(key_path, Fernet.generate_key))
+
+    @staticmethod
+    def load_key(path, generate):
+        try:
+            with open(path, 'rb') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        key = generate()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # readable by us only
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+            f.write(key)
+        return key
+
+    def seal(self, sender, message):
+        return self.fernet.encrypt('\n'.join([sender, message]).encode('utf-8')).decode('ascii')
+
+    def unseal(self, sealed):
+        """ Returns (sender, message). Raises ValueError if `sealed` isn't ours. """
+        try:
+            plain = self.fernet.decrypt(sealed.encode('ascii'))
+        except self.invalid:
+            raise ValueError('corrupt, or sealed with another key')
+        sender, _, message = plain.decode('utf-8').partition('\n')
+        return sender, message
+
+    def sealed_at(self, sealed):
+        """ When `sealed` was sealed, in seconds since the epoch. """
+        try:
+            return self.fernet.extract_timestamp(sealed.encode('ascii'))
+        except self.invalid:
+            raise ValueError('corrupt, or sealed with another key')
+
+
+def hash_id(message_id):
+    return int.from_bytes(hashlib.blake2b(message_id.to_bytes(8, 'big'), digest_size=8).digest(),
+                          'big')
+
+
+def exchange(conn, type, payload, flags=0):
+    """ Sends one frame and returns the payload of its ack. """
+    message_id = messaging.new_message_id()
+    conn.sendall(frames.pack(type, payload, message_id, flags))
+    ack = frames.recv_frame(conn)
+    if ack.type != frames.ACK or ack.message_id != message_id:
+        raise frames.FrameError('expected the ack of message {}'.format(message_id))
+    return bytes(ack.payload)
+
+
+class Relay:
+    """ Holds messages for unreachable peers, spooled in `spool` (a store.OutboxSpool). """
+    def __init__(self, spool, sealer, capacity=10000, per_recipient=1000, retention=7 * 86400,
+                 siblings=(), sync_interval=60, retry_interval=30, max_retry_interval=3600,
+                 forward_count=256, connect_timeout=5, tombstones=10000, poll_interval=0.5,
+                 tls=None, forwarders=8):
+        self.spool = spool
+        self.sealer = sealer
+        self.capacity = capacity
+        self.per_recipient = per_recipient
+        self.retention = retention
+        self.siblings = set(siblings)  # relays reconciling their mailboxes with ours
+        self.sync_interval = sync_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.forward_count = forward_count
+        self.connect_timeout = connect_timeout
+        self.tombstones = tombstones
+        self.poll_interval = poll_interval  # how often to check stop while idle
+        self.tls = tls  # a tls.ClientTLS, if connections are to switch to TLS
+        self.mailboxes = {}  # recipient -> OrderedDict of the ids held for it
+        self.digests = {}    # recipient -> XOR of hash_id of the ids held for it
+        self.due = {}        # recipient -> (when to forward its messages, backoff)
+        self.delivered = collections.OrderedDict()  # id -> recipient, of the last delivered
+        # unreachable recipients take connect_timeout each: forward to several at once
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=forwarders,
+                                                          thread_name_prefix='Forward')
+        self.forwarding = set()  # recipients being forwarded their messages
+        self.lock = threading.Condition()
+        self.stop = threading.Event()
+
+    def __len__(self):
+        return len(self.spool.pending)
+
+    def open(self):
+        for message_id, recipient, _ in self.spool.open():
+            self.index(message_id, recipient)
+        self.purge()
+        logger.info('relay holds %d messages for %d peers.', len(self), len(self.mailboxes))
+
+    def index(self, message_id, recipient):
+        """ Files a spooled message in its recipient's mailbox. Call holding the lock. """
+        self.mailboxes.setdefault(recipient, collections.OrderedDict())[message_id] = None
+        self.digests[recipient] = self.digests.get(recipient, 0) ^ hash_id(message_id)
+        self.due.setdefault(recipient, (time.monotonic(), self.retry_interval))
+
+    def hold(self, message_id, recipient, sender, message):
+        """ Spools a message for `recipient`. Returns 200, or OVERLOADED if the relay is full. """
+        with self.lock:
+            if message_id in self.delivered or message_id in self.spool.pending:
+                return 200  # a retry
+            if len(self.spool.pending) >= self.capacity or \
+                    len(self.mailboxes.get(recipient, ())) >= self.per_recipient:
+                logger.info('relay full: refused message for <%s>.', recipient)
+                return messaging.OVERLOADED
+            record = self.spool.add(message_id, recipient, self.sealer.seal(sender, message),
+                                    wait=False)
+            self.index(message_id, recipient)
+            self.lock.notify_all()
+        self.spool.wait(record)
+        held_total.inc()
+        logger.debug('holding message %x for <%s>.', message_id, recipient)
+        return 200
+
+    def remove(self, message_id, recipient, delivered=True):
+        with self.lock:
+            mailbox = self.mailboxes.get(recipient)
+            if mailbox is None or mailbox.pop(message_id, False) is False:
+                return
+            self.digests[recipient] ^= hash_id(message_id)
+            if not mailbox:
+                del self.mailboxes[recipient]
+                del self.digests[recipient]
+                self.due.pop(recipient, None)
+            if delivered:
+                # siblings still holding it will drop it at the next sync
+                self.delivered[message_id] = recipient
+                while len(self.delivered) > self.tombstones:
+                    self.delivered.popitem(last=False)
+        self.spool.done(message_id)
+
+    def wake(self, ip):
+        """ Forwards right away the messages held for `ip`, which just connected. """
+        if ip not in self.mailboxes:
+            return
+        with self.lock:
+            if ip in self.due:
+                self.due[ip] = (time.monotonic(), self.due[ip][1])
+                self.lock.notify_all()
+
+    def back_off(self, recipient):
+        with self.lock:
+            if recipient in self.due:
+                delay = self.due[recipient][1]
+                self.due[recipient] = (time.monotonic() + delay,
+                                       min(2 * delay, self.max_retry_interval))
+
+    def start(self):
+        logger.info('relay started.')
+        last_sync = last_purge = time.monotonic()
+        while not self.stop.is_set():
+            now = time.monotonic()
+            with self.lock:
+                for recipient, (when, _) in self.due.items():
+                    if when <= now and recipient not in self.forwarding:
+                        self.forwarding.add(recipient)
+                        self.pool.submit(self.forward_due, recipient)
+            if self.siblings and now - last_sync >= self.sync_interval:
+                for sibling in self.siblings:
+                    self.sync_with(sibling)
+                last_sync = now
+            if now - last_purge >= 3600:
+                self.purge()
+                last_purge = now
+            with self.lock:
+                timeouts = [when for r, (when, _) in self.due.items() if r not in self.forwarding]
+                timeout = min([self.poll_interval] + [t - time.monotonic() for t in timeouts])
+                if timeout > 0:
+                    self.lock.wait(timeout)
+        self.pool.shutdown(wait=False)
+        logger.info('stop set. Relay is shutting down.')
+
+    def connect(self, peer):
+        conn = socket.create_connection((peer, messaging.SUS_MESSAGES_PORT), self.connect_timeout)
+        if self.tls is None or not self.tls.wanted(peer):
+            return conn
+        try:
+            return self.tls.wrap(conn, peer)
+        except tls.Refused:
+            return socket.create_connection((peer, messaging.SUS_MESSAGES_PORT),
+                                            self.connect_timeout)
+
+    def forward_due(self, recipient):
+        try:
+            self.forward(recipient)
+        finally:
+            with self.lock:
+                self.forwarding.discard(recipient)
+                self.lock.notify_all()
+
+    def forward(self, recipient):
+        """ Hands `recipient` the messages held for it, backing off if it's unreachable. """
+        try:
+            conn = self.connect(recipient)
+        except socket.error as exc:
+            logger.debug('<%s> still unreachable: %s.', recipient, exc)
+            self.back_off(recipient)
+            return
+        with conn:
+            while not self.stop.is_set():
+                with self.lock:
+                    ids = list(itertools.islice(self.mailboxes.get(recipient, ()),
+                                                self.forward_count))
+                if not ids:
+                    return
+                entries = []
+                for message_id in ids:
+                    try:
+                        sender, message = self.sealer.unseal(self.spool.pending[message_id][1])
+                    except (KeyError, ValueError) as exc:
+                        logger.info('dropped held message %x: %s.', message_id, exc)
+                        self.remove(message_id, recipient, delivered=False)
+                        continue
+                    entries.append((message_id, '\n'.join([sender, message]).encode('utf-8')))
+                if not entries:
+                    continue
+                try:
+                    statuses = exchange(conn, frames.FORWARD,
+                                        frames.batch_payload([e for _, e in entries],
+                                                             [i for i, _ in entries]),
+                                        frames.MESSAGE_IDS).split()
+                except (socket.error, frames.FrameError) as exc:
+                    logger.info('could not forward messages to <%s>: %s.', recipient, exc)
+                    self.back_off(recipient)
+                    return
+                delivered = 0
+                for (message_id, _), status in zip(entries, statuses):
+                    if status == b'200':
+                        self.remove(message_id, recipient)
+                        delivered += 1
+                forwarded_total.inc(delivered)
+                logger.info('forwarded %d held message(s) to <%s>.', delivered, recipient)
+                if delivered < len(entries):
+                    self.back_off(recipient)  # it's overloaded
+                    return
+
+    def purge(self):
+        """ Drops the messages held for longer than `retention`. """
+        oldest = time.time() - self.retention
+        expired = 0
+        for message_id, (recipient, sealed) in self.spool.snapshot():
+            try:
+                if self.sealer.sealed_at(sealed) >= oldest:
+                    continue
+            except ValueError:
+                pass
+            self.remove(message_id, recipient, delivered=False)
+            expired += 1
+        if expired:
+            expired_total.inc(expired)
+            logger.info('dropped %d held message(s) older than %d seconds.', expired,
+                        self.retention)
+
+    def sync_with(self, sibling):
+        """ Pulls from `sibling` the messages we miss, and drops the ones it delivered. """
+        pulled = dropped = 0
+        try:
+            with self.connect(sibling) as conn:
+                with self.lock:
+                    digests = {r: '{:016x}'.format(d) for r, d in self.digests.items()}
+                response = json.loads(str(exchange(
+                    conn, frames.SYNC, json.dumps({'digests': digests}).encode('utf-8')), 'utf-8'))
+                for message_id, recipient in response['delivered']:
+                    if message_id in self.spool.pending:
+                        self.remove(message_id, recipient)
+                        dropped += 1
+                with self.lock:
+                    wanted = [message_id for ids in response['held'].values() for message_id in ids
+                              if message_id not in self.spool.pending and
+                              message_id not in self.delivered]
+                for start in range(0, len(wanted), self.forward_count):
+                    request = {'want': wanted[start:start + self.forward_count]}
+                    response = json.loads(str(exchange(
+                        conn, frames.SYNC, json.dumps(request).encode('utf-8')), 'utf-8'))
+                    for message_id, recipient, sender, message in response['messages']:
+                        if self.hold(message_id, recipient, sender, message) != 200:
+                            return
+                        pulled += 1
+        except (socket.error, frames.FrameError, ValueError, TypeError, KeyError,
+                AttributeError) as exc:
+            logger.info('could not sync with relay <%s>: %s.', sibling, exc)
+            return
+        finally:
+            if pulled or dropped:
+                logger.info('synced with relay <%s>: pulled %d message(s), dropped %d.',
+                            sibling, pulled, dropped)
+
+    def handle_sync(self, request):
+        """ Answers the SYNC `request` of a sibling, returning the JSON response.
+
+        Raises frames.FrameError if the request is malformed.
+        """
+        try:
+            request = json.loads(frames.text(request))
+            theirs = request.get('digests')
+            if theirs is None:
+                wanted = [int(message_id) for message_id in request['want'][:self.forward_count]]
+            else:
+                theirs = {str(r): str(digest) for r, digest in theirs.items()}
+        except (ValueError, TypeError, KeyError, AttributeError) as exc:
+            raise frames.FrameError('bad SYNC request: {}'.format(exc))
+        if theirs is not None:
+            with self.lock:
+                differing = {r for r in set(theirs) | set(self.digests)
+                             if theirs.get(r) != '{:016x}'.format(self.digests.get(r, 0))}
+                response = {
+                    'held': {r: list(self.mailboxes.get(r, ())) for r in differing},
+                    'delivered': [[message_id, r] for message_id, r in self.delivered.items()
+                                  if r in differing],
+                }
+        else:
+            messages = []
+            for message_id in wanted:
+                try:
+                    recipient, sealed = self.spool.pending[message_id]
+                    sender, message = self.sealer.unseal(sealed)
+                except (KeyError, ValueError):
+                    continue  # delivered in the meantime
+                messages.append([message_id, recipient, sender, message])
+            response = {'messages': messages}
+        return json.dumps(response)
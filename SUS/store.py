@@ -0,0 +1,400 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" On-disk storage: message history and outbox spool.
+
+MessageStore appends messages to segment files (<first record number>.log),
+each with an index file (.idx) of fixed-size entries: timestamp, CRC32 of
+the peer and offset of the record in the segment. Queries memory-map both,
+binary search the index by time and only touch the matching records.
+
+OutboxSpool is a write-ahead log of the messages still to be sent, replayed
+when the daemon starts.
+"""
+
+
+import collections
+import datetime
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+
+logger = logging.getLogger('store')
+
+
+RECORD = struct.Struct('!IdBH')  # message length, timestamp, direction, peer length
+INDEX = struct.Struct('!dIQ')    # timestamp, crc32 of peer, offset of the record
+
+INCOMING = 0
+OUTGOING = 1
+
+
+StoredMessage = collections.namedtuple('StoredMessage', ['timestamp', 'direction', 'peer', 'message'])
+
+
+class MessageStore:
+    """ Segmented append-only message log.
+
+    A new segment is started once the current one exceeds `segment_size`
+    bytes; only the newest `max_segments` segments are kept.
+    """
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, max_segments=64):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.log = None
+        self.index = None
+        self.records = 0  # records in the store, names new segments
+        self.last_timestamp = 0
+
+    def segments(self):
+        """ Returns the paths of the segments, oldest first, without extension. """
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name[:-len('.log')] for name in os.listdir(self.directory)
+                 if re.match(r'^\d{20}\.log$', name)]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def open(self):
+        """ Opens the newest segment for appending, recovering from partial writes. """
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        if not segments:
+            self.rotate()
+            return
+        path = segments[-1]
+        with open(path + '.idx', 'ab') as index:
+            entries = index.tell() // INDEX.size
+        end = 0  # of the last record whole in the log
+        with open(path + '.idx', 'rb') as index:
+            while entries > 0:
+                index.seek((entries - 1) * INDEX.size)
+                timestamp, _, offset = INDEX.unpack(index.read(INDEX.size))
+                record_end = self.record_end_at(path + '.log', offset)
+                if record_end is not None:
+                    self.last_timestamp, end = timestamp, record_end
+                    break
+                entries -= 1  # the record of this entry was torn
+        with open(path + '.idx', 'ab') as index:
+            index.truncate(entries * INDEX.size)
+        self.records = int(os.path.basename(path)) + entries
+        self.log = open(path + '.log', 'ab')
+        self.index = open(path + '.idx', 'ab')
+        # drop a record whose index entry wasn't written, or that was torn
+        self.log.truncate(end)
+        self.log.seek(0, os.SEEK_END)  # truncating doesn't move tell(), which gives offsets
+
+    @staticmethod
+    def record_end_at(path, offset):
+        """ Where the record at `offset` ends, or None if it isn't all in the log. """
+        with open(path, 'rb') as log:
+            log.seek(offset)
+            header = log.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return None
+            length, _, _, peer_length = RECORD.unpack(header)
+            end = offset + RECORD.size + peer_length + length
+            return end if os.fstat(log.fileno()).st_size >= end else None
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.index.close()
+                self.log = self.index = None
+
+    def append(self, direction, peer, message):
+        peer = peer.encode('utf-8')
+        message = message.encode('utf-8')
+        with self.lock:
+            if self.log is None:
+                self.open()
+            elif self.log.tell() >= self.segment_size:
+                self.rotate()
+            # timestamps never go backwards, so that the index stays sorted
+            timestamp = self.last_timestamp = max(time.time(), self.last_timestamp)
+            offset = self.log.tell()
+            self.log.write(b''.join([
+                RECORD.pack(len(message), timestamp, direction, len(peer)), peer, message
+            ]))
+            self.log.flush()
+            self.index.write(INDEX.pack(timestamp, zlib.crc32(peer), offset))
+            self.index.flush()
+            self.records += 1
+
+    def rotate(self):
+        if self.log is not None:
+            self.log.close()
+            self.index.close()
+        path = os.path.join(self.directory, '{:020d}'.format(self.records))
+        self.log = open(path + '.log', 'ab')
+        self.index = open(path + '.idx', 'ab')
+        logger.info('started message store segment %s.', path)
+        self.compact()
+
+    def compact(self):
+        """ Deletes the oldest segments, keeping `max_segments` of them. """
+        for path in self.segments()[:-self.max_segments]:
+            for extension in ('.log', '.idx'):
+                try:
+                    os.remove(path + extension)
+                except FileNotFoundError:
+                    pass
+            logger.info('removed message store segment %s.', path)
+
+    def history(self, peer=None, since=None, count=None):
+        """ Returns the newest `count` messages exchanged with `peer` after `since`.
+
+        Messages are in chronological order; segments are scanned newest first
+        and the scan stops as soon as `count` messages are found.
+        """
+        found = []
+        for path in reversed(self.segments()):
+            for stored in self.scan_segment(path, peer, since):
+                found.append(stored)
+                if count is not None and len(found) >= count:
+                    return found[::-1]
+            if since is not None and self.segment_starts_before(path, since):
+                break
+        return found[::-1]
+
+    @staticmethod
+    def segment_starts_before(path, since):
+        with open(path + '.idx', 'rb') as index:
+            first = index.read(INDEX.size)
+        return len(first) == INDEX.size and INDEX.unpack(first)[0] < since
+
+    @staticmethod
+    def scan_segment(path, peer, since):
+        """ Yields the matching messages in one segment, newest first. """
+        peer_bytes = peer.encode('utf-8') if peer is not None else None
+        peer_crc = zlib.crc32(peer_bytes) if peer is not None else None
+        try:
+            index_file = open(path + '.idx', 'rb')
+            log_file = open(path + '.log', 'rb')
+        except FileNotFoundError:
+            return  # removed by compaction
+        with index_file, log_file:
+            entries = os.fstat(index_file.fileno()).st_size // INDEX.size
+            log_size = os.fstat(log_file.fileno()).st_size
+            if entries == 0 or log_size == 0:
+                return
+            with mmap.mmap(index_file.fileno(), entries * INDEX.size, access=mmap.ACCESS_READ) as index, \
+                    mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                first = 0
+                if since is not None:
+                    # binary search the first entry not older than `since`
+                    low, high = 0, entries
+                    while low < high:
+                        middle = (low + high) // 2
+                        if INDEX.unpack_from(index, middle * INDEX.size)[0] < since:
+                            low = middle + 1
+                        else:
+                            high = middle
+                    first = low
+                for entry in range(entries - 1, first - 1, -1):
+                    timestamp, crc, offset = INDEX.unpack_from(index, entry * INDEX.size)
+                    if peer_crc is not None and crc != peer_crc:
+                        continue
+                    if offset + RECORD.size > len(log):
+                        continue  # being written right now
+                    length, _, direction, peer_length = RECORD.unpack_from(log, offset)
+                    start = offset + RECORD.size
+                    stored_peer = log[start:start + peer_length]
+                    if peer_bytes is not None and stored_peer != peer_bytes:
+                        continue  # CRC collision
+                    start += peer_length
+                    yield StoredMessage(timestamp, direction, stored_peer.decode('utf-8'),
+                                        log[start:start + length].decode('utf-8', 'replace'))
+
+
+def parse_duration(duration):
+    """ Parses "30s", "10m", "2h" or "7d" into seconds. Raises ValueError. """
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd])$', duration.strip())
+    if not match:
+        raise ValueError('invalid duration: {}'.format(duration))
+    return float(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+
+
+def parse_since(since):
+    """ Parses "30s", "10m", "2h", "7d" (ago) or an ISO date into a timestamp. """
+    try:
+        return time.time() - parse_duration(since)
+    except ValueError:
+        return datetime.datetime.fromisoformat(since.strip()).timestamp()
+
+
+SPOOL_RECORD = struct.Struct('!BQHI')  # kind, message id, recipient length, message length
+
+SPOOL_ADD = 1
+SPOOL_DONE = 2
+
+
+class OutboxSpool:
+    """ Write-ahead log of the messages waiting to be sent.
+
+    add() returns once the message is on disk. fsyncs are group-committed
+    by start(): every fsync covers all the messages added while the
+    previous one was running, or during the last `sync_interval` seconds
+    if that's greater than 0, trading latency for fewer fsyncs.
+
+    The spool is rewritten with just the pending messages once it's over
+    `compact_size` bytes and at least half of it is records of messages
+    already done, so that rewriting it costs as much as what it frees.
+    """
+    def __init__(self, path, sync_interval=0, compact_size=1024 * 1024):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_size = compact_size
+        self.file = None
+        self.pending = collections.OrderedDict()  # message id -> (recipient, message)
+        self.live = 0  # bytes of the records of the pending messages
+        self.written = 0  # records written
+        self.synced = 0   # records known to be on disk
+        self.synced_changed = threading.Condition(threading.Lock())
+        self.stop = threading.Event()
+
+    def open(self):
+        """ Replays the spool; returns the (id, recipient, message) still to be sent. """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as spool:
+                data = spool.read()
+            offset = 0
+            while offset + SPOOL_RECORD.size <= len(data):
+                kind, message_id, recipient_length, message_length = \
+                    SPOOL_RECORD.unpack_from(data, offset)
+                start = offset + SPOOL_RECORD.size
+                end = start + recipient_length + message_length
+                if end > len(data):
+                    break  # torn write
+                if kind == SPOOL_ADD:
+                    recipient = data[start:start + recipient_length].decode('utf-8')
+                    message = data[start + recipient_length:end].decode('utf-8')
+                    self.pending[message_id] = (recipient, message)
+                else:
+                    self.pending.pop(message_id, None)
+                offset = end
+        self.compact()
+        logger.info('outbox spool has %d messages to send.', len(self.pending))
+        return [(message_id, r, m) for message_id, (r, m) in self.pending.items()]
+
+    def add(self, message_id, recipient, message, wait=True):
+        """ Spools a message; if `wait`, returns once it's on disk. Returns its record number. """
+        recipient_bytes = recipient.encode('utf-8')
+        message_bytes = message.encode('utf-8')
+        with self.synced_changed:
+            if message_id in self.pending:
+                self.live -= self.record_size(*self.pending[message_id])
+            self.pending[message_id] = (recipient, message)
+            self.file.write(b''.join([
+                SPOOL_RECORD.pack(SPOOL_ADD, message_id, len(recipient_bytes), len(message_bytes)),
+                recipient_bytes, message_bytes
+            ]))
+            self.live += SPOOL_RECORD.size + len(recipient_bytes) + len(message_bytes)
+            self.written += 1
+            record = self.written
+            self.synced_changed.notify_all()
+        if wait:
+            self.wait(record)
+        return record
+
+    def snapshot(self):
+        """ The (id, (recipient, message)) pairs of the pending messages, as a list. """
+        with self.synced_changed:
+            return list(self.pending.items())
+
+    def done(self, message_id):
+        """ Marks a message as sent (or given up). Doesn't wait for the disk. """
+        with self.synced_changed:
+            done = self.pending.pop(message_id, None)
+            if done is None:
+                return
+            self.live -= self.record_size(*done)
+            self.file.write(SPOOL_RECORD.pack(SPOOL_DONE, message_id, 0, 0))
+            self.written += 1
+            self.synced_changed.notify_all()
+
+    def wait(self, record):
+        """ Blocks until `record` is on disk. """
+        with self.synced_changed:
+            while self.synced < record and not self.stop.is_set():
+                self.synced_changed.wait(0.5)
+
+    def wake(self):
+        with self.synced_changed:
+            self.synced_changed.notify_all()
+
+    def start(self):
+        """ Group-commits the spool until stopped. """
+        logger.info('outbox spool started (%s).', self.path)
+        while not self.stop.is_set():
+            with self.synced_changed:
+                while self.written == self.synced and not self.stop.is_set():
+                    self.synced_changed.wait(0.5)
+            if self.sync_interval > 0:
+                self.stop.wait(self.sync_interval)
+            self.sync()
+            with self.synced_changed:
+                if self.file.tell() > max(self.compact_size, 2 * self.live):
+                    self.compact()
+        self.sync()
+        with self.synced_changed:
+            self.file.close()
+            self.synced_changed.notify_all()
+        logger.info('stop set. Outbox spool is shutting down.')
+
+    def sync(self):
+        with self.synced_changed:
+            self.file.flush()
+            written = self.written
+        os.fsync(self.file.fileno())
+        with self.synced_changed:
+            self.synced = max(self.synced, written)
+            self.synced_changed.notify_all()
+
+    @staticmethod
+    def record_size(recipient, message):
+        return SPOOL_RECORD.size + len(recipient.encode('utf-8')) + len(message.encode('utf-8'))
+
+    def compact(self):
+        """ Rewrites the spool with just the pending messages. Call holding the lock. """
+        if self.file is not None:
+            self.file.close()
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as spool:
+            for message_id, (recipient, message) in self.pending.items():
+                recipient = recipient.encode('utf-8')
+                message = message.encode('utf-8')
+                spool.write(b''.join([
+                    SPOOL_RECORD.pack(SPOOL_ADD, message_id, len(recipient), len(message)),
+                    recipient, message
+                ]))
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.replace(temporary, self.path)
+        self.file = open(self.path, 'ab')
+        self.live = self.file.tell()
+        self.synced = self.written
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" TLS for connections between peers, for `SUS start --tls`.
+
+Connections start in plaintext on the messages port: a sender that wants
+TLS sends a STARTTLS frame first, and shakes hands once the receiver
+acknowledged it. Peers that don't speak TLS close the connection instead,
+and are sent plaintext for a while: TLS is opportunistic.
+
+Handshakes are rare. Connections are kept open and reused for many
+messages (see messaging.PeerConnectionPool), and a new connection to a
+peer resumes the session of the previous one (with a session ticket),
+which skips the certificate exchange and its public key operations.
+"""
+
+
+import logging
+import socket
+import ssl
+import time
+import weakref
+import frames
+import metrics
+
+
+logger = logging.getLogger('tls')
+
+handshakes_total = metrics.registry.counter('sus_tls_handshakes_total',
+                                            'TLS handshakes with peers, as their client.')
+resumed_total = metrics.registry.counter('sus_tls_resumed_total',
+                                         'TLS handshakes that resumed a previous session.')
+
+
+class Refused(Exception):
+    """ The peer didn't switch the connection to TLS. """
+
+
+def server_context(cert, key):
+    """ The context of TLS connections accepted by the inbox. """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def client_context(ca=None):
+    """ The context of TLS connections to peers.
+
+    Peers' certificates are only verified with `ca`, a file of trusted
+    certificates; peers are known by IP, so host names aren't checked.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.check_hostname = False
+    if ca is None:
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context.load_verify_locations(ca)
+    return context
+
+
+class ClientTLS:
+    """ Switches connections to peers to TLS, resuming their last session. """
+    def __init__(self, context, plaintext_recheck=600):
+        self.context = context
+        self.plaintext_recheck = plaintext_recheck
+        self.sessions = {}  # peer -> ssl.SSLSession of its last connection
+        self.plaintext_peers = {}  # peer -> when it refused to switch to TLS
+        self.remembered = weakref.WeakSet()  # connections whose session was kept
+
+    def wanted(self, peer):
+        """ False if `peer` recently refused to switch to TLS. """
+        refused = self.plaintext_peers.get(peer)
+        if refused is None:
+            return True
+        if time.monotonic() - refused > self.plaintext_recheck:
+            self.plaintext_peers.pop(peer, None)
+            return True
+        return False
+
+    def wrap(self, conn, peer):
+        """ Switches new connection `conn` to `peer` to TLS; returns the TLS socket.
+
+        Raises Refused, having closed `conn`, if the peer doesn't speak TLS.
+        """
+        try:
+            conn.sendall(frames.pack(frames.STARTTLS, b''))
+            ack = frames.recv_frame(conn)
+            if ack.type != frames.ACK or ack.payload != b'200':
+                raise frames.FrameError('STARTTLS refused')
+            # TLS records are small: don't let Nagle hold them for a delayed ACK
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self.context.wrap_socket(conn, session=self.sessions.get(peer))
+        except (socket.error, frames.FrameError) as exc:
+            conn.close()
+            if isinstance(exc, ssl.SSLCertVerificationError):
+                raise  # it does speak TLS: don't fall back to plaintext
+            logger.info('<%s> did not switch to TLS: %s.', peer, exc)
+            self.plaintext_peers[peer] = time.monotonic()
+            raise Refused(peer)
+        handshakes_total.inc()
+        if conn.session_reused:
+            resumed_total.inc()
+        return conn
+
+    def remember(self, peer, conn):
+        """ Keeps the session of `conn` to `peer`, for the next connection to resume.
+
+        Only the first call for a connection counts: getting a session is
+        surprisingly slow, and its ticket doesn't change.
+        """
+        if not isinstance(conn, ssl.SSLSocket) or conn in self.remembered:
+            return
+        session = conn.session
+        if session is not None:  # TLS 1.3 tickets only arrive with the first data received
+            self.sessions[peer] = session
+            self.remembered.add(conn)
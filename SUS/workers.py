@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Inbox worker processes, for `SUS start --inbox-workers N`.
+
+Every worker binds the messages port with SO_REUSEPORT next to the
+daemon's own InboxServer, so that the kernel spreads incoming connections
+among them. Workers accept, read, parse and acknowledge messages on their
+own core, and send them in batches through a pipe to the daemon, whose
+inbox recognizes duplicates (a retry may reach another worker), queues
+and stores them.
+
+Workers leave a full pipe, and with it their own incoming queue, to apply
+backpressure as the daemon's inbox would. Their log records travel to the
+daemon through a queue.
+"""
+
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import messaging
+import tls
+
+
+logger = logging.getLogger('workers')
+
+
+def reuse_port_available():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+class ForwardingInbox(messaging.InboxServer):
+    """ An InboxServer handing the messages it receives to the daemon through `pipe`. """
+    def __init__(self, pipe, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipe = pipe
+
+    def handle_message(self, message, sender, block=True, message_id=None):
+        if not messaging.incoming_messages.put((sender, message, message_id), block):
+            return messaging.OVERLOADED
+        return 200
+
+    def forward(self, poll_interval=0.5):
+        while not self.stop.is_set():
+            batch = messaging.incoming_messages.drain(max_items=256, timeout=poll_interval)
+            if batch:
+                self.pipe.send(batch)
+
+
+def watch_silence_list(silenced, stop, interval=1):
+    """ Reloads `silenced` whenever the daemon's shell edits its file. """
+    modified = None
+    while not stop.wait(interval):
+        try:
+            mtime = os.stat(silenced.path).st_mtime
+        except OSError:
+            continue
+        if mtime != modified:
+            modified = mtime
+            silenced.load()
+
+
+def work(index, args, pipe, log_queue, log_level, port, silence_path, tls_files, relays):
+    """ Body of worker process `index`: serves the inbox until terminated. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the daemon decides when workers stop
+    logging.root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    logging.root.setLevel(log_level)
+    messaging.SUS_MESSAGES_PORT = port
+    messaging.incoming_messages.capacity = args.incoming_capacity or None
+    messaging.incoming_messages.policy = args.incoming_policy
+    limiter = None
+    if args.inbox_rate > 0:
+        limiter = messaging.RateLimiter(args.inbox_rate, args.inbox_burst or None)
+    stop = threading.Event()
+    silenced = messaging.SilenceList(silence_path)
+    inbox = ForwardingInbox(
+        pipe, ip=args.ip, limiter=limiter, backlog=args.backlog, silenced=silenced,
+        admission=messaging.Admission(args.max_connections, args.max_connections_per_ip or None),
+        reuse_port=True, tls=tls.server_context(*tls_files) if tls_files is not None else None,
+        relays=relays,
+    )
+    inbox.stop = stop
+    threading.Thread(target=inbox.forward, name='Forward', daemon=True).start()
+    if silence_path is not None:
+        threading.Thread(target=watch_silence_list, args=(silenced, stop), name='SilenceWatch',
+                         daemon=True).start()
+    logger.info('inbox worker %d started (pid %d).', index, os.getpid())
+    if args.async_io:
+        messaging.listen_async([inbox], stop)
+    else:
+        inbox.listen()
+
+
+def collect(inbox, pipe, stop, poll_interval=0.5):
+    """ Delivers to `inbox` the messages a worker sends through `pipe`, waiting for room. """
+    while not stop.is_set():
+        try:
+            if not pipe.poll(poll_interval):
+                continue
+            batch = pipe.recv()
+        except (EOFError, OSError):
+            logger.info('an inbox worker exited.')
+            return
+        for sender, message, message_id in batch:
+            # the worker acknowledged the message already: rather than lose it, hold
+            # the pipe until there's room, so that the worker refuses new messages
+            while inbox.deliver(message, sender, message_id=message_id) != 200:
+                if stop.is_set():
+                    return
+                messaging.incoming_messages.wait_for_room(poll_interval)
+
+
+def relay_logs(log_queue):
+    while True:
+        record = log_queue.get()
+        if record is None:
+            return
+        logging.getLogger(record.name).handle(record)
+
+
+def start_workers(count, args, inbox, stop, silence_path=None, tls_files=None, relays=()):
+    """ Starts `count` worker processes sharing the messages port with `inbox`.
+
+    `inbox` must have been bound with reuse_port; its messages are
+    delivered by one thread per worker. Returns the processes.
+    """
+    context = multiprocessing.get_context('spawn')  # forking a threaded process isn't safe
+    log_queue = context.Queue()
+    threading.Thread(target=relay_logs, args=(log_queue,), name='WorkerLogs',
+                     daemon=True).start()
+    processes = []
+    for index in range(count):
+        receiving, sending = context.Pipe(duplex=False)
+        process = context.Process(
+            target=work, name='InboxWorker-{}'.format(index), daemon=True,
+            args=(index, args, sending, log_queue, logging.root.getEffectiveLevel(),
+                  messaging.SUS_MESSAGES_PORT, silence_path, tls_files, relays),
+        )
+        process.start()
+        sending.close()
+        threading.Thread(target=collect, args=(inbox, receiving, stop),
+                         name='Collect-{}'.format(index), daemon=True).start()
+        processes.append(process)
+    return processes
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Compares the codecs in frames on typical messages.
+
+For every sample message and codec, reports the bytes a MESSAGE frame
+takes on the wire (as frames.compress would send it, so that messages
+under the threshold or that don't shrink are sent as they are) and the
+CPU time taken to compress and decompress it.
+
+    python3 benchmarks/compression.py [-t THRESHOLD] [--json]
+"""
+
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import traceback
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SUS'))
+import frames
+
+
+def stack_trace():
+    # alternating between two functions, so that traceback doesn't collapse repeated lines
+    def parse(depth):
+        if depth == 0:
+            raise ValueError('invalid literal for int() with base 10: \'abc\'')
+        evaluate(depth - 1)
+
+    def evaluate(depth):
+        parse(depth - 1)
+    try:
+        parse(40)
+    except ValueError:
+        return traceback.format_exc()
+
+
+def log_excerpt(lines=200):
+    generator = random.Random(42)
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING']
+    modules = ['messaging', 'SUSd', 'store', 'frames']
+    line = '{}|2017-04-14 13:{:02d}:{:02d},{:03d}|{} L{}:   connected to 192.168.1.{}:{}.'
+    return '\n'.join(line.format(
+        generator.choice(levels), i // 60 % 60, i % 60, generator.randrange(1000),
+        generator.choice(modules), generator.randrange(1, 900), generator.randrange(2, 254),
+        generator.randrange(30000, 60000)) for i in range(lines))
+
+
+SAMPLES = [
+    ('chat line', 'are you coming to lunch? :)'),
+    ('stack trace', stack_trace()),
+    ('log excerpt', log_excerpt()),
+    ('random base64', base64.b64encode(random.Random(7).randbytes(12000)).decode()),
+]
+
+
+def timed(function, argument, duration=0.2):
+    """ Seconds per call of function(argument), averaged over ~`duration` seconds. """
+    calls = 0
+    start = time.process_time()
+    while True:
+        function(argument)
+        calls += 1
+        elapsed = time.process_time() - start
+        if elapsed >= duration:
+            return elapsed / calls
+
+
+def measure(text, codec, threshold):
+    payload = text.encode('utf-8')
+    wire, flags = frames.compress(payload, codec, threshold)
+    result = {
+        'bytes': len(payload),
+        'wire_bytes': frames.HEADER.size + len(wire),
+        'compressed': flags != 0,
+        'compress_us': None,
+        'decompress_us': None,
+    }
+    if codec is not None:
+        compress = lambda p: frames.compress(p, codec, threshold)
+        result['compress_us'] = round(timed(compress, payload) * 1e6, 1)
+        frame = frames.Frame(frames.MESSAGE, flags, 0, wire)
+        result['decompress_us'] = round(timed(frames.decoded_payload, frame) * 1e6, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='compression.py')
+    parser.add_argument('-t', '--threshold', help='as `SUS start --compress-threshold`.',
+                        type=int, default=1024)
+    parser.add_argument('--json', help='print the results as one JSON line.', action='store_true')
+    args = parser.parse_args()
+    codecs = [None] + sorted(frames.CODECS.values(), key=lambda c: c.id)
+    results = []
+    for name, text in SAMPLES:
+        for codec in codecs:
+            result = measure(text, codec, args.threshold)
+            result.update(sample=name, codec='none' if codec is None else codec.name)
+            results.append(result)
+    if args.json:
+        print(json.dumps({'threshold': args.threshold, 'results': results}, sort_keys=True))
+        return
+    print('{:<14} {:<6} {:>8} {:>8} {:>7} {:>12} {:>14}'.format(
+        'sample', 'codec', 'bytes', 'on wire', 'ratio', 'compress', 'decompress'))
+    for r in results:
+        print('{:<14} {:<6} {:>8} {:>8} {:>6.0f}% {:>12} {:>14}'.format(
+            r['sample'], r['codec'], r['bytes'], r['wire_bytes'],
+            100 * r['wire_bytes'] / (r['bytes'] + frames.HEADER.size),
+            '-' if r['compress_us'] is None else '{:.1f} µs'.format(r['compress_us']),
+            '-' if r['decompress_us'] is None or not r['compressed']
+            else '{:.1f} µs'.format(r['decompress_us'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Loads a SUS daemon running on loopback and measures how it copes.
+
+The daemon runs SUSd.run in a child process, on random ports and with its
+data in a temporary directory, so it doesn't get in the way of a SUS
+already running. Every 127.0.0.x address reaches it, so `--peers` spreads
+the messages over as many recipients.
+
+Scenarios:
+
+    end-to-end  every sender streams `send` commands to the shell; latency
+                is from writing the command to the daemon printing the
+                message it received from itself (shell, spool, outbox, inbox).
+    inbox       every sender sends framed messages straight to the inbox,
+                one at a time; latency is from sending a frame to its ack.
+
+Reports messages per second, latency percentiles, and the CPU time and
+peak RSS of the daemon. `--json` prints a single JSON line instead, to be
+appended to a file and compared across commits:
+
+    python3 benchmarks/loopback.py -s 4 -n 20000 --size 200 --json >> bench.jsonl
+
+Options after `--` are passed to the daemon, as they would be to `SUS start`.
+"""
+
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+SUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SUS')
+sys.path.insert(0, SUS_DIR)
+
+RECEIVED = re.compile(r'SUS> \S+: bench (\d+) (\d+)')  # senders may show by nickname
+
+
+def serve(args, daemon_arguments):
+    """ Runs the daemon; the benchmark runs this in a child process. """
+    import client
+    import messaging
+    import main
+    import SUSd
+    messaging.SUS_MESSAGES_PORT = args.messages_port
+    SUSd.SUSD_SHELL_PORT = client.SUSD_SHELL_PORT = args.shell_port
+    SUSd.SUS_DIR = client.SUS_DIR = args.sus_dir
+    main.LOGGING['handlers']['file']['filename'] = os.path.join(args.sus_dir, 'SUS.log')
+    daemon_args = main.start_arguments().parse_args(['-n'] + daemon_arguments)
+    main.setup_logging(daemon_args.log_level, daemon_args.log_max_bytes, daemon_args.log_backups)
+    signal.signal(signal.SIGTERM, SUSd.close)
+    SUSd.run(daemon_args)
+
+
+class Daemon:
+    """ A SUSd.run child process. """
+    def __init__(self, daemon_arguments):
+        self.sus_dir = tempfile.mkdtemp(prefix='SUS-bench-')
+        base = random.randint(20000, 60000)
+        self.messages_port = base
+        self.shell_port = base + 1
+        self.process = subprocess.Popen(
+            [sys.executable, '-u', os.path.abspath(__file__), '--serve',
+             '--messages-port', str(self.messages_port), '--shell-port', str(self.shell_port),
+             '--sus-dir', self.sus_dir, '--'] + daemon_arguments,
+            stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        self.received = {}  # message number -> ns from its sending to the daemon printing it
+        self.everything_received = threading.Event()
+        self.expected = None
+        self.reader = threading.Thread(target=self.read_stdout, name='Stdout', daemon=True)
+        self.reader.start()
+        self.wait_for_shell()
+
+    def wait_for_shell(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.shell_port), timeout=1).close()
+                return
+            except socket.error:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError('the daemon did not start')
+                time.sleep(0.05)
+
+    def read_stdout(self):
+        for line in self.process.stdout:
+            match = RECEIVED.search(line)
+            if match is None:
+                continue
+            self.received[int(match.group(1))] = time.monotonic_ns() - int(match.group(2))
+            if self.expected is not None and len(self.received) >= self.expected:
+                self.everything_received.set()
+
+    def cpu_seconds(self):
+        """ CPU time used so far by the daemon and its inbox workers, or None without /proc. """
+        ticks = None
+        try:
+            pids = [p for p in os.listdir('/proc') if p.isdigit()]
+        except OSError:
+            return None
+        for pid in pids:
+            try:
+                with open('/proc/{}/stat'.format(pid)) as stat:
+                    fields = stat.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue  # exited meanwhile
+            if int(pid) == self.process.pid or int(fields[1]) == self.process.pid:
+                ticks = (ticks or 0) + int(fields[11]) + int(fields[12])
+        return None if ticks is None else ticks / os.sysconf('SC_CLK_TCK')
+
+    def peak_rss(self):
+        """ Peak resident memory of the daemon in bytes, or None where /proc isn't available. """
+        try:
+            with open('/proc/{}/status'.format(self.process.pid)) as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.sus_dir, ignore_errors=True)
+
+
+def message(number, size):
+    text = 'bench {} {} '.format(number, time.monotonic_ns())
+    return text + 'x' * max(0, size - len(text))
+
+
+def end_to_end(daemon, sender, count, args):
+    """ Streams `count` send commands to the shell; returns when they're all accepted. """
+    shell = socket.create_connection(('127.0.0.1', daemon.shell_port))
+    first = sender * count
+
+    def stream():
+        chunk = [b'stream\n']
+        for number in range(first, first + count):
+            recipient = '127.0.0.{}'.format(1 + number % args.peers)
+            chunk.append('send {} {}\n'.format(recipient, message(number, args.size)).encode('utf-8'))
+            if len(chunk) >= 64:
+                shell.sendall(b''.join(chunk))
+                chunk = []
+        shell.sendall(b''.join(chunk))
+        shell.shutdown(socket.SHUT_WR)
+
+    streamer = threading.Thread(target=stream, daemon=True)
+    streamer.start()
+    statuses = shell.makefile('r', encoding='utf-8')
+    statuses.readline()  # OK
+    rejected = sum(1 for status in statuses if status.strip() != '200')
+    streamer.join()
+    shell.close()
+    return [], rejected
+
+
+def inbox(daemon, sender, count, args):
+    """ Sends `count` framed messages to the inbox, one at a time; returns their ack times. """
+    import frames
+    peer = '127.0.0.{}'.format(1 + sender % args.peers)
+    conn = socket.create_connection((peer, daemon.messages_port))
+    latencies = []
+    rejected = 0
+    for number in range(sender * count, (sender + 1) * count):
+        sent = time.monotonic_ns()
+        conn.sendall(frames.pack(frames.MESSAGE, message(number, args.size).encode('utf-8'), number))
+        ack = frames.recv_frame(conn)
+        latencies.append(time.monotonic_ns() - sent)
+        if bytes(ack.payload) != b'200':
+            rejected += 1
+    conn.close()
+    return latencies, rejected
+
+
+SCENARIOS = {'end-to-end': end_to_end, 'inbox': inbox}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(args, daemon_arguments):
+    daemon = Daemon(daemon_arguments)
+    try:
+        per_sender = args.messages // args.senders
+        total = per_sender * args.senders
+        daemon.expected = total
+        cpu_before = daemon.cpu_seconds()
+        results = [None] * args.senders
+
+        def load(sender):
+            results[sender] = SCENARIOS[args.scenario](daemon, sender, per_sender, args)
+
+        senders = [threading.Thread(target=load, args=(s,)) for s in range(args.senders)]
+        start = time.monotonic()
+        for thread in senders:
+            thread.start()
+        for thread in senders:
+            thread.join()
+        accepted = time.monotonic() - start
+        complete = daemon.everything_received.wait(args.timeout)
+        elapsed = time.monotonic() - start
+        cpu_after = daemon.cpu_seconds()
+        peak_rss = daemon.peak_rss()
+    finally:
+        daemon.stop()
+
+    if args.scenario == 'end-to-end':
+        latencies = list(daemon.received.values())
+    else:
+        latencies = [latency for sender_latencies, _ in results for latency in sender_latencies]
+    latencies.sort()
+    return {
+        'commit': git_commit(),
+        'scenario': args.scenario,
+        'senders': args.senders,
+        'peers': args.peers,
+        'size': args.size,
+        'daemon_args': daemon_arguments,
+        'messages': total,
+        'received': len(daemon.received),
+        'rejected': sum(result[1] for result in results if result is not None),
+        'complete': complete,
+        'seconds': round(elapsed, 4),
+        'accept_seconds': round(accepted, 4),
+        'messages_per_second': round(len(daemon.received) / elapsed, 1),
+        'latency_ms': {
+            name: None if value is None else round(value / 1000000, 3)
+            for name, value in [('p50', percentile(latencies, 0.5)),
+                                ('p99', percentile(latencies, 0.99)),
+                                ('p999', percentile(latencies, 0.999)),
+                                ('max', latencies[-1] if latencies else None)]
+        },
+        'cpu_seconds': None if cpu_before is None else round(cpu_after - cpu_before, 3),
+        'peak_rss_bytes': peak_rss,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SUS_DIR,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    print('{} x {} senders, {} peers, {} byte messages{}'.format(
+        report['scenario'], report['senders'], report['peers'], report['size'],
+        ' ({})'.format(' '.join(report['daemon_args'])) if report['daemon_args'] else ''))
+    print('  received    {} of {}{}'.format(report['received'], report['messages'],
+                                          '' if report['complete'] else ' (timed out)'))
+    if report['rejected']:
+        print('  rejected    {}'.format(report['rejected']))
+    print('  throughput  {:.0f} messages/s ({:.2f} s)'.format(report['messages_per_second'],
+                                                             report['seconds']))
+    latency = report['latency_ms']
+    if latency['p50'] is not None:
+        print('  latency     p50 {p50} ms  p99 {p99} ms  p999 {p999} ms  max {max} ms'.format(
+            **latency))
+    if report['cpu_seconds'] is not None:
+        print('  daemon CPU  {:.2f} s ({:.0f}% of one core)'.format(
+            report['cpu_seconds'], 100 * report['cpu_seconds'] / report['seconds']))
+    if report['peak_rss_bytes'] is not None:
+        print('  peak RSS    {:.1f} MiB'.format(report['peak_rss_bytes'] / 1024 / 1024))
+
+
+def main():
+    arguments = sys.argv[1:]
+    daemon_arguments = []
+    if '--' in arguments:
+        split = arguments.index('--')
+        arguments, daemon_arguments = arguments[:split], arguments[split + 1:]
+    parser = argparse.ArgumentParser(prog='loopback.py')
+    parser.add_argument('scenario', nargs='?', choices=sorted(SCENARIOS), default='end-to-end')
+    parser.add_argument('-s', '--senders', help='concurrent senders.', type=int, default=4)
+    parser.add_argument('-n', '--messages', help='messages sent in all.', type=int, default=10000)
+    parser.add_argument('-p', '--peers', help='recipients messages are spread over.',
+                        type=int, default=1)
+    parser.add_argument('--size', help='message size in bytes.', type=int, default=100)
+    parser.add_argument('--timeout', help='seconds to wait for every message to arrive.',
+                        type=float, default=60)
+    parser.add_argument('--json', help='print the results as one JSON line.', action='store_true')
+    parser.add_argument('--serve', help=argparse.SUPPRESS, action='store_true')
+    parser.add_argument('--messages-port', help=argparse.SUPPRESS, type=int)
+    parser.add_argument('--shell-port', help=argparse.SUPPRESS, type=int)
+    parser.add_argument('--sus-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args(arguments)
+    if args.serve:
+        serve(args, daemon_arguments)
+        return
+    report = run(args, daemon_arguments)
+    if args.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
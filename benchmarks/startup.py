@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Measures how long the SUS command line takes to start.
+
+Runs `SUS reply` (which fails fast if the daemon isn't running) and bare
+imports of the client and daemon modules, reporting the median wall time
+of each in milliseconds.
+
+    python3 benchmarks/startup.py [-n RUNS]
+"""
+
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+SUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SUS')
+
+
+CASES = [
+    ('python (baseline)', ['-c', 'pass']),
+    ('import client', ['-c', 'import client']),
+    ('import messaging', ['-c', 'import messaging']),
+    ('import SUSd', ['-c', 'import SUSd']),
+    ('SUS reply', [os.path.join(SUS_DIR, 'main.py'), 'reply', 'benchmark']),
+]
+
+
+def measure(arguments, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable] + arguments, cwd=SUS_DIR,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+        if completed.returncode != 0:
+            return None
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='startup.py')
+    parser.add_argument('-n', '--runs', help='runs per case.', type=int, default=20)
+    args = parser.parse_args()
+    for name, arguments in CASES:
+        median = measure(arguments, args.runs)
+        if median is None:
+            print('{:<20} failed (missing dependencies?)'.format(name))
+        else:
+            print('{:<20} {:8.1f} ms'.format(name, median))
+
+
+if __name__ == '__main__':
+    main()
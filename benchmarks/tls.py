@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Measures what TLS costs per message, compared to plaintext.
+
+An InboxServer accepting TLS runs on loopback, in this process, and
+receives `-n` messages in each scenario:
+
+    plaintext          one connection kept open, as the outbox does
+    tls                one TLS connection kept open
+    plaintext-connect  a new connection per message
+    tls-full           a new TLS connection per message, full handshake
+    tls-resumed        a new TLS connection per message, resuming the
+                       previous connection's session
+
+Reports the wall and CPU time (of client and server together) per
+message. The certificate is made by the openssl command, which must be
+on the PATH.
+
+    python3 benchmarks/tls.py [-n 2000] [--size 100] [--json]
+"""
+
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SUS'))
+import frames
+import messaging
+import tls
+
+
+def make_certificate(directory):
+    cert, key = os.path.join(directory, 'tls.crt'), os.path.join(directory, 'tls.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt',
+                    'ec_paramgen_curve:P-256', '-nodes', '-days', '1', '-subj', '/CN=SUS',
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+
+def drain(stop):
+    while not stop.is_set():
+        messaging.incoming_messages.drain(timeout=0.1)
+
+
+def exchange(conn, payload):
+    message_id = messaging.new_message_id()
+    conn.sendall(frames.pack(frames.MESSAGE, payload, message_id))
+    ack = frames.recv_frame(conn)
+    if ack.type != frames.ACK or ack.message_id != message_id or ack.payload != b'200':
+        raise frames.FrameError('unexpected ack')
+
+
+def send(pool, payload, count, keep_alive, resume):
+    """ Sends `count` messages through `pool`, as the outbox would. """
+    for _ in range(count):
+        if pool.tls is not None and not resume:
+            pool.tls.sessions.clear()
+        conn, _ = pool.acquire('127.0.0.1')
+        exchange(conn, payload)
+        pool.release('127.0.0.1', conn, keep_alive)
+    pool.close_all()
+
+
+def measure(scenario, payload, count):
+    client_tls = None
+    if scenario.startswith('tls'):
+        client_tls = tls.ClientTLS(tls.client_context())
+    pool = messaging.PeerConnectionPool(max_per_peer=1, tls=client_tls)
+    handshakes, resumed = tls.handshakes_total.value, tls.resumed_total.value
+    wall, cpu = time.perf_counter(), time.process_time()
+    send(pool, payload, count, keep_alive=scenario in ('plaintext', 'tls'),
+         resume=scenario != 'tls-full')
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {
+        'scenario': scenario,
+        'wall_us': round(wall / count * 1e6, 1),
+        'cpu_us': round(cpu / count * 1e6, 1),
+        'handshakes': tls.handshakes_total.value - handshakes,
+        'resumed': tls.resumed_total.value - resumed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='tls.py')
+    parser.add_argument('-n', '--count', help='messages per scenario.', type=int, default=2000)
+    parser.add_argument('--size', help='bytes per message.', type=int, default=100)
+    parser.add_argument('--json', help='print the results as one JSON line.', action='store_true')
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='sus-tls-bench-')
+    stop = threading.Event()
+    try:
+        messaging.SUS_MESSAGES_PORT = random.randint(20000, 60000)
+        inbox = messaging.InboxServer(ip='127.0.0.1',
+                                      tls=tls.server_context(*make_certificate(directory)))
+        inbox.stop = stop
+        threading.Thread(target=inbox.listen, daemon=True).start()
+        threading.Thread(target=drain, args=(stop,), daemon=True).start()
+        payload = b'x' * args.size
+        results = [measure(scenario, payload, args.count) for scenario in
+                   ['plaintext', 'tls', 'plaintext-connect', 'tls-full', 'tls-resumed']]
+    finally:
+        stop.set()
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json:
+        print(json.dumps({'count': args.count, 'size': args.size, 'results': results},
+                         sort_keys=True))
+        return
+    print('{:<18} {:>12} {:>12} {:>11} {:>8}'.format(
+        'scenario', 'wall/msg', 'cpu/msg', 'handshakes', 'resumed'))
+    for r in results:
+        print('{:<18} {:>9.1f} µs {:>9.1f} µs {:>11} {:>8}'.format(
+            r['scenario'], r['wall_us'], r['cpu_us'], r['handshakes'], r['resumed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" The SUS modules import each other by name, as they do when run from SUS/. """
+
+
+import os
+import socket
+import sys
+import threading
+import pytest
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SUS'))
+
+
+@pytest.fixture
+def messages_port(monkeypatch):
+    """ A free port, made the messages port of this process. """
+    import messaging
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    monkeypatch.setattr(messaging, 'SUS_MESSAGES_PORT', port)
+    return port
+
+
+@pytest.fixture(params=['threads', 'asyncio'])
+def start_inbox(request, messages_port):
+    """ Starts InboxServers on the messages port, served by threads or by an event loop. """
+    import messaging
+    started = []
+
+    def start(**kwargs):
+        inbox = messaging.InboxServer('127.0.0.1', **kwargs)
+        inbox.server.listen()  # before the thread gets to it
+        if request.param == 'threads':
+            thread = threading.Thread(target=inbox.listen, daemon=True)
+        else:
+            thread = threading.Thread(target=messaging.listen_async, args=([inbox], inbox.stop),
+                                      daemon=True)
+        thread.start()
+        started.append((inbox, thread))
+        return inbox
+    messaging.incoming_messages.drain(timeout=0)
+    yield start
+    for inbox, thread in started:
+        inbox.stop.set()
+        try:
+            socket.create_connection(('127.0.0.1', messages_port)).close()  # wakes accept up
+        except socket.error:
+            pass
+        thread.join(5)
+        inbox.server.close()
+    messaging.incoming_messages.drain(timeout=0)
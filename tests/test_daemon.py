@@ -0,0 +1,42 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import queue
+import SUSd
+
+
+def test_log_records_are_queued_unformatted():
+    records = queue.Queue(2)
+    handler = SUSd.LogQueueHandler(records)
+    logger = logging.getLogger('test.queued')
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        logger.warning('message from <%s>', '10.0.0.1')
+        record = records.get_nowait()
+        assert (record.msg, record.args) == ('message from <%s>', ('10.0.0.1',))
+        for i in range(5):
+            logger.warning('record %d', i)
+        assert handler.dropped == 3
+        records.get_nowait()
+        records.get_nowait()
+        logger.warning('room again')
+        assert records.get_nowait().getMessage() == 'log queue full: dropped 3 records.'
+        assert records.get_nowait().getMessage() == 'room again'
+    finally:
+        logger.removeHandler(handler)
@@ -0,0 +1,173 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import socket
+import pytest
+import frames
+
+
+def test_recv_frame_reads_what_pack_wrote():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(frames.pack(frames.MESSAGE, 'ciao'.encode('utf-8'), 42))
+        frame = frames.recv_frame(right)
+    assert (frame.type, frame.flags, frame.message_id) == (frames.MESSAGE, 0, 42)
+    assert frames.text(frame.payload) == 'ciao'
+
+
+def test_recv_frame_refuses_what_is_not_a_frame():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(b'OK\n200 keep-alive\n')
+        with pytest.raises(frames.FrameError):
+            frames.recv_frame(right)
+
+
+def test_batch_round_trip():
+    messages = [b'uno', b'', 'tr\u00e8'.encode('utf-8')]
+    assert [bytes(m) for m in frames.unpack_batch(frames.batch_payload(messages))] == messages
+    payload = frames.batch_payload(messages, ids=[1, 2, 3])
+    assert [(i, bytes(m)) for i, m in frames.unpack_batch(payload, True)] == \
+        list(zip([1, 2, 3], messages))
+
+
+def test_truncated_batch():
+    payload = frames.batch_payload([b'hello'])[:-1]
+    with pytest.raises(frames.FrameError):
+        list(frames.unpack_batch(payload))
+
+
+def test_text_refuses_invalid_utf8():
+    assert frames.text(memoryview('\u00e8'.encode('utf-8'))) == '\u00e8'
+    with pytest.raises(frames.FrameError):
+        frames.text(b'\xff\xfe')
+
+
+def test_frame_reader_reassembles_frames_split_anywhere():
+    data = b''.join(frames.pack(frames.MESSAGE, 'message {}'.format(i).encode('utf-8'), i)
+                    for i in range(10))
+    reader = frames.FrameReader(buffer_size=16)
+    received = []
+    for i in range(0, len(data), 7):
+        reader.feed(data[i:i + 7])
+        received.extend((frame.message_id, bytes(frame.payload)) for frame in reader.frames())
+    assert received == [(i, 'message {}'.format(i).encode('utf-8')) for i in range(10)]
+    assert reader.legacy is False
+    assert reader.idle()
+
+
+def test_frame_reader_grows_for_large_frames():
+    payload = bytes(range(256)) * 64
+    reader = frames.FrameReader(buffer_size=64)
+    data = frames.pack(frames.MESSAGE, payload)
+    for start in range(0, len(data), 100):
+        reader.feed(data[start:start + 100])
+        # room for twice what arrived, at most: never more than the frame
+        assert len(reader.buffer) <= max(64, 2 * (start + 100))
+        assert len(reader.buffer) <= len(data)
+    assert [bytes(frame.payload) for frame in reader.frames()] == [payload]
+
+
+def test_frame_reader_does_not_allocate_what_a_header_claims():
+    reader = frames.FrameReader(buffer_size=64)
+    header = frames.HEADER.pack(frames.MAGIC, frames.VERSION, frames.MESSAGE, 0,
+                                frames.MAX_PAYLOAD, 1)
+    reader.feed(header + b'x' * 10)
+    assert list(reader.frames()) == []
+    reader.make_room()
+    assert len(reader.buffer) <= 128
+
+
+def test_frame_reader_receives_frames_larger_than_its_buffer():
+    payloads = [bytes([i]) * (1000 * i) for i in range(1, 6)]
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(b''.join(frames.pack(frames.MESSAGE, p, i) for i, p in enumerate(payloads)))
+        left.shutdown(socket.SHUT_WR)
+        reader = frames.FrameReader(buffer_size=256)
+        received = []
+        while reader.recv_from(right):
+            received.extend(bytes(frame.payload) for frame in reader.frames())
+    assert received == payloads
+    assert len(reader.buffer) <= 2 * frames.HEADER.size + 2 * len(payloads[-1])
+
+
+def test_frame_reader_make_room_keeps_the_partial_frame():
+    first = frames.pack(frames.MESSAGE, b'a' * 20, 1)
+    second = frames.pack(frames.MESSAGE, b'b' * 20, 2)
+    reader = frames.FrameReader(buffer_size=len(first) + 8)
+    reader.feed(first + second[:8])
+    assert [frame.message_id for frame in reader.frames()] == [1]
+    reader.feed(second[8:])  # moves the start of the second frame to the front
+    assert [(frame.message_id, bytes(frame.payload)) for frame in reader.frames()] == \
+        [(2, b'b' * 20)]
+
+
+def test_frame_reader_spots_legacy_peers():
+    reader = frames.FrameReader()
+    reader.feed(b'hello##END')
+    assert reader.legacy
+    assert reader.legacy_messages() == ['hello']
+
+
+def test_legacy_reader_end_marker_spanning_chunks():
+    reader = frames.LegacyReader()
+    assert reader.feed(b'first message##') == []
+    assert reader.feed(b'ENDsecond#') == ['first message']
+    assert reader.feed(b'#E') == []
+    assert reader.feed(b'ND') == ['second']
+    assert reader.idle()
+
+
+def test_legacy_reader_multibyte_character_spanning_chunks():
+    data = '\u00e8 pi\u00f9##END'.encode('utf-8')
+    reader = frames.LegacyReader()
+    assert reader.feed(data[:1]) == []
+    assert reader.feed(data[1:]) == ['\u00e8 pi\u00f9']
+
+
+def test_legacy_reader_rest():
+    reader = frames.LegacyReader()
+    assert reader.feed(b'one##ENDtwo') == ['one']
+    assert reader.rest() == 'two'
+
+
+
+@pytest.mark.parametrize('name', sorted(codec.name for codec in frames.CODECS.values()))
+def test_compression_round_trip(name):
+    codec = frames.codec_named(name)
+    payload = b'ciao ' * 1000
+    compressed, flags = frames.compress(payload, codec, threshold=100)
+    assert flags == codec.id and len(compressed) < len(payload)
+    frame = frames.Frame(frames.MESSAGE, flags, 0, compressed)
+    assert bytes(frames.decoded_payload(frame)) == payload
+    assert frames.compress(b'short', codec, threshold=100) == (b'short', 0)
+
+
+@pytest.mark.parametrize('name', sorted(codec.name for codec in frames.CODECS.values()))
+def test_decompression_is_bounded(name):
+    codec = frames.codec_named(name)
+    bomb = codec.compress(bytes(1024 * 1024))
+    with pytest.raises(frames.FrameError):
+        codec.decompress(bomb, max_size=1024)
+    with pytest.raises(frames.FrameError):
+        codec.decompress(b'not compressed at all')
+
+
+def test_unknown_codecs_are_refused():
+    with pytest.raises(frames.FrameError):
+        frames.decoded_payload(frames.Frame(frames.MESSAGE, 4, 0, b'ciao'))
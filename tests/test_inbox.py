@@ -0,0 +1,161 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import socket
+import time
+import pytest
+import frames
+import messaging
+
+
+def connect():
+    return socket.create_connection(('127.0.0.1', messaging.SUS_MESSAGES_PORT), timeout=5)
+
+
+def received(count=1):
+    messages = []
+    while len(messages) < count:
+        batch = messaging.incoming_messages.drain(timeout=2)
+        if not batch:
+            break
+        messages.extend(batch)
+    return messages
+
+
+def recv_until(conn, end):
+    data = b''
+    while not data.endswith(end):
+        fragment = conn.recv(1024)
+        if fragment == b'':
+            break
+        data += fragment
+    return data
+
+
+def test_legacy_senders(start_inbox):
+    start_inbox()
+    with connect() as conn:
+        conn.sendall('ciao, mondo! \u00e8##END'.encode('utf-8'))
+        assert recv_until(conn, b'\n') == b'OK\n200 keep-alive\n'
+        # the connection may be reused for the next message
+        conn.sendall(b'again##END')
+        assert recv_until(conn, b'\n') == b'OK\n200 keep-alive\n'
+    assert received(2) == [('127.0.0.1', 'ciao, mondo! \u00e8'), ('127.0.0.1', 'again')]
+
+
+def test_legacy_senders_that_close_without_an_end_marker(start_inbox):
+    start_inbox()
+    with connect() as conn:
+        conn.sendall(b'no end marker')
+        conn.shutdown(socket.SHUT_WR)
+        assert recv_until(conn, b'\n') == b'OK\n200 keep-alive\n'
+    assert received() == [('127.0.0.1', 'no end marker')]
+
+
+def test_framed_senders(start_inbox):
+    start_inbox()
+    with connect() as conn:
+        conn.sendall(frames.pack(frames.MESSAGE, 'ciao \u00e8'.encode('utf-8'), 1) +
+                     frames.pack_batch([b'uno', b'due'], 2, ids=[10, 11]))
+        ack = frames.recv_frame(conn)
+        assert (ack.type, ack.message_id, bytes(ack.payload)) == (frames.ACK, 1, b'200')
+        assert ack.flags & frames.MESSAGE_IDS
+        ack = frames.recv_frame(conn)
+        assert (ack.message_id, bytes(ack.payload)) == (2, b'200 200')
+    assert received(3) == [('127.0.0.1', 'ciao \u00e8'), ('127.0.0.1', 'uno'),
+                           ('127.0.0.1', 'due')]
+
+
+def test_retried_messages_are_delivered_once(start_inbox):
+    start_inbox(duplicates=messaging.DuplicateFilter())
+    with connect() as conn:
+        for _ in range(2):  # as if the first ack was lost
+            conn.sendall(frames.pack_batch([b'uno', b'due'], 1, ids=[10, 11]))
+            assert bytes(frames.recv_frame(conn).payload) == b'200 200'
+        conn.sendall(frames.pack(frames.MESSAGE, b'due', 11))
+        assert bytes(frames.recv_frame(conn).payload) == b'200'
+    assert received(2) == [('127.0.0.1', 'uno'), ('127.0.0.1', 'due')]
+    assert messaging.incoming_messages.drain(timeout=0.1) == []
+
+
+@pytest.mark.parametrize('frame', [
+    frames.pack(frames.MESSAGE, b'\xff\xfe', 1),
+    frames.pack(frames.ACK, b'200', 1),
+    frames.HEADER.pack(frames.MAGIC, 9, frames.MESSAGE, 0, 4, 1) + b'ciao',
+], ids=['not UTF-8', 'unexpected type', 'unknown version'])
+def test_bad_frames_close_the_connection(start_inbox, frame):
+    start_inbox()
+    with connect() as conn:
+        conn.sendall(frame)
+        assert conn.recv(1024) == b''
+    assert messaging.incoming_messages.drain(timeout=0.1) == []
+
+
+def test_connections_past_the_cap_are_refused(start_inbox):
+    inbox = start_inbox(admission=messaging.Admission(max_connections=8, max_per_ip=1))
+    with connect() as first:
+        first.sendall(b'first##END')
+        assert recv_until(first, b'\n') == b'OK\n200 keep-alive\n'
+        with connect() as second:
+            ack = frames.recv_frame(second)
+            assert bytes(ack.payload) == str(messaging.OVERLOADED).encode('utf-8')
+            assert second.recv(1024) == b''
+        assert inbox.admission.refused == 1
+    # once done with, connections are released
+    deadline = time.monotonic() + 2
+    while (len(inbox.admission) or inbox.threads) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(inbox.admission) == 0
+    assert not inbox.admission.active
+    assert not inbox.threads
+
+
+def test_admission():
+    admission = messaging.Admission(max_connections=3, max_per_ip=2)
+    assert admission.admit('10.0.0.1')
+    assert admission.admit('10.0.0.1')
+    assert not admission.admit('10.0.0.1')
+    assert admission.admit('10.0.0.2')
+    assert not admission.admit('10.0.0.3')
+    admission.release('10.0.0.1')
+    assert admission.admit('10.0.0.3')
+    for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']:
+        admission.release(ip)
+    assert len(admission) == 0 and not admission.active
+    assert admission.refused == 2
+
+
+def test_silenced_senders_are_hung_up_on(start_inbox):
+    silenced = messaging.SilenceList()
+    silenced.add('127.0.0.0/8')
+    start_inbox(silenced=silenced)
+    with connect() as conn:
+        try:
+            conn.sendall(b'ciao##END')
+        except socket.error:
+            pass  # already closed
+        try:
+            assert conn.recv(1024) == b''
+        except ConnectionResetError:
+            pass
+    assert messaging.incoming_messages.drain(timeout=0.1) == []
+
+
+def test_idle_connections_are_closed(start_inbox):
+    start_inbox(inactivity_timeout=0.2)
+    with connect() as conn:
+        assert conn.recv(1024) == b''
@@ -0,0 +1,59 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import socket
+import subprocess
+import sys
+import pytest
+import main
+
+
+def run(monkeypatch, *argv):
+    """ Runs the SUS command line with `argv`; returns its exit status. """
+    monkeypatch.setattr(sys, 'argv', ['SUS'] + list(argv))
+    try:
+        main.SUS()
+    except SystemExit as exc:
+        return exc.code
+    return 0
+
+
+@pytest.mark.parametrize('argv', [['group', '-d'], ['peer', '-d'], ['silence', '-u']])
+def test_deleting_needs_a_name(monkeypatch, capsys, argv):
+    assert run(monkeypatch, *argv) == 2
+    assert 'required' in capsys.readouterr().err
+
+
+def test_client_commands_import_little():
+    """ Sending from the command line imports neither the daemon nor logging. """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    script = """if True:
+        import sys
+        import client
+        import main
+        client.SUSD_SHELL_PORT = {}  # nobody listening
+        sys.argv = ['SUS', 'send', '10.0.0.1', 'ciao']
+        main.SUS()
+        print(sorted({{'logging', 'messaging', 'SUSd', 'daemon'}} & set(sys.modules)))
+    """.format(port)
+    output = subprocess.check_output(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(main.__file__), universal_newlines=True)
+    assert output.splitlines()[-1] == '[]'
@@ -0,0 +1,150 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import pytest
+import messaging
+
+
+def test_message_queue_wakes_up_consumers():
+    queue = messaging.MessageQueue()
+    threading.Timer(0.05, queue.put, args=('ciao',)).start()
+    started = time.monotonic()
+    assert queue.drain(timeout=5) == ['ciao']
+    assert time.monotonic() - started < 1
+
+
+def test_message_queue_drains_in_batches():
+    queue = messaging.MessageQueue()
+    for i in range(100):
+        queue.put(i)
+    assert queue.drain(max_items=64) == list(range(64))
+    assert queue.drain(max_items=64) == list(range(64, 100))
+    assert queue.drain(timeout=0) == []
+
+
+def test_message_queue_wake_lets_consumers_notice_stop():
+    queue = messaging.MessageQueue()
+    threading.Timer(0.05, queue.wake).start()
+    started = time.monotonic()
+    assert queue.drain(timeout=5) == []
+    assert time.monotonic() - started < 1
+
+
+@pytest.mark.parametrize('policy', [messaging.REJECT, messaging.DROP_OLDEST])
+def test_message_queue_overload_policies(policy):
+    dropped = []
+    queue = messaging.MessageQueue(capacity=2, policy=policy, on_drop=dropped.append)
+    results = [queue.put(i) for i in range(3)]
+    if policy == messaging.REJECT:
+        assert results == [True, True, False]
+        assert queue.rejected == 1
+        assert queue.drain(timeout=0) == [0, 1]
+    else:
+        assert results == [True, True, True]
+        assert dropped == [0]
+        assert queue.drain(timeout=0) == [1, 2]
+
+
+def test_message_queue_blocks_producers_until_there_is_room():
+    queue = messaging.MessageQueue(capacity=1, timeout=5)
+    queue.put(0)
+    assert not queue.put(1, block=False)
+    threading.Timer(0.1, queue.drain).start()
+    started = time.monotonic()
+    assert queue.put(1)
+    assert time.monotonic() - started >= 0.05
+    assert queue.drain(timeout=0) == [1]
+
+
+def test_message_queue_rejects_after_its_timeout():
+    queue = messaging.MessageQueue(capacity=1, timeout=0.05)
+    queue.put(0)
+    assert not queue.put(1)
+    assert queue.rejected == 1
+
+
+def test_rate_limiter_allows_a_burst_then_the_rate():
+    limiter = messaging.RateLimiter(rate=10, burst=5)
+    assert limiter.delay('10.0.0.1') == 0
+    limiter.charge('10.0.0.1', 4)
+    assert limiter.delay('10.0.0.1') == 0
+    limiter.charge('10.0.0.1', 11)  # in debt: a second to pay it back, and one more token
+    assert 1 <= limiter.delay('10.0.0.1') <= 1.1
+    assert limiter.delay('10.0.0.2') == 0
+
+
+def test_rate_limiter_forgets_refilled_buckets():
+    limiter = messaging.RateLimiter(rate=1000, burst=1, max_buckets=10)
+    for i in range(10):
+        limiter.charge('10.0.0.{}'.format(i))
+    time.sleep(0.01)
+    limiter.charge('10.0.1.1')
+    assert list(limiter.buckets) == ['10.0.1.1']
+
+
+def test_duplicate_filter():
+    duplicates = messaging.DuplicateFilter()
+    assert duplicates.add(1)
+    assert not duplicates.add(1)
+    assert duplicates.add(2)
+    duplicates.discard(1)
+    assert duplicates.add(1)
+
+
+def test_duplicate_filter_forgets_past_its_capacity():
+    duplicates = messaging.DuplicateFilter(capacity=10)
+    for message_id in range(100):
+        assert duplicates.add(message_id)
+    assert len(duplicates.recent) <= 10
+    assert duplicates.add(0)
+
+
+def test_duplicate_filter_forgets_after_its_window():
+    duplicates = messaging.DuplicateFilter(window=0.05)
+    assert duplicates.add(1)
+    time.sleep(0.1)
+    assert duplicates.add(1)
+
+
+def test_silence_list_ranges(tmpdir):
+    silenced = messaging.SilenceList(str(tmpdir.join('silenced.json')))
+    assert '10.1.2.3' not in silenced
+    assert silenced.add('10.1.2.3/16') == '10.1.0.0/16'
+    assert silenced.add('192.168.1.7/32') == '192.168.1.7'
+    assert '10.1.200.1' in silenced
+    assert '10.2.0.1' not in silenced
+    assert '192.168.1.7' in silenced and '192.168.1.8' not in silenced
+    assert 'not an ip' not in silenced
+    # kept across restarts
+    assert messaging.SilenceList(silenced.path).items() == \
+        [('10.1.0.0/16', None), ('192.168.1.7', None)]
+    assert silenced.remove('10.1.9.9/16')
+    assert not silenced.remove('10.1.0.0/16')
+    assert '10.1.200.1' not in silenced
+    with pytest.raises(ValueError):
+        silenced.add('10.1.0.0/33')
+
+
+def test_silence_list_expiry():
+    silenced = messaging.SilenceList()
+    silenced.add('10.0.0.1', time.time() + 60)
+    silenced.add('10.0.0.2', time.time() - 1)
+    assert '10.0.0.1' in silenced
+    assert '10.0.0.2' not in silenced
+    assert [entry for entry, _ in silenced.items()] == ['10.0.0.1']
@@ -0,0 +1,62 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import urllib.request
+import pytest
+import metrics
+
+
+@pytest.mark.parametrize('micros', [0, 1, 31, 32, 1000, 123456, 10 ** 9])
+def test_histogram_buckets_are_within_6_percent(micros):
+    value = metrics.Histogram.value_at(metrics.Histogram.index(micros))
+    assert abs(value - micros) <= max(1, 0.0625 * micros)
+
+
+def test_histogram_quantiles():
+    histogram = metrics.Histogram('latency', 'test')
+    assert histogram.quantiles() == [0.0, 0.0, 0.0]
+    for millis in range(1, 101):
+        histogram.observe(millis / 1000)
+    p50, p90, p99 = histogram.quantiles()
+    assert p50 == pytest.approx(0.050, rel=0.07)
+    assert p90 == pytest.approx(0.090, rel=0.07)
+    assert p99 == pytest.approx(0.099, rel=0.07)
+    assert histogram.count == 100
+    assert histogram.max == 100000
+    assert histogram.summary().startswith('count 100  p50 ')
+
+
+def test_prometheus_endpoint():
+    registry = metrics.Registry()
+    registry.counter('sus_test_total', 'Things counted.').inc(3)
+    registry.gauge('sus_test_queued', 'Things queued.', lambda: 7)
+    registry.histogram('sus_test_seconds', 'Things timed.').observe(0.5)
+    server = metrics.serve_prometheus(0, registry)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            body = response.read().decode('utf-8').splitlines()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert body[:3] == ['# HELP sus_test_total Things counted.', '# TYPE sus_test_total counter',
+                        'sus_test_total 3']
+    assert 'sus_test_queued 7' in body
+    assert '# TYPE sus_test_seconds summary' in body
+    assert 'sus_test_seconds_count 1' in body
+    assert 'sus_test_seconds_sum 0.5' in body
@@ -0,0 +1,344 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import socket
+import threading
+import time
+import pytest
+import frames
+import messaging
+import tls
+
+
+def outgoing(message='ciao', recipient='127.0.0.1'):
+    return messaging.Outgoing(recipient, message, None, messaging.new_message_id())
+
+
+class Listener:
+    """ Accepts connections on the messages port, serving each with `serve` in a thread. """
+    def __init__(self, port, serve):
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen()
+        self.server.settimeout(0.1)
+        self.serve = serve
+        self.connections = []  # kept open until closed
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+    def accept(self):
+        while not self.stop.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            self.connections.append(conn)
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.server.close()
+        for conn in self.connections:
+            conn.close()
+
+
+@pytest.fixture
+def baseline_peer(messages_port):
+    """ A peer running SUS from before frames: a thread per connection reads
+    text until ##END and answers "OK\\n200". Bytes that aren't UTF-8, like a
+    frame header, kill the thread and leave the connection open.
+    """
+    received = []
+
+    def serve(conn):
+        message = ''
+        while True:
+            fragment = conn.recv(1024)
+            if fragment == b'':
+                break
+            try:
+                message += fragment.decode('utf-8')
+            except UnicodeDecodeError:
+                return
+            if message.rstrip().endswith('##END'):
+                break
+        received.append(message.replace('##END', '').strip())
+        conn.sendall(b'OK\n')
+        conn.sendall(b'200')
+        conn.close()
+
+    listener = Listener(messages_port, serve)
+    listener.received = received
+    yield listener
+    listener.close()
+
+
+@pytest.fixture
+def silent_peer(messages_port):
+    """ A peer that accepts connections, and then never reads nor answers. """
+    listener = Listener(messages_port, lambda conn: None)
+    yield listener
+    listener.close()
+
+
+def outbox(connections=None):
+    sender = messaging.OutboxSender(watch=messaging.MessageQueue(), connections=connections)
+    sender.stop = threading.Event()
+    sender.probe_timeout = 0.3
+    return sender
+
+
+def test_falls_back_to_end_markers_for_baseline_peers(baseline_peer):
+    sender = outbox()
+    started = time.monotonic()
+    sender.send_messages('127.0.0.1', [(outgoing(str(i)), 0) for i in range(3)])
+    assert time.monotonic() - started < 2
+    assert baseline_peer.received == ['0', '1', '2']
+    assert sender.is_legacy('127.0.0.1')
+    assert len(sender.retries) == 0
+    # the next message goes straight to ##END
+    sender.send_messages('127.0.0.1', [(outgoing('3'), 0)])
+    assert baseline_peer.received[-1] == '3'
+
+
+def test_starttls_to_baseline_peers_falls_back_to_plaintext(baseline_peer):
+    client_tls = tls.ClientTLS(tls.client_context())
+    sender = outbox(messaging.PeerConnectionPool(timeout=0.3, tls=client_tls))
+    sender.send_messages('127.0.0.1', [(outgoing('hello'), 0)])
+    assert baseline_peer.received == ['hello']
+    assert not client_tls.wanted('127.0.0.1')
+    assert sender.is_legacy('127.0.0.1')
+
+
+def test_silent_peers_are_not_taken_for_legacy_ones(silent_peer):
+    sender = outbox()
+    message = outgoing()
+    sender.send_messages('127.0.0.1', [(message, 0)])
+    assert not sender.is_legacy('127.0.0.1')
+    assert sender.retries.failures == {'127.0.0.1': 1}
+    sender.retries.release('127.0.0.1')
+    assert sender.retries.due() == [(message, 1)]
+
+
+def test_inbox_peers_get_frames(messages_port):
+    messaging.incoming_messages.drain(timeout=0)
+    inbox = messaging.InboxServer('127.0.0.1')
+    inbox.server.listen()  # before the thread gets to it
+    threading.Thread(target=inbox.listen, daemon=True).start()
+    try:
+        sender = outbox()
+        sender.send_messages('127.0.0.1', [(outgoing(str(i)), 0) for i in range(3)])
+        assert not sender.is_legacy('127.0.0.1')
+        assert '127.0.0.1' in sender.framed_peers
+        assert messaging.incoming_messages.drain(timeout=1) == \
+            [('127.0.0.1', '0'), ('127.0.0.1', '1'), ('127.0.0.1', '2')]
+    finally:
+        inbox.stop.set()
+        socket.create_connection(('127.0.0.1', messages_port)).close()
+
+
+def test_connections_carry_many_messages(messages_port):
+    messaging.incoming_messages.drain(timeout=0)
+    inbox = messaging.InboxServer('127.0.0.1')
+    inbox.server.listen()  # before the thread gets to it
+    threading.Thread(target=inbox.listen, daemon=True).start()
+    connections = messaging.connections_total.value
+    try:
+        sender = outbox()
+        for i in range(3):
+            sender.send_messages('127.0.0.1', [(outgoing(str(i)), 0)])
+        assert [m for _, m in messaging.incoming_messages.drain(timeout=1)] == ['0', '1', '2']
+        assert messaging.connections_total.value - connections == 1
+        assert len(sender.connections.idle['127.0.0.1']) == 1
+    finally:
+        inbox.stop.set()
+        socket.create_connection(('127.0.0.1', messages_port)).close()
+
+
+def test_connections_closed_by_the_peer_are_not_reused(silent_peer):
+    pool = messaging.PeerConnectionPool(timeout=1)
+    conn, reused = pool.acquire('127.0.0.1')
+    assert not reused
+    pool.release('127.0.0.1', conn)
+    while not silent_peer.connections:
+        time.sleep(0.01)
+    silent_peer.connections[0].close()
+    time.sleep(0.05)
+    conn, reused = pool.acquire('127.0.0.1')
+    assert not reused
+    pool.discard('127.0.0.1', conn)
+
+
+def test_retry_backoff_doubles_with_jitter():
+    retries = messaging.RetryScheduler(base_delay=1, max_delay=4)
+    delays = []
+    for attempts in range(1, 6):
+        started = time.monotonic()
+        assert retries.failed(outgoing(), attempts)
+        delays.append(retries.not_before['127.0.0.1'] - started)
+    for delay, expected in zip(delays, [1, 2, 4, 4, 4]):
+        assert expected / 2 <= delay <= expected + 0.1
+
+
+def test_retry_dead_letters():
+    retries = messaging.RetryScheduler(max_attempts=3)
+    kept, dead = outgoing('kept'), outgoing('dead')
+    assert retries.failed_batch([(kept, 2), (dead, 3)]) == [True, False]
+    assert list(retries.dead_letters) == [dead]
+    assert len(retries) == 1
+
+
+def test_retry_release_and_success():
+    retries = messaging.RetryScheduler(base_delay=60)
+    message = outgoing()
+    retries.failed(message, 1)
+    assert retries.due() == []
+    assert retries.defer(outgoing('next'), 0)  # backed off: parked too
+    retries.release('127.0.0.1')
+    assert [m.message for m, _ in retries.due()] == ['ciao', 'next']
+    retries.succeeded('127.0.0.1')
+    assert not retries.defer(message, 1)  # nothing to wait for
+
+
+def test_unreachable_recipients_are_backed_off(messages_port):
+    sender = outbox()
+    message = outgoing()
+    sender.send_messages('127.0.0.1', [(message, 0)])  # nobody listening
+    assert sender.retries.failures == {'127.0.0.1': 1}
+    assert len(sender.retries) == 1
+    assert sender.retries.due() == []
+
+
+def test_messages_to_one_peer_are_coalesced(messages_port):
+    received = []
+
+    def serve(conn):
+        while True:
+            try:
+                frame = frames.recv_frame(conn)
+            except (socket.error, frames.FrameError):
+                return
+            if frame.type == frames.BATCH:
+                messages = list(frames.unpack_batch(frame.payload,
+                                                    frame.flags & frames.MESSAGE_IDS))
+                statuses = ' '.join('200' for _ in messages)
+            else:
+                messages, statuses = [frame.payload], '200'
+            received.append((frame.type, len(messages)))
+            conn.sendall(frames.pack(frames.ACK, statuses.encode('utf-8'), frame.message_id,
+                                     frames.MESSAGE_IDS))
+    listener = Listener(messages_port, serve)
+    try:
+        sender = outbox()
+        sender.send_messages('127.0.0.1', [(outgoing(str(i)), 0) for i in range(50)])
+    finally:
+        listener.close()
+    assert sum(count for _, count in received) == 50
+    assert len(received) <= 2
+    assert received[-1][0] == frames.BATCH
+    assert len(sender.retries) == 0
+
+
+def test_large_messages_are_compressed_once_the_peer_accepts_it(messages_port):
+    messaging.incoming_messages.drain(timeout=0)
+    inbox = messaging.InboxServer('127.0.0.1')
+    inbox.server.listen()  # before the thread gets to it
+    threading.Thread(target=inbox.listen, daemon=True).start()
+    try:
+        sender = messaging.OutboxSender(watch=messaging.MessageQueue(),
+                                        codec=frames.codec_named('zlib'), compress_threshold=100)
+        sender.stop = threading.Event()
+        large = 'ciao ' * 1000
+        sender.send_messages('127.0.0.1', [(outgoing('hello'), 0)])  # learns the codecs
+        assert frames.accepts(sender.peer_flags['127.0.0.1'], sender.codec)
+        payload, wire = messaging.payload_bytes_total.value, messaging.wire_bytes_total.value
+        sender.send_messages('127.0.0.1', [(outgoing(large), 0)])
+        assert messaging.wire_bytes_total.value - wire < \
+            (messaging.payload_bytes_total.value - payload) / 10
+        assert messaging.incoming_messages.drain(timeout=1) == \
+            [('127.0.0.1', 'hello'), ('127.0.0.1', large.strip())]
+    finally:
+        inbox.stop.set()
+        socket.create_connection(('127.0.0.1', messages_port)).close()
+
+
+def test_circuit_opens_after_repeated_failures_and_probes_back_off():
+    health = messaging.PeerHealth(failure_threshold=3, probe_interval=1, max_probe_interval=4)
+    for _ in range(2):
+        health.failed('10.0.0.1')
+    assert health.allow('10.0.0.1')
+    health.failed('10.0.0.1')
+    assert not health.allow('10.0.0.1')
+    assert health.unreachable() == ['10.0.0.1']
+    assert health.probes_due() == []
+    assert 0.9 <= health.next_probe_in(10) <= 1
+    health.peers['10.0.0.1'].next_probe = 0
+    assert health.probes_due() == ['10.0.0.1']
+    assert health.probes_due() == []  # being probed
+    assert not health.probed('10.0.0.1', None)
+    assert health.peers['10.0.0.1'].probe_delay == 2
+    health.peers['10.0.0.1'].next_probe = 0
+    assert health.probes_due() == ['10.0.0.1']
+    assert health.probed('10.0.0.1', 0.01)
+    assert health.allow('10.0.0.1')
+    assert health.unreachable() == []
+
+
+def test_connect_timeouts_follow_the_round_trip_time():
+    health = messaging.PeerHealth(connect_timeout=10, min_connect_timeout=0.5)
+    assert health.timeout('10.0.0.1') == 10
+    for _ in range(20):
+        health.succeeded('10.0.0.1', 0.2)
+    assert 0.5 <= health.timeout('10.0.0.1') < 1
+    health.succeeded('10.0.0.2', 0.001)
+    assert health.timeout('10.0.0.2') == 0.5
+
+
+def test_messages_to_unreachable_peers_fail_without_connecting(messages_port):
+    sender = outbox()
+    sender.health.failure_threshold = 1
+    sender.send_messages('127.0.0.1', [(outgoing(), 0)])  # nobody listening
+    assert not sender.health.allow('127.0.0.1')
+    sender.retries.release('127.0.0.1')
+    sender.retries.due()
+    sender.retries.succeeded('127.0.0.1')  # not backed off any more: only the circuit holds it
+    message = outgoing('next')
+    sender.schedule(message)
+    assert sender.coalescing == {}  # not handed to a sender
+    assert [m for _, _, m, _ in sender.retries.pending] == [message]
+    # a probe that gets through closes the circuit
+    listener = Listener(messages_port, lambda conn: None)
+    try:
+        sender.probe('127.0.0.1')
+    finally:
+        listener.close()
+    assert sender.health.allow('127.0.0.1')
+
+
+def test_failed_batch_backs_off_once():
+    retries = messaging.RetryScheduler(base_delay=1)
+    batch = [(outgoing(str(i)), 1) for i in range(50)]
+    started = time.monotonic()
+    assert retries.failed_batch(batch) == [True] * 50
+    assert retries.failures == {'127.0.0.1': 1}
+    assert retries.not_before['127.0.0.1'] - started <= 1.1
+    assert len(retries) == 50
+    assert retries.due() == []
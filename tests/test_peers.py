@@ -0,0 +1,93 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import socket
+import pytest
+import client
+import peers
+import store
+
+
+@pytest.fixture
+def directory(tmpdir):
+    directory = peers.PeerDirectory(str(tmpdir.join('peers.json')))
+    yield directory
+    directory.close()
+
+
+def test_nicknames(directory):
+    directory.add('xor-Nand', '192.168.1.7')
+    assert 'xor-Nand' in directory
+    assert directory.resolve('xor-Nand') == '192.168.1.7'
+    assert directory.resolve('10.0.0.1') == '10.0.0.1'
+    assert directory.name_of('192.168.1.7') == 'xor-Nand'
+    assert peers.PeerDirectory(directory.path).get('xor-Nand') == '192.168.1.7'
+    assert directory.remove('xor-Nand')
+    assert not directory.remove('xor-Nand')
+    assert 'xor-Nand' not in directory
+
+
+def test_host_names_are_resolved_once(directory, monkeypatch):
+    lookups = []
+
+    def getaddrinfo(host, *args):
+        lookups.append(host)
+        if host == 'nowhere':
+            raise socket.gaierror('unknown host')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 0, '', ('192.168.1.8', 0))]
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    directory.add('box', 'box.lan')
+    assert directory.resolve('box') == '192.168.1.8'
+    assert directory.resolve('box.lan') == '192.168.1.8'
+    assert directory.resolve('nowhere') is None
+    assert directory.resolve('nowhere') is None
+    assert lookups == ['box.lan', 'nowhere']
+
+
+def test_learned_nicknames_are_capped(tmpdir, monkeypatch):
+    monkeypatch.setattr(socket, 'gethostbyaddr',
+                        lambda ip: ('host-{}.lan'.format(ip.rsplit('.', 1)[1]), [], [ip]))
+    directory = peers.PeerDirectory(str(tmpdir.join('peers.json')), max_learned=3)
+    directory.add('host-1', '10.0.0.100')
+    for i in range(1, 6):
+        directory.learn('10.0.0.{}'.format(i))
+    directory.close()
+    # the user's nickname wins, and only the last three learned are kept
+    assert list(directory.learned) == ['host-3', 'host-4', 'host-5']
+    assert directory.get('host-1') == '10.0.0.100'
+    reloaded = peers.PeerDirectory(directory.path, max_learned=2)
+    reloaded.close()
+    assert list(reloaded.learned) == ['host-4', 'host-5']
+
+
+def test_history_resolves_nicknames(tmpdir, monkeypatch, capsys):
+    monkeypatch.setattr(client, 'SUS_DIR', str(tmpdir))
+    with open(str(tmpdir.join('peers.json')), 'w') as f:
+        json.dump({'names': {'xor-Nand': '10.0.0.1'}, 'learned': {'box': '10.0.0.2'}}, f)
+    messages = store.MessageStore(os.path.join(str(tmpdir), 'messages'))
+    messages.open()
+    messages.append(store.INCOMING, '10.0.0.1', 'ciao')
+    messages.append(store.OUTGOING, '10.0.0.2', 'hello')
+    messages.append(store.OUTGOING, '10.0.0.1', 'come va?')
+    messages.close()
+    client.history('xor-Nand')
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split('  ', 1)[1] for line in lines] == ['xor-Nand: ciao', '> xor-Nand: come va?']
+    client.history()
+    assert capsys.readouterr().out.splitlines()[1].endswith('> box: hello')
@@ -0,0 +1,206 @@
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import socket
+import threading
+import time
+import pytest
+import frames
+import messaging
+import relay
+import store
+
+
+class PlainSealer:
+    """ Seals nothing: stands in for relay.Sealer, which needs cryptography. """
+    def seal(self, sender, message):
+        return json.dumps([time.time(), sender, message])
+
+    def unseal(self, sealed):
+        _, sender, message = json.loads(sealed)
+        return sender, message
+
+    def sealed_at(self, sealed):
+        return json.loads(sealed)[0]
+
+
+@pytest.fixture
+def spool(tmpdir):
+    spool = store.OutboxSpool(str(tmpdir.join('relay.spool')))
+    spool.open()
+    thread = threading.Thread(target=spool.start)
+    thread.start()
+    yield spool
+    spool.stop.set()
+    thread.join()
+
+
+def new_relay(spool, **kwargs):
+    held = relay.Relay(spool, PlainSealer(), connect_timeout=1, **kwargs)
+    held.open()
+    return held
+
+
+def start_inbox(ip, **kwargs):
+    inbox = messaging.InboxServer(ip, **kwargs)
+    inbox.server.listen()  # before the thread gets to it
+    threading.Thread(target=inbox.listen, daemon=True).start()
+    return inbox
+
+
+def stop_inbox(inbox, ip):
+    inbox.stop.set()
+    socket.create_connection((ip, messaging.SUS_MESSAGES_PORT)).close()
+    inbox.server.close()
+
+
+def send_frame(ip, type, payload):
+    with socket.create_connection((ip, messaging.SUS_MESSAGES_PORT), 1) as conn:
+        return relay.exchange(conn, type, payload)
+
+
+def test_relay_holds_and_forwards(spool, messages_port):
+    messaging.incoming_messages.drain(timeout=0)
+    held = new_relay(spool)
+    inbox = start_inbox('127.0.0.1', relay=held)
+    try:
+        assert send_frame('127.0.0.1', frames.RELAY, b'127.0.0.2\nciao') == b'200'
+    finally:
+        stop_inbox(inbox, '127.0.0.1')
+    assert len(held) == 1
+    assert list(held.mailboxes) == ['127.0.0.2']
+    # the recipient only takes FORWARD frames from its relays
+    recipient = start_inbox('127.0.0.2', relays=['127.0.0.1'])
+    try:
+        held.forward('127.0.0.2')
+        assert messaging.incoming_messages.drain(timeout=1) == [('127.0.0.1', 'ciao')]
+    finally:
+        stop_inbox(recipient, '127.0.0.2')
+    assert len(held) == 0
+    assert held.mailboxes == {} and held.digests == {}
+
+
+def test_daemons_that_are_not_relays_refuse_to_hold(messages_port):
+    inbox = start_inbox('127.0.0.1')
+    try:
+        status = send_frame('127.0.0.1', frames.RELAY, b'127.0.0.2\nciao')
+    finally:
+        stop_inbox(inbox, '127.0.0.1')
+    assert status == str(messaging.NOT_A_RELAY).encode('utf-8')
+
+
+def test_forward_frames_from_other_peers_are_refused(messages_port):
+    messaging.incoming_messages.drain(timeout=0)
+    inbox = start_inbox('127.0.0.1', relays=['10.0.0.1'])
+    try:
+        with pytest.raises((frames.FrameError, socket.error)):
+            send_frame('127.0.0.1', frames.FORWARD,
+                       frames.batch_payload([b'10.0.0.2\nforged'], [1]))
+    finally:
+        stop_inbox(inbox, '127.0.0.1')
+    assert messaging.incoming_messages.drain(timeout=0.2) == []
+
+
+def test_unreachable_recipients_back_off(spool, messages_port):
+    held = new_relay(spool, retry_interval=10)
+    held.hold(1, '127.0.0.2', '127.0.0.3', 'ciao')
+    started = time.monotonic()
+    held.forward('127.0.0.2')  # nobody listening
+    when, backoff = held.due['127.0.0.2']
+    assert when - started >= 9
+    assert backoff == 20
+    assert len(held) == 1
+
+
+def test_relays_forward_to_several_recipients_at_once(spool):
+    held = new_relay(spool, poll_interval=0.05)
+    forwarded = []
+
+    def slow_forward(recipient):
+        time.sleep(0.5)  # as if connecting timed out
+        forwarded.append(recipient)
+        held.back_off(recipient)
+    held.forward = slow_forward
+    for i in range(4):
+        held.hold(i, '10.0.0.{}'.format(i), '127.0.0.1', 'ciao')
+    thread = threading.Thread(target=held.start)
+    thread.start()
+    try:
+        time.sleep(0.8)
+        assert sorted(forwarded) == ['10.0.0.{}'.format(i) for i in range(4)]
+    finally:
+        held.stop.set()
+        thread.join()
+
+
+def test_siblings_pull_what_they_miss_and_drop_what_was_delivered(tmpdir, spool, messages_port):
+    theirs = new_relay(spool, siblings=['127.0.0.1'])
+    theirs.hold(1, '10.0.0.1', '127.0.0.3', 'one')
+    theirs.hold(2, '10.0.0.1', '127.0.0.3', 'two')
+    theirs.remove(2, '10.0.0.1')  # delivered
+    ours_spool = store.OutboxSpool(str(tmpdir.join('ours.spool')))
+    ours_spool.open()
+    thread = threading.Thread(target=ours_spool.start)
+    thread.start()
+    try:
+        ours = new_relay(ours_spool, siblings=['127.0.0.1'])
+        ours.hold(2, '10.0.0.1', '127.0.0.3', 'two')
+        ours.hold(3, '10.0.0.2', '127.0.0.3', 'three')
+        inbox = start_inbox('127.0.0.1', relay=theirs)
+        try:
+            ours.sync_with('127.0.0.1')
+        finally:
+            stop_inbox(inbox, '127.0.0.1')
+        assert sorted(ours_spool.pending) == [1, 3]
+        assert ours.sealer.unseal(ours_spool.pending[1][1]) == ('127.0.0.3', 'one')
+        assert ours.digests['10.0.0.1'] == theirs.digests['10.0.0.1']
+    finally:
+        ours_spool.stop.set()
+        thread.join()
+
+
+@pytest.mark.parametrize('request_', [b'not json', b'{"want": ["x"]}', b'[]', b'\xff'])
+def test_malformed_sync_requests(spool, request_):
+    held = new_relay(spool)
+    with pytest.raises(frames.FrameError):
+        held.handle_sync(request_)
+
+
+def test_purge_drops_expired_messages(spool):
+    held = new_relay(spool, retention=60)
+    held.hold(1, '10.0.0.1', '127.0.0.1', 'old')
+    held.hold(2, '10.0.0.1', '127.0.0.1', 'new')
+    recipient, sealed = spool.pending[1]
+    _, sender, message = json.loads(sealed)
+    spool.add(1, recipient, json.dumps([time.time() - 120, sender, message]))
+    held.purge()
+    assert list(spool.pending) == [2]
+    assert list(held.mailboxes['10.0.0.1']) == [2]
+    assert 1 not in held.delivered
+
+
+def test_sealer_round_trip(tmpdir):
+    pytest.importorskip('cryptography')
+    sealer = relay.Sealer(str(tmpdir.join('keys', 'relay.key')))
+    sealed = sealer.seal('127.0.0.1', 'ciao\nmondo')
+    assert sealer.unseal(sealed) == ('127.0.0.1', 'ciao\nmondo')
+    assert abs(sealer.sealed_at(sealed) - time.time()) < 60
+    # the key is kept
+    assert relay.Sealer(str(tmpdir.join('keys', 'relay.key'))).unseal(sealed) == \
+        ('127.0.0.1', 'ciao\nmondo')
+    with pytest.raises(ValueError):
+        sealer.unseal('garbage')
@@ -0,0 +1,204 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import socket
+import threading
+import time
+import pytest
+import client
+import messaging
+import SUSd
+from peers import PeerDirectory
+
+
+@pytest.fixture(params=['threads', 'asyncio'])
+def shell(request, tmpdir, monkeypatch):
+    """ A Shell listening on a free port, served by threads or by an event loop. """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    monkeypatch.setattr(SUSd, 'SUSD_SHELL_PORT', port)
+    monkeypatch.setattr(client, 'SUSD_SHELL_PORT', port)
+    sent()
+    shell = SUSd.Shell('127.0.0.1', groups_file=str(tmpdir.join('groups.json')),
+                       peers=PeerDirectory(str(tmpdir.join('peers.json'))),
+                       silence_list=messaging.SilenceList(str(tmpdir.join('silenced.json'))))
+    shell.port = port
+    shell.server.listen()  # before the thread gets to it
+    if request.param == 'threads':
+        thread = threading.Thread(target=shell.listen, daemon=True)
+    else:
+        thread = threading.Thread(target=messaging.listen_async, args=([shell], shell.stop),
+                                  daemon=True)
+    thread.start()
+    yield shell
+    shell.stop.set()
+    try:
+        socket.create_connection(('127.0.0.1', port)).close()  # wakes accept up
+    except socket.error:
+        pass
+    thread.join(5)
+    sent()
+
+
+def exchange(shell, data):
+    """ Sends `data` to `shell`, and returns all it answers until it closes. """
+    with socket.create_connection(('127.0.0.1', shell.port), timeout=5) as conn:
+        conn.sendall(data)
+        conn.shutdown(socket.SHUT_WR)
+        answer = b''
+        while True:
+            fragment = conn.recv(4096)
+            if fragment == b'':
+                return answer
+            answer += fragment
+
+
+def sent():
+    messages = []
+    while True:
+        batch = messaging.outgoing_messages.drain(max_items=1000, timeout=0)
+        if not batch:
+            return [(m.recipient, m.message) for m in messages]
+        messages.extend(batch)
+
+
+def test_command(shell):
+    assert exchange(shell, b'send 10.0.0.1 hello there\n') == b'OK\n200'
+    assert sent() == [('10.0.0.1', 'hello there')]
+
+
+@pytest.mark.parametrize('command', [b'send 10.0.0.1', b'send', b'ungroup', b'unpeer',
+                                     b'unsilence', b'send 10.0.0.1 \xff\xfe'])
+def test_bad_command(shell, command):
+    assert exchange(shell, command + b'\n') == b'OK\n400'
+
+
+def test_stream(shell):
+    lines = [b'send 10.0.0.1 one', b'send 10.0.0.1 two', b'send 10.0.0.2 three', b'stats',
+             b'send 10.0.0.1 four']
+    answer = exchange(shell, b'stream\n' + b'\n'.join(lines) + b'\n')
+    assert answer == b'OK\n200\n200\n200\n200\n200\n'
+    assert sent() == [('10.0.0.1', 'one'), ('10.0.0.1', 'two'), ('10.0.0.2', 'three'),
+                      ('10.0.0.1', 'four')]
+
+
+def test_stream_last_line_without_newline(shell):
+    assert exchange(shell, b'stream\nsend 10.0.0.1 one\nsend 10.0.0.1 two') == \
+        b'OK\n200\n200\n'
+
+
+def test_stream_answers_every_line(shell):
+    lines = [b'send 10.0.0.1 one', b'send 10.0.0.1 \xff', b'send 10.0.0.1', b'nope',
+             b'send 10.0.0.1 two']
+    answer = exchange(shell, b'stream\n' + b'\n'.join(lines) + b'\n')
+    assert answer == b'OK\n200\n400\n400\n404\n200\n'
+    assert sent() == [('10.0.0.1', 'one'), ('10.0.0.1', 'two')]
+
+
+def test_stream_split_across_packets(shell):
+    with socket.create_connection(('127.0.0.1', shell.port), timeout=5) as conn:
+        conn.sendall(b'stream\n')
+        assert conn.recv(3) == b'OK\n'
+        conn.sendall(b'send 10.0.0.1 o')
+        conn.sendall(b'ne\nsend 10.0.0.1 t')
+        assert conn.recv(4) == b'200\n'
+        conn.sendall(b'wo\n')
+        assert conn.recv(4) == b'200\n'
+    assert sent() == [('10.0.0.1', 'one'), ('10.0.0.1', 'two')]
+
+
+def test_send_from_the_command_line(shell, capsys):
+    client.send('10.0.0.1', 'ciao')
+    assert capsys.readouterr().out == 'SUS>  \u2713\n'
+    assert sent() == [('10.0.0.1', 'ciao')]
+    client.send('@nope', 'ciao')
+    assert capsys.readouterr().out == 'error>  no such group or peer.\n'
+
+
+def test_send_stream_from_the_command_line(shell, capsys):
+    lines = ['10.0.0.2\tmessage {}\n'.format(i) if i % 2 else 'message {}\n'.format(i)
+             for i in range(5000)]
+    lines.insert(10, '@nope\tlost\n')
+    client.send_stream(lines, '10.0.0.1')
+    assert capsys.readouterr().out == 'error>  line 11: status 404.\n' \
+                                      'error>  1 of 5001 messages not accepted.\n'
+    messages = sent()
+    assert len(messages) == 5000
+    assert messages[:2] == [('10.0.0.1', 'message 0'), ('10.0.0.2', 'message 1')]
+
+
+def test_send_to_a_group(shell):
+    assert exchange(shell, b'group friends 10.0.0.1, 10.0.0.2\n') == b'OK\n200'
+    assert exchange(shell, b'group friends\n') == b'OK\n200\n@friends: 10.0.0.1, 10.0.0.2\n'
+
+    def deliver():
+        # stands in for the outbox: the first recipient gets it, the second doesn't
+        outcomes = {'10.0.0.1': 'sent', '10.0.0.2': 'failed'}
+        pending = set(outcomes)
+        while pending:
+            for message in messaging.outgoing_messages.drain(timeout=5):
+                messaging.finish(message, outcomes[message.recipient])
+                pending.discard(message.recipient)
+    thread = threading.Thread(target=deliver)
+    thread.start()
+    answer = exchange(shell, b'send @friends,10.0.0.1 ciao\n')
+    thread.join()
+    assert answer == b'OK\n200\n10.0.0.1 sent\n10.0.0.2 failed\n'
+    assert exchange(shell, b'send @enemies ciao\n') == b'OK\n404\nno such group or peer.'
+    assert exchange(shell, b'ungroup friends\n') == b'OK\n200'
+    assert exchange(shell, b'group\n') == b'OK\n200\n'
+
+
+def test_silence(shell):
+    assert exchange(shell, b'silence 10.1.2.3/16 2h\n') == b'OK\n200\n10.1.0.0/16\n'
+    assert '10.1.9.9' in shell.silence_list
+    assert exchange(shell, b'silence\n').startswith(b'OK\n200\n10.1.0.0/16 until ')
+    assert exchange(shell, b'silence 10.0.0.1 forever\n') == b'OK\n400'
+    assert exchange(shell, b'unsilence 10.1.0.0/16\n') == b'OK\n200'
+    assert exchange(shell, b'unsilence 10.1.0.0/16\n') == b'OK\n404'
+
+
+def test_subscription(shell):
+    with socket.create_connection(('127.0.0.1', shell.port), timeout=5) as conn:
+        lines = conn.makefile('rb')
+        conn.sendall(b'subscribe\nsend 10.0.0.1 ciao\n')
+        assert lines.readline() == b'OK\n'
+        assert json.loads(lines.readline().decode('utf-8')) == {'status': '200', 'body': ''}
+        deadline = time.monotonic() + 5
+        while not len(messaging.subscribers) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        messaging.subscribers.publish('10.0.0.2', 'hello \u00e8')
+        assert json.loads(lines.readline().decode('utf-8')) == \
+            {'sender': '10.0.0.2', 'message': 'hello \u00e8'}
+        conn.sendall(b'send 10.0.0.1 \xff\ngroup nope\n')
+        assert json.loads(lines.readline().decode('utf-8'))['status'] == '400'
+        assert json.loads(lines.readline().decode('utf-8'))['status'] == '404'
+        lines.close()
+    assert sent() == [('10.0.0.1', 'ciao')]
+    deadline = time.monotonic() + 5
+    while len(messaging.subscribers) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(messaging.subscribers) == 0
+
+
+def test_interactive_client(shell, capsys):
+    client.interactive(['hello?\n', '/to 10.0.0.1\n', 'ciao\n', '/quit\n', 'ignored\n'])
+    messages = messaging.outgoing_messages.drain(timeout=5)
+    assert [(m.recipient, m.message) for m in messages] == [('10.0.0.1', 'ciao')]
+    assert 'nobody to talk to yet' in capsys.readouterr().out
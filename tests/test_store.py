@@ -0,0 +1,211 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import datetime
+import os
+import threading
+import time
+import pytest
+import store
+
+
+def open_spool(directory, **kwargs):
+    spool = store.OutboxSpool(os.path.join(str(directory), 'outbox.spool'), **kwargs)
+    return spool, spool.open()
+
+
+def reopen(spool):
+    spool.sync()
+    spool.file.close()
+    return open_spool(os.path.dirname(spool.path))[1]
+
+
+def test_spool_replays_pending_messages(tmpdir):
+    spool, replayed = open_spool(tmpdir)
+    assert replayed == []
+    spool.add(1, '10.0.0.1', 'uno', wait=False)
+    spool.add(2, '10.0.0.2', 'd\u00f2', wait=False)
+    spool.add(3, '10.0.0.1', 'tre', wait=False)
+    spool.done(2)
+    assert reopen(spool) == [(1, '10.0.0.1', 'uno'), (3, '10.0.0.1', 'tre')]
+
+
+def test_spool_ignores_a_torn_write(tmpdir):
+    spool, _ = open_spool(tmpdir)
+    spool.add(1, '10.0.0.1', 'whole', wait=False)
+    spool.add(2, '10.0.0.1', 'torn', wait=False)
+    spool.sync()
+    spool.file.close()
+    with open(spool.path, 'r+b') as f:
+        f.truncate(os.path.getsize(spool.path) - 2)
+    assert open_spool(tmpdir)[1] == [(1, '10.0.0.1', 'whole')]
+
+
+def test_spool_tracks_the_size_of_pending_records(tmpdir):
+    spool, _ = open_spool(tmpdir)
+    for message_id in range(10):
+        spool.add(message_id, '10.0.0.1', 'm\u00e8ssage', wait=False)
+    spool.add(0, '10.0.0.1', 'again', wait=False)
+    for message_id in range(5):
+        spool.done(message_id)
+    spool.done(42)  # never added
+    expected = sum(spool.record_size(r, m) for r, m in spool.pending.values())
+    assert spool.live == expected
+    with spool.synced_changed:
+        spool.compact()
+    assert spool.live == expected == os.path.getsize(spool.path)
+    spool.file.close()
+
+
+def test_spool_compaction_keeps_pending_messages(tmpdir):
+    spool, _ = open_spool(tmpdir)
+    for message_id in range(100):
+        spool.add(message_id, '10.0.0.1', 'message', wait=False)
+    for message_id in range(99):
+        spool.done(message_id)
+    with spool.synced_changed:
+        spool.compact()
+    assert os.path.getsize(spool.path) == store.SPOOL_RECORD.size + len('10.0.0.1message')
+    assert reopen(spool) == [(99, '10.0.0.1', 'message')]
+
+
+def run_spool(spool, adds, dones=()):
+    """ Group-commits `spool` while `adds` messages are added and `dones` are done;
+    returns how many times it was compacted.
+    """
+    compactions = []
+    compact = spool.compact
+    spool.compact = lambda: compactions.append(compact())
+    thread = threading.Thread(target=spool.start)
+    thread.start()
+    try:
+        for message_id in dones:
+            spool.done(message_id)
+        for message_id in adds:
+            spool.add(message_id, '10.0.0.1', 'y' * 100)
+    finally:
+        spool.stop.set()
+        thread.join()
+    return len(compactions)
+
+
+def test_spool_with_a_large_backlog_is_not_compacted_at_every_commit(tmpdir):
+    spool, _ = open_spool(tmpdir, compact_size=64 * 1024)
+    for message_id in range(2000):  # about 230 kB pending
+        spool.add(message_id, '10.0.0.1', 'x' * 100, wait=False)
+    assert run_spool(spool, range(10000, 10200)) == 0
+
+
+def test_spool_is_compacted_once_mostly_done(tmpdir):
+    spool, _ = open_spool(tmpdir, compact_size=64 * 1024)
+    for message_id in range(2000):
+        spool.add(message_id, '10.0.0.1', 'x' * 100, wait=False)
+    assert run_spool(spool, [10000], dones=range(1900)) >= 1
+    assert sorted(open_spool(tmpdir)[1])[-1] == (10000, '10.0.0.1', 'y' * 100)
+    assert os.path.getsize(spool.path) < 64 * 1024
+
+
+def fill(history, count):
+    for i in range(count):
+        history.append(store.INCOMING if i % 2 else store.OUTGOING,
+                       '10.0.0.{}'.format(i % 3), 'message {}'.format(i))
+
+
+def test_message_store_history(tmpdir):
+    history = store.MessageStore(str(tmpdir), segment_size=200)
+    fill(history, 20)
+    assert len(history.segments()) > 1
+    messages = history.history()
+    assert [m.message for m in messages] == ['message {}'.format(i) for i in range(20)]
+    assert [m.direction for m in messages[:2]] == [store.OUTGOING, store.INCOMING]
+    assert [m.message for m in history.history(peer='10.0.0.1', count=2)] == \
+        ['message 16', 'message 19']
+    assert history.history(since=messages[-1].timestamp + 1) == []
+    history.close()
+
+
+def test_message_store_keeps_the_newest_segments(tmpdir):
+    history = store.MessageStore(str(tmpdir), segment_size=100, max_segments=2)
+    fill(history, 30)
+    assert len(history.segments()) == 2
+    assert history.history()[-1].message == 'message 29'
+    history.close()
+
+
+def reopened(directory, tear):
+    """ Appends to a store, tears the end of its newest segment with `tear`
+    (path without extension -> None), then appends after reopening it.
+    """
+    history = store.MessageStore(str(directory))
+    fill(history, 3)
+    history.close()
+    tear(history.segments()[-1])
+    history = store.MessageStore(str(directory))
+    history.open()
+    history.append(store.INCOMING, '10.0.0.1', 'appended')
+    messages = [m.message for m in history.history()]
+    history.close()
+    return messages
+
+
+def cut(path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - size)
+
+
+def test_message_store_drops_a_record_without_index_entry(tmpdir):
+    def tear(path):
+        with open(path + '.log', 'ab') as log:
+            log.write(b'\x00\x00')
+    assert reopened(tmpdir, tear) == ['message 0', 'message 1', 'message 2', 'appended']
+
+
+def test_message_store_drops_a_record_torn_in_its_header(tmpdir):
+    last = store.RECORD.size + len('10.0.0.2message 2')
+    tear = lambda path: cut(path + '.log', last - 5)
+    assert reopened(tmpdir, tear) == ['message 0', 'message 1', 'appended']
+
+
+def test_message_store_drops_a_record_torn_in_its_body(tmpdir):
+    tear = lambda path: cut(path + '.log', 3)
+    assert reopened(tmpdir, tear) == ['message 0', 'message 1', 'appended']
+
+
+def test_message_store_drops_a_torn_index_entry(tmpdir):
+    tear = lambda path: cut(path + '.idx', 3)
+    assert reopened(tmpdir, tear) == ['message 0', 'message 1', 'appended']
+
+
+
+def test_parse_since():
+    assert abs(store.parse_since('2h') - (time.time() - 2 * 3600)) < 5
+    assert store.parse_since('2017-04-14 13:30') == \
+        datetime.datetime(2017, 4, 14, 13, 30).timestamp()
+    with pytest.raises(ValueError):
+        store.parse_since('yesterday')
+
+
+@pytest.mark.parametrize('duration, seconds', [('90s', 90), ('30m', 1800), ('2h', 7200),
+                                               ('1.5d', 129600)])
+def test_parse_duration(duration, seconds):
+    assert store.parse_duration(duration) == seconds
+
+
+@pytest.mark.parametrize('duration', ['90', '2 weeks', 'h', ''])
+def test_parse_bad_duration(duration):
+    with pytest.raises(ValueError):
+        store.parse_duration(duration)
@@ -0,0 +1,85 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import ssl
+import subprocess
+import pytest
+import messaging
+import tls
+
+
+def make_certificate(directory, name='SUS'):
+    """ A self-signed certificate and its key, made by the openssl command. """
+    cert, key = str(directory.join(name + '.crt')), str(directory.join(name + '.key'))
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt',
+                    'ec_paramgen_curve:P-256', '-nodes', '-days', '1', '-subj', '/CN=' + name,
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+
+@pytest.fixture(scope='module')
+def certificate(tmpdir_factory):
+    if shutil.which('openssl') is None:
+        pytest.skip('needs the openssl command')
+    return make_certificate(tmpdir_factory.mktemp('tls'))
+
+
+def outbox(client_tls):
+    # idle_timeout=0: every message gets a new connection
+    connections = messaging.PeerConnectionPool(idle_timeout=0, timeout=5, tls=client_tls)
+    sender = messaging.OutboxSender(watch=messaging.MessageQueue(), connections=connections)
+    sender.probe_timeout = 1
+    return sender
+
+
+def send(sender, message):
+    sender.send_messages('127.0.0.1', [(messaging.Outgoing(
+        '127.0.0.1', message, None, messaging.new_message_id()), 0)])
+
+
+def test_messages_go_over_tls_and_sessions_resume(start_inbox, certificate):
+    start_inbox(tls=tls.server_context(*certificate))
+    client_tls = tls.ClientTLS(tls.client_context(certificate[0]))
+    sender = outbox(client_tls)
+    handshakes, resumed = tls.handshakes_total.value, tls.resumed_total.value
+    send(sender, 'first')
+    assert messaging.incoming_messages.drain(timeout=5) == [('127.0.0.1', 'first')]
+    assert '127.0.0.1' in client_tls.sessions
+    send(sender, 'second')
+    assert messaging.incoming_messages.drain(timeout=5) == [('127.0.0.1', 'second')]
+    assert tls.handshakes_total.value - handshakes == 2
+    assert tls.resumed_total.value - resumed == 1
+    assert client_tls.wanted('127.0.0.1')
+
+
+def test_inboxes_without_tls_get_plaintext(start_inbox):
+    start_inbox()
+    client_tls = tls.ClientTLS(tls.client_context())
+    send(outbox(client_tls), 'plain')
+    assert messaging.incoming_messages.drain(timeout=5) == [('127.0.0.1', 'plain')]
+    assert not client_tls.wanted('127.0.0.1')
+
+
+def test_untrusted_certificates_are_not_taken_for_plaintext(start_inbox, certificate, tmpdir):
+    start_inbox(tls=tls.server_context(*certificate))
+    other, _ = make_certificate(tmpdir, 'other')
+    client_tls = tls.ClientTLS(tls.client_context(other))
+    pool = messaging.PeerConnectionPool(timeout=5, tls=client_tls)
+    with pytest.raises(ssl.SSLCertVerificationError):
+        pool.acquire('127.0.0.1')
+    assert client_tls.wanted('127.0.0.1')
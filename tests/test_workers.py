@@ -0,0 +1,87 @@
+
+#  Copyright (C) 2016  Daniele Parmeggiani <dani.parmeggiani@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import multiprocessing
+import socket
+import threading
+import time
+import pytest
+import messaging
+import workers
+
+
+pytestmark = pytest.mark.skipif(not workers.reuse_port_available(), reason='needs SO_REUSEPORT')
+
+
+@pytest.fixture
+def daemon_inbox(messages_port):
+    """ The daemon's inbox, bound to share the messages port but not listening. """
+    messaging.incoming_messages.drain(timeout=0)
+    inbox = messaging.InboxServer('127.0.0.1', reuse_port=True,
+                                  duplicates=messaging.DuplicateFilter())
+    yield inbox
+    inbox.server.close()
+    messaging.incoming_messages.drain(timeout=0)
+
+
+def test_collect_waits_for_room_instead_of_dropping(daemon_inbox, monkeypatch):
+    monkeypatch.setattr(messaging.incoming_messages, 'capacity', 1)
+    monkeypatch.setattr(messaging.incoming_messages, 'policy', messaging.REJECT)
+    receiving, sending = multiprocessing.Pipe(duplex=False)
+    stop = threading.Event()
+    collector = threading.Thread(target=workers.collect,
+                                 args=(daemon_inbox, receiving, stop, 0.05))
+    collector.start()
+    try:
+        # a retry that reached another worker is dropped as a duplicate
+        sending.send([('10.0.0.1', 'uno', 1), ('10.0.0.1', 'due', 2), ('10.0.0.1', 'due', 2)])
+        received = []
+        deadline = time.monotonic() + 5
+        while len(received) < 2 and time.monotonic() < deadline:
+            received.extend(messaging.incoming_messages.drain(timeout=0.1))
+        assert received == [('10.0.0.1', 'uno'), ('10.0.0.1', 'due')]
+    finally:
+        stop.set()
+        collector.join()
+
+
+def test_workers_receive_for_the_daemon(daemon_inbox):
+    args = argparse.Namespace(
+        ip='127.0.0.1', incoming_capacity=0, incoming_policy=messaging.BLOCK, inbox_rate=0,
+        inbox_burst=0, backlog=16, max_connections=16, max_connections_per_ip=0, async_io=False)
+    stop = threading.Event()
+    processes = workers.start_workers(1, args, daemon_inbox, stop)
+    try:
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                conn = socket.create_connection(('127.0.0.1', messaging.SUS_MESSAGES_PORT), 1)
+                break
+            except socket.error:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)  # the worker is still starting
+        with conn:
+            conn.sendall(b'ciao##END')
+            assert conn.recv(1024).startswith(b'OK\n200')
+        assert messaging.incoming_messages.drain(timeout=5) == [('127.0.0.1', 'ciao')]
+    finally:
+        stop.set()
+        for process in processes:
+            process.terminate()
+            process.join(5)